@@ -0,0 +1,426 @@
+"""
+Общие части бенчмарков tls_proxy: самоподписанный сертификат, TLS эхо-сервер и заглушка
+usbipd вместо настоящего сервера и запуск прокси в отдельном процессе
+"""
+from typing import Dict, List, Optional, Tuple
+import multiprocessing
+import subprocess
+import argparse
+import asyncio
+import struct
+import socket
+import time
+import ssl
+import sys
+import os
+
+from tls_proxy.config import TARGET_HOST_SIZE
+from tls_proxy.protocol import OP_COMMON, OP_REQ_DEVLIST, OP_REP_DEVLIST, OP_REQ_IMPORT
+from tls_proxy.protocol import OP_REP_IMPORT, USB_DEVICE, USBIP_HEADER, USBIP_CMD_SUBMIT
+from tls_proxy.protocol import USBIP_CMD_UNLINK, USBIP_RET_SUBMIT, USBIP_RET_UNLINK
+from tls_proxy.protocol import USBIP_DIR_IN, USBIP_DIR_OUT, SYSFS_BUS_ID_SIZE
+from tls_proxy.protocol import submit_payload_size
+
+
+TARGET_HOST = "localhost"
+
+# Устройство заглушки usbipd
+USBIP_VERSION = 0x0111
+STUB_BUSID = "1-1"
+STUB_DEVID = 1 << 16 | 2
+STUB_DEVICE = USB_DEVICE.pack(b"/sys/devices/platform/stub/usb1/1-1", STUB_BUSID.encode(),
+                              1, 2, 3, 0x1d6b, 0x0104, 0x0100, 0, 0, 0, 1, 1, 1)
+# bInterfaceClass, bInterfaceSubClass, bInterfaceProtocol, padding
+STUB_INTERFACE = bytes([0xff, 0, 0, 0])
+BULK_IN_EP = 1
+BULK_OUT_EP = 2
+INTERRUPT_IN_EP = 3
+# Как у HID-клавиатуры: отчет 8 байт, bInterval 10
+HID_REPORT_SIZE = 8
+HID_INTERVAL = 10
+
+
+def make_self_signed_cert(directory: str) -> Tuple[str, str]:
+    cert_path = os.path.join(directory, "usbip.crt")
+    key_path = os.path.join(directory, "usbip.key")
+    subprocess.run(["openssl", "req", "-batch", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-days", "1", "-subj", "/CN=localhost",
+                    "-keyout", key_path, "-out", cert_path],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_path, key_path
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port: int, timeout_s: float = 10.):
+    deadline = time.monotonic() + timeout_s
+    while True:
+        try:
+            with socket.create_connection(("localhost", port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def target_host_preamble(target_host: str = TARGET_HOST) -> bytes:
+    return target_host.encode("ascii").ljust(TARGET_HOST_SIZE, b'\0')
+
+
+def start_echo_server(cert_path: str, key_path: str, processes: int = 1,
+                      plain: bool = False) -> Tuple[List[subprocess.Popen], int]:
+    """
+    processes > 1 - несколько процессов эхо-сервера на одном порту (SO_REUSEPORT).
+    plain - эхо-сервер без TLS
+    """
+    port = free_port()
+    args = ["--plain"] if plain else ["--cert", cert_path, "--key", key_path]
+    procs = [subprocess.Popen([sys.executable, "-m", "benchmarks.harness", "echo",
+                               "--port", str(port), *args])
+             for _ in range(processes)]
+    wait_port(port)
+    return procs, port
+
+
+def start_usbipd_stub(cert_path: str, key_path: str) -> Tuple[subprocess.Popen, int]:
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "benchmarks.harness", "usbipd",
+                             "--port", str(port), "--cert", cert_path, "--key", key_path])
+    wait_port(port)
+    return proc, port
+
+
+def start_proxy(upstream_port: int, ca_file: str,
+                extra_args: List[str] = ()) -> Tuple[subprocess.Popen, int]:
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "tls_proxy", "--port", str(port),
+                             "--upstream-port", str(upstream_port), "--cafile", ca_file,
+                             *extra_args],
+                            stderr=subprocess.DEVNULL)
+    wait_port(port)
+    return proc, port
+
+
+def start_tunnel_server(usbipd_port: int, cert_path: str, key_path: str,
+                        extra_args: List[str] = ()) -> Tuple[subprocess.Popen, int]:
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "tls_proxy.tunnel_server",
+                             "--address", "localhost", "--port", str(port),
+                             "--cert", cert_path, "--key", key_path, "--client-ca", cert_path,
+                             "--usbipd-port", str(usbipd_port), "--usbipd-cafile", cert_path,
+                             *extra_args],
+                            stderr=subprocess.DEVNULL)
+    wait_port(port)
+    return proc, port
+
+
+def cpu_time(procs: List[subprocess.Popen]) -> float:
+    """
+    Процессорное время (user + system) процессов в секундах
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.
+    for proc in procs:
+        with open(f"/proc/{proc.pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        # utime и stime - 14 и 15 поля, первые два поля отрезаны
+        total += (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+
+def stop_process(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def stop_processes(procs: List[subprocess.Popen]):
+    for proc in procs:
+        stop_process(proc)
+
+
+async def open_session(proxy_port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    reader, writer = await asyncio.open_connection("localhost", proxy_port)
+    writer.write(target_host_preamble())
+    return reader, writer
+
+
+async def _ping_pong_session(proxy_port: int, messages: int, payload: bytes,
+                             latencies: List[float]) -> int:
+    reader, writer = await open_session(proxy_port)
+    try:
+        for _ in range(messages):
+            start = time.perf_counter()
+            writer.write(payload)
+            await reader.readexactly(len(payload))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+    return messages * len(payload) * 2
+
+
+async def run_sessions(proxy_port: int, sessions: int, messages: int,
+                       size: int) -> Tuple[int, List[float]]:
+    """
+    sessions сессий одновременно отправляют через прокси messages сообщений по size байт
+    и ждут эха каждого. Возвращает число переданных байт и задержки сообщений
+    """
+    latencies: List[float] = []
+    payload = bytes(size)
+    transferred = await asyncio.gather(
+        *(_ping_pong_session(proxy_port, messages, payload, latencies) for _ in range(sessions)))
+    return sum(transferred), latencies
+
+
+def _run_sessions_process(args: Tuple[int, int, int, int]) -> Tuple[int, List[float]]:
+    raise_nofile_limit()
+    return asyncio.run(run_sessions(*args))
+
+
+def run_load(proxy_port: int, sessions: int, messages: int, size: int,
+             processes: int = 1) -> Tuple[float, List[float]]:
+    """
+    Запускает run_sessions в processes процессах, поделив между ними сессии.
+    Возвращает суммарную пропускную способность в байтах в секунду и задержки сообщений
+    """
+    start = time.perf_counter()
+    if processes <= 1:
+        transferred, latencies = asyncio.run(run_sessions(proxy_port, sessions, messages, size))
+    else:
+        shares = [sessions // processes + (i < sessions % processes) for i in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_run_sessions_process,
+                               [(proxy_port, share, messages, size) for share in shares if share])
+        transferred = sum(result[0] for result in results)
+        latencies = [latency for result in results for latency in result[1]]
+    return transferred / (time.perf_counter() - start), latencies
+
+
+async def _urb_session(proxy_port: int, urbs: int, size: int, direction: int, depth: int,
+                       latencies: List[float], interval: int = 0, period_s: float = 0.) -> int:
+    """
+    Импортирует устройство заглушки usbipd и передает urbs URB bulk по size байт, держа
+    depth URB без ответа. С interval - URB прерываний IN, следующий через period_s после ответа
+    """
+    reader, writer = await open_session(proxy_port)
+    try:
+        writer.write(OP_COMMON.pack(USBIP_VERSION, OP_REQ_IMPORT, 0) +
+                     STUB_BUSID.encode().ljust(SYSFS_BUS_ID_SIZE, b'\0'))
+        _, _, status = OP_COMMON.unpack(await reader.readexactly(OP_COMMON.size))
+        if status:
+            raise ConnectionError(f"Import failed with status {status}")
+        await reader.readexactly(USB_DEVICE.size)
+
+        ep = BULK_IN_EP if direction == USBIP_DIR_IN else BULK_OUT_EP
+        if interval:
+            ep = INTERRUPT_IN_EP
+        payload = bytes(size) if direction == USBIP_DIR_OUT else b''
+        submitted: Dict[int, float] = {}
+        seqnum = 0
+
+        def submit():
+            nonlocal seqnum
+            seqnum += 1
+            submitted[seqnum] = time.perf_counter()
+            writer.write(USBIP_HEADER.pack(USBIP_CMD_SUBMIT, seqnum, STUB_DEVID, direction, ep,
+                                           0, size, 0, 0, interval) + payload)
+
+        for _ in range(min(depth, urbs)):
+            submit()
+        for _ in range(urbs):
+            _, ret_seqnum, _, _, _, _, actual_length, _, packets, _ = \
+                USBIP_HEADER.unpack(await reader.readexactly(USBIP_HEADER.size))
+            data_size = submit_payload_size(direction == USBIP_DIR_IN, actual_length, packets)
+            if data_size:
+                await reader.readexactly(data_size)
+            latencies.append(time.perf_counter() - submitted.pop(ret_seqnum))
+            if period_s:
+                await asyncio.sleep(period_s)
+            if seqnum < urbs:
+                submit()
+                await writer.drain()
+    finally:
+        writer.close()
+    return urbs * size
+
+
+async def run_urb_sessions(proxy_port: int, sessions: int, urbs: int, size: int, direction: int,
+                           depth: int) -> Tuple[int, List[float]]:
+    """
+    sessions сессий одновременно передают через прокси urbs URB по size байт.
+    Возвращает число переданных байт данных URB и задержки от CMD_SUBMIT до RET_SUBMIT
+    """
+    latencies: List[float] = []
+    transferred = await asyncio.gather(
+        *(_urb_session(proxy_port, urbs, size, direction, depth, latencies)
+          for _ in range(sessions)))
+    return sum(transferred), latencies
+
+
+def run_urb_load(proxy_port: int, sessions: int, urbs: int, size: int, direction: int,
+                 depth: int) -> Tuple[float, int, List[float]]:
+    """
+    Возвращает пропускную способность в байтах в секунду, число переданных байт данных URB
+    и задержки URB
+    """
+    start = time.perf_counter()
+    transferred, latencies = asyncio.run(
+        run_urb_sessions(proxy_port, sessions, urbs, size, direction, depth))
+    return transferred / (time.perf_counter() - start), transferred, latencies
+
+
+async def _hid_under_bulk(proxy_port: int, bulk_sessions: int, bulk_size: int, depth: int,
+                          hid_urbs: int, period_s: float) -> Tuple[float, List[float]]:
+    bulk_latencies: List[float] = []
+    hid_latencies: List[float] = []
+    bulk = [asyncio.ensure_future(_urb_session(proxy_port, 1 << 30, bulk_size, USBIP_DIR_IN,
+                                               depth, bulk_latencies))
+            for _ in range(bulk_sessions)]
+    # Bulk успевает заполнить очереди
+    await asyncio.sleep(0.5)
+    start = time.perf_counter()
+    bulk_urbs = len(bulk_latencies)
+    try:
+        await _urb_session(proxy_port, hid_urbs, HID_REPORT_SIZE, USBIP_DIR_IN, 1,
+                           hid_latencies, HID_INTERVAL, period_s)
+    finally:
+        bulk_urbs = len(bulk_latencies) - bulk_urbs
+        for task in bulk:
+            task.cancel()
+        await asyncio.gather(*bulk, return_exceptions=True)
+    return bulk_urbs * bulk_size / (time.perf_counter() - start), hid_latencies
+
+
+def run_hid_under_bulk(proxy_port: int, bulk_sessions: int, bulk_size: int, depth: int,
+                       hid_urbs: int, period_s: float) -> Tuple[float, List[float]]:
+    """
+    Сессия HID-устройства передает hid_urbs URB прерываний раз в period_s, пока bulk_sessions
+    сессий передают URB bulk IN по bulk_size байт. Возвращает пропускную способность bulk
+    в байтах в секунду за это время и задержки URB прерываний
+    """
+    return asyncio.run(_hid_under_bulk(proxy_port, bulk_sessions, bulk_size, depth, hid_urbs,
+                                       period_s))
+
+
+def raise_nofile_limit():
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, ssl.SSLError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _usbipd_stub_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Отвечает на OP_REQ_DEVLIST и OP_REQ_IMPORT одним устройством, после импорта отвечает на
+    CMD_SUBMIT успешным RET_SUBMIT с данными нужного размера для IN, на CMD_UNLINK - RET_UNLINK
+    """
+    try:
+        version, code, _ = OP_COMMON.unpack(await reader.readexactly(OP_COMMON.size))
+        if code == OP_REQ_DEVLIST:
+            writer.write(OP_COMMON.pack(version, OP_REP_DEVLIST, 0) + struct.pack(">I", 1) +
+                         STUB_DEVICE + STUB_INTERFACE)
+            await writer.drain()
+            return
+        if code != OP_REQ_IMPORT:
+            return
+        await reader.readexactly(SYSFS_BUS_ID_SIZE)
+        writer.write(OP_COMMON.pack(version, OP_REP_IMPORT, 0) + STUB_DEVICE)
+
+        while True:
+            command, seqnum, _, direction, _, _, length, _, packets, _ = \
+                USBIP_HEADER.unpack(await reader.readexactly(USBIP_HEADER.size))
+            if command == USBIP_CMD_SUBMIT:
+                data_size = submit_payload_size(direction == USBIP_DIR_OUT, length, packets)
+                if data_size:
+                    await reader.readexactly(data_size)
+                writer.write(USBIP_HEADER.pack(USBIP_RET_SUBMIT, seqnum, 0, 0, 0, 0, length, 0,
+                                               packets, 0) +
+                             bytes(submit_payload_size(direction == USBIP_DIR_IN, length,
+                                                       packets)))
+            elif command == USBIP_CMD_UNLINK:
+                # URB заглушки завершаются сразу, отменять нечего
+                writer.write(USBIP_HEADER.pack(USBIP_RET_UNLINK, seqnum, 0, 0, 0, 0, 0, 0, 0, 0))
+            else:
+                return
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run_echo_server(port: int, cert_path: Optional[str], key_path: Optional[str]):
+    """
+    Без сертификата - эхо-сервер без TLS
+    """
+    context = None
+    if cert_path is not None:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert_path, key_path)
+    server = await asyncio.start_server(_echo, "localhost", port, ssl=context, backlog=4096,
+                                        reuse_port=True)
+    async with server:
+        await server.serve_forever()
+
+
+async def run_usbipd_stub(port: int, cert_path: str, key_path: str):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    server = await asyncio.start_server(_usbipd_stub_session, "localhost", port, ssl=context,
+                                        backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tls_proxy benchmark helpers")
+    parser.add_argument('command', choices=["echo", "usbipd"])
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--cert')
+    parser.add_argument('--key')
+    parser.add_argument('--plain', action='store_true')
+    args = parser.parse_args()
+    if not args.plain and not (args.cert and args.key):
+        parser.error("--cert and --key are required without --plain")
+    if args.command == "usbipd" and args.plain:
+        parser.error("usbipd stub requires TLS")
+
+    raise_nofile_limit()
+    try:
+        if args.command == "usbipd":
+            asyncio.run(run_usbipd_stub(args.port, args.cert, args.key))
+        else:
+            asyncio.run(run_echo_server(args.port, args.cert, args.key))
+    except KeyboardInterrupt:
+        pass
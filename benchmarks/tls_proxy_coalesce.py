@@ -0,0 +1,98 @@
+"""
+Объединение URB клиента в записи TLS (--coalesce) с разными задержками против пересылки каждой
+порции отдельной записью: URB в секунду, порции от клиента в секунду (без --coalesce каждая
+из них - запись), записи в соединение с сервером в секунду (запись до 16 КБ - одна запись TLS),
+задержка URB и процессорное время прокси на URB.
+Сессии передают небольшие URB bulk OUT заглушке usbipd, держа depth URB без ответа
+
+python3 -m benchmarks.tls_proxy_coalesce --delays 0 200 1000 --sessions 1 8
+"""
+import tempfile
+import argparse
+import json
+import os
+
+from tls_proxy.protocol import USBIP_DIR_OUT
+from tls_proxy.control import request
+from benchmarks import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy URB coalescing benchmark")
+    parser.add_argument('--delays', type=int, nargs='+', default=[0, 200, 1000],
+                        help='--coalesce-delay values in microseconds (besides no coalescing)')
+    parser.add_argument('--coalesce-size', type=int, default=16384, dest='coalesce_size')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--size', type=int, default=512, help='URB transfer size')
+    parser.add_argument('--urbs', type=int, default=2000, help='URBs per session')
+    parser.add_argument('--depth', type=int, default=16, help='Outstanding URBs per session')
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help='Also write results to JSON file')
+    args = parser.parse_args()
+
+    modes = {"off": []}
+    for delay in args.delays:
+        modes[f"{delay}us"] = ["--coalesce", "--coalesce-delay", str(delay),
+                               "--coalesce-size", str(args.coalesce_size)]
+
+    harness.raise_nofile_limit()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        control_path = os.path.join(tmp_dir, "control.sock")
+        usbipd_proc, usbipd_port = harness.start_usbipd_stub(cert_path, key_path)
+        try:
+            print(f"{'mode':>8} {'sessions':>8} {'URB/s':>10} {'chunks/s':>10} "
+                  f"{'writes/s':>10} {'URB/write':>10} {'p50 ms':>10} {'p99 ms':>10} "
+                  f"{'cpu us/URB':>11}")
+            for mode, mode_args in modes.items():
+                proxy_proc, proxy_port = harness.start_proxy(
+                    usbipd_port, cert_path, ["--control", control_path, *mode_args])
+                try:
+                    for sessions in args.sessions:
+                        before = request("stats", control_path)["coalesce"]
+                        cpu = harness.cpu_time([proxy_proc])
+                        throughput, transferred, latencies = harness.run_urb_load(
+                            proxy_port, sessions, args.urbs, args.size, USBIP_DIR_OUT,
+                            args.depth)
+                        cpu = harness.cpu_time([proxy_proc]) - cpu
+                        after = request("stats", control_path)["coalesce"]
+                        chunks = after["chunks"] - before["chunks"]
+                        writes = after["writes"] - before["writes"]
+                        urbs = transferred // args.size
+                        urbs_per_s = throughput / args.size
+                        result = {
+                            "mode": mode,
+                            "sessions": sessions,
+                            "urbs_per_s": urbs_per_s,
+                            # Без --coalesce порции и записи не считаются
+                            "chunks_per_s": chunks / urbs * urbs_per_s if chunks else None,
+                            "writes_per_s": writes / urbs * urbs_per_s if writes else None,
+                            "urbs_per_write": urbs / writes if writes else None,
+                            "p50_ms": harness.percentile(latencies, 0.5) * 1e3,
+                            "p99_ms": harness.percentile(latencies, 0.99) * 1e3,
+                            "cpu_us_per_urb": cpu / urbs * 1e6,
+                        }
+                        results.append(result)
+                        chunks_per_s = f"{result['chunks_per_s']:>10.0f}" if chunks else \
+                            f"{'-':>10}"
+                        writes_per_s = f"{result['writes_per_s']:>10.0f}" if writes else \
+                            f"{'-':>10}"
+                        urbs_per_write = f"{result['urbs_per_write']:>10.2f}" if writes else \
+                            f"{'-':>10}"
+                        print(f"{mode:>8} {sessions:>8} {urbs_per_s:>10.0f} {chunks_per_s} "
+                              f"{writes_per_s} {urbs_per_write} {result['p50_ms']:>10.3f} "
+                              f"{result['p99_ms']:>10.3f} {result['cpu_us_per_urb']:>11.1f}")
+                finally:
+                    harness.stop_process(proxy_proc)
+        finally:
+            harness.stop_process(usbipd_proc)
+
+    if args.json_path:
+        with open(args.json_path, "w") as out:
+            json.dump({"size": args.size, "urbs": args.urbs, "depth": args.depth,
+                       "coalesce_size": args.coalesce_size, "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
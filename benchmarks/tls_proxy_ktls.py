@@ -0,0 +1,92 @@
+"""
+Шифрование TLS в ядре (--ktls) против шифрования в OpenSSL в процессе прокси: пропускная
+способность, задержка URB и процессорное время прокси на гигабайт с заглушкой usbipd.
+URB OUT проверяют отправку серверу (splice в kTLS-соединение), URB IN - прием. Столбцы kTLS
+показывают, сколько соединений на самом деле шифрует ядро: без поддержки Python, OpenSSL
+или ядра --ktls работает как без него
+
+python3 -m benchmarks.tls_proxy_ktls --sizes 512 65536
+"""
+import tempfile
+import argparse
+import json
+import os
+
+from tls_proxy.protocol import USBIP_DIR_IN, USBIP_DIR_OUT
+from tls_proxy.control import request
+from benchmarks import harness
+
+
+MODES = {
+    "userspace": [],
+    "ktls": ["--ktls"],
+}
+DIRECTIONS = {"in": USBIP_DIR_IN, "out": USBIP_DIR_OUT}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy kernel TLS benchmark")
+    parser.add_argument('--modes', nargs='+', choices=MODES.keys(), default=list(MODES))
+    parser.add_argument('--directions', nargs='+', choices=DIRECTIONS.keys(),
+                        default=list(DIRECTIONS))
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 65536],
+                        help='URB transfer sizes')
+    parser.add_argument('--urbs', type=int, default=1000, help='URBs per session')
+    parser.add_argument('--depth', type=int, default=4, help='Outstanding URBs per session')
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help='Also write results to JSON file')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        control_path = os.path.join(tmp_dir, "control.sock")
+        usbipd_proc, usbipd_port = harness.start_usbipd_stub(cert_path, key_path)
+        try:
+            print(f"{'mode':>10} {'dir':>4} {'size':>8} {'MB/s':>10} {'p50 ms':>10} "
+                  f"{'p99 ms':>10} {'cpu s/GB':>10} {'ktls tx':>8} {'ktls rx':>8}")
+            for mode in args.modes:
+                proxy_proc, proxy_port = harness.start_proxy(
+                    usbipd_port, cert_path, ["--control", control_path, *MODES[mode]])
+                try:
+                    for direction in args.directions:
+                        for size in args.sizes:
+                            cpu = harness.cpu_time([proxy_proc])
+                            throughput, transferred, latencies = harness.run_urb_load(
+                                proxy_port, args.sessions, args.urbs, size,
+                                DIRECTIONS[direction], args.depth)
+                            cpu = harness.cpu_time([proxy_proc]) - cpu
+                            ktls = request("stats", control_path)["tls_handshakes"]["ktls"]
+                            result = {
+                                "mode": mode,
+                                "direction": direction,
+                                "size": size,
+                                "mb_per_s": throughput / 1e6,
+                                "p50_ms": harness.percentile(latencies, 0.5) * 1e3,
+                                "p99_ms": harness.percentile(latencies, 0.99) * 1e3,
+                                "cpu_s_per_gb": cpu / (transferred / 1e9),
+                                "ktls_tx": ktls["tx"],
+                                "ktls_rx": ktls["rx"],
+                            }
+                            results.append(result)
+                            print(f"{mode:>10} {direction:>4} {size:>8} "
+                                  f"{result['mb_per_s']:>10.2f} {result['p50_ms']:>10.3f} "
+                                  f"{result['p99_ms']:>10.3f} {result['cpu_s_per_gb']:>10.3f} "
+                                  f"{ktls['tx']:>8} {ktls['rx']:>8}")
+                    if mode == "ktls" and not ktls["enabled"]:
+                        print(f"kTLS is not available: {ktls['unavailable']}")
+                finally:
+                    harness.stop_process(proxy_proc)
+        finally:
+            harness.stop_process(usbipd_proc)
+
+    if args.json_path:
+        with open(args.json_path, "w") as out:
+            json.dump({"sessions": args.sessions, "urbs": args.urbs, "depth": args.depth,
+                       "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Задержка URB прерываний HID-устройства, пока сессии накопителей передают URB bulk через тот же
+туннель (--tunnel и tls_proxy.tunnel_server), без --qos и с --qos у обеих сторон туннеля.
+Заглушка usbipd заменяет usbipd2
+
+python3 -m benchmarks.tls_proxy_qos --bulk-sessions 1 4
+"""
+import tempfile
+import argparse
+import json
+
+from benchmarks import harness
+
+
+MODES = {
+    "fifo": [],
+    "qos": ["--qos"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy tunnel QoS benchmark")
+    parser.add_argument('--modes', nargs='+', choices=MODES.keys(), default=list(MODES.keys()))
+    parser.add_argument('--bulk-sessions', type=int, nargs='+', default=[1, 4],
+                        dest='bulk_sessions')
+    parser.add_argument('--bulk-size', type=int, default=65536, dest='bulk_size',
+                        help='Bulk URB size')
+    parser.add_argument('--depth', type=int, default=4, help='Outstanding bulk URBs per session')
+    parser.add_argument('--hid-urbs', type=int, default=300, dest='hid_urbs',
+                        help='Interrupt URBs of HID session')
+    parser.add_argument('--period', type=float, default=0.01, dest='period_s',
+                        help='Delay between interrupt URBs in seconds')
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help='Also write results to JSON file')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        usbipd_proc, usbipd_port = harness.start_usbipd_stub(cert_path, key_path)
+        try:
+            print(f"{'mode':>6} {'bulk':>6} {'bulk MB/s':>10} {'hid p50 ms':>11} "
+                  f"{'hid p99 ms':>11} {'hid max ms':>11}")
+            for mode in args.modes:
+                tunnel_proc, tunnel_port = harness.start_tunnel_server(
+                    usbipd_port, cert_path, key_path, MODES[mode])
+                proxy_proc, proxy_port = harness.start_proxy(
+                    usbipd_port, cert_path,
+                    ["--tunnel", "--tunnel-port", str(tunnel_port), "--tunnel-cert", cert_path,
+                     "--tunnel-key", key_path, *MODES[mode]])
+                try:
+                    for bulk_sessions in args.bulk_sessions:
+                        throughput, latencies = harness.run_hid_under_bulk(
+                            proxy_port, bulk_sessions, args.bulk_size, args.depth,
+                            args.hid_urbs, args.period_s)
+                        result = {
+                            "mode": mode,
+                            "bulk_sessions": bulk_sessions,
+                            "bulk_mb_per_s": throughput / 1e6,
+                            "hid_p50_ms": harness.percentile(latencies, 0.5) * 1e3,
+                            "hid_p99_ms": harness.percentile(latencies, 0.99) * 1e3,
+                            "hid_max_ms": max(latencies) * 1e3,
+                        }
+                        results.append(result)
+                        print(f"{mode:>6} {bulk_sessions:>6} {result['bulk_mb_per_s']:>10.2f} "
+                              f"{result['hid_p50_ms']:>11.3f} {result['hid_p99_ms']:>11.3f} "
+                              f"{result['hid_max_ms']:>11.3f}")
+                finally:
+                    harness.stop_processes([proxy_proc, tunnel_proc])
+        finally:
+            harness.stop_process(usbipd_proc)
+
+    if args.json_path:
+        with open(args.json_path, "w") as out:
+            json.dump({"bulk_size": args.bulk_size, "depth": args.depth,
+                       "period_s": args.period_s, "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
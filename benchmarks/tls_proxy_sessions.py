@@ -0,0 +1,41 @@
+"""
+Суммарная пропускная способность и задержка tls_proxy в зависимости от числа одновременных сессий.
+Каждая сессия отправляет через прокси сообщения на TLS эхо-сервер и ждет ответа.
+
+python3 -m benchmarks.tls_proxy_sessions --sessions 1 10 100 1000
+"""
+import tempfile
+import argparse
+
+from benchmarks import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy concurrent sessions benchmark")
+    parser.add_argument('--engine', default="asyncio", help='tls_proxy relay engine')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--messages', type=int, default=100, help='Messages per session')
+    parser.add_argument('--size', type=int, default=512, help='Message size')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        echo_procs, echo_port = harness.start_echo_server(cert_path, key_path)
+        proxy_proc, proxy_port = harness.start_proxy(echo_port, cert_path,
+                                                     ["--engine", args.engine])
+        try:
+            print(f"{'sessions':>8} {'MB/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+            for sessions in args.sessions:
+                throughput, latencies = harness.run_load(proxy_port, sessions, args.messages,
+                                                         args.size)
+                print(f"{sessions:>8} {throughput / 1e6:>10.2f} "
+                      f"{harness.percentile(latencies, 0.5) * 1e3:>10.3f} "
+                      f"{harness.percentile(latencies, 0.99) * 1e3:>10.3f}")
+        finally:
+            harness.stop_process(proxy_proc)
+            harness.stop_processes(echo_procs)
+
+
+if __name__ == "__main__":
+    main()
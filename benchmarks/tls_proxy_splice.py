@@ -0,0 +1,56 @@
+"""
+Пропускная способность и процессорное время прокси на гигабайт при передаче больших сообщений
+для трех режимов соединения с сервером: TLS, обычный TCP с пересылкой через буферы Python
+и обычный TCP с пересылкой через splice (--plain-server)
+
+python3 -m benchmarks.tls_proxy_splice --sessions 1 8
+"""
+import tempfile
+import argparse
+
+from benchmarks import harness
+
+
+MODES = {
+    "tls": [],
+    "plain": ["--plain-server", harness.TARGET_HOST, "--no-splice"],
+    "splice": ["--plain-server", harness.TARGET_HOST],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy splice relay benchmark")
+    parser.add_argument('--modes', nargs='+', choices=MODES.keys(), default=list(MODES))
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per session')
+    parser.add_argument('--size', type=int, default=65536, help='Message size')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        tls_echo_procs, tls_echo_port = harness.start_echo_server(cert_path, key_path)
+        plain_echo_procs, plain_echo_port = harness.start_echo_server(cert_path, key_path,
+                                                                      plain=True)
+        try:
+            print(f"{'mode':>8} {'sessions':>8} {'MB/s':>10} {'cpu s/GB':>10}")
+            for mode in args.modes:
+                echo_port = tls_echo_port if mode == "tls" else plain_echo_port
+                proxy_proc, proxy_port = harness.start_proxy(echo_port, cert_path, MODES[mode])
+                try:
+                    for sessions in args.sessions:
+                        cpu = harness.cpu_time([proxy_proc])
+                        throughput, latencies = harness.run_load(proxy_port, sessions,
+                                                                 args.messages, args.size)
+                        cpu = harness.cpu_time([proxy_proc]) - cpu
+                        transferred = sessions * args.messages * args.size * 2
+                        print(f"{mode:>8} {sessions:>8} {throughput / 1e6:>10.2f} "
+                              f"{cpu / (transferred / 1e9):>10.3f}")
+                finally:
+                    harness.stop_process(proxy_proc)
+        finally:
+            harness.stop_processes(tls_echo_procs + plain_echo_procs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Сравнение обычного режима tls_proxy (отдельное TLS-соединение на сессию) с туннелем
+(--tunnel и tls_proxy.tunnel_server): число TLS-соединений между клиентом и сервером,
+процессорное время прокси и серверной стороны и задержка сообщений.
+Эхо-сервер заменяет usbipd2, в режиме туннеля tunnel_server подключается к нему локально.
+С --messages 1 время процессора в основном уходит на установку сессий
+
+python3 -m benchmarks.tls_proxy_tunnel --sessions 1 10 100
+"""
+import tempfile
+import argparse
+import os
+
+from tls_proxy import control
+from benchmarks import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy tunnel benchmark")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--messages', type=int, default=100, help='Messages per session')
+    parser.add_argument('--size', type=int, default=512, help='Message size')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        echo_procs, echo_port = harness.start_echo_server(cert_path, key_path)
+        tunnel_proc, tunnel_port = harness.start_tunnel_server(echo_port, cert_path, key_path)
+        modes = {
+            "direct": [],
+            "tunnel": ["--tunnel", "--tunnel-port", str(tunnel_port), "--tunnel-cert", cert_path,
+                       "--tunnel-key", key_path],
+        }
+        try:
+            print(f"{'mode':>8} {'sessions':>8} {'tls conns':>10} {'proxy cpu':>10} "
+                  f"{'server cpu':>10} {'MB/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+            for mode, mode_args in modes.items():
+                control_socket = os.path.join(tmp_dir, f"{mode}.sock")
+                proxy_proc, proxy_port = harness.start_proxy(
+                    echo_port, cert_path, ["--control", control_socket, *mode_args])
+                server_procs = echo_procs + ([tunnel_proc] if mode == "tunnel" else [])
+                try:
+                    for sessions in args.sessions:
+                        handshakes = control.request("stats", control_socket)["tls_handshakes"]
+                        proxy_cpu = harness.cpu_time([proxy_proc])
+                        server_cpu = harness.cpu_time(server_procs)
+                        throughput, latencies = harness.run_load(proxy_port, sessions,
+                                                                 args.messages, args.size)
+                        proxy_cpu = harness.cpu_time([proxy_proc]) - proxy_cpu
+                        server_cpu = harness.cpu_time(server_procs) - server_cpu
+                        connections = sum(
+                            control.request("stats", control_socket)["tls_handshakes"][key] -
+                            handshakes[key] for key in ("full", "resumed"))
+                        print(f"{mode:>8} {sessions:>8} {connections:>10} "
+                              f"{proxy_cpu:>9.2f}s {server_cpu:>9.2f}s "
+                              f"{throughput / 1e6:>10.2f} "
+                              f"{harness.percentile(latencies, 0.5) * 1e3:>10.3f} "
+                              f"{harness.percentile(latencies, 0.99) * 1e3:>10.3f}")
+                finally:
+                    harness.stop_process(proxy_proc)
+        finally:
+            harness.stop_process(tunnel_proc)
+            harness.stop_processes(echo_procs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Пропускная способность, задержка URB и процессорное время прокси на гигабайт данных URB
+с заглушкой usbipd вместо сервера: сессии через прокси импортируют устройство заглушки
+и передают URB bulk. Перебираются все сочетания движков, размеров буферов прокси, числа
+сессий и размеров URB, чтобы сравнивать их и версии прокси на одной машине
+
+python3 -m benchmarks.tls_proxy_usbip --engines asyncio socketserver --sizes 512 65536
+"""
+import tempfile
+import argparse
+import json
+
+from tls_proxy.config import RELAY_BUFFER_SIZE
+from tls_proxy.protocol import USBIP_DIR_IN, USBIP_DIR_OUT
+from tls_proxy.__main__ import ENGINES
+from benchmarks import harness
+
+
+DIRECTIONS = {"in": USBIP_DIR_IN, "out": USBIP_DIR_OUT}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy benchmark with usbipd stub")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES.keys(), default=["asyncio"])
+    parser.add_argument('--buffer-sizes', type=int, nargs='+', default=[RELAY_BUFFER_SIZE],
+                        dest='buffer_sizes', help='Proxy relay buffer sizes')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 16384, 65536],
+                        help='URB transfer sizes')
+    parser.add_argument('--urbs', type=int, default=1000, help='URBs per session')
+    parser.add_argument('--depth', type=int, default=1, help='Outstanding URBs per session')
+    parser.add_argument('--direction', choices=DIRECTIONS.keys(), default="in")
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help='Also write results to JSON file')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        usbipd_proc, usbipd_port = harness.start_usbipd_stub(cert_path, key_path)
+        try:
+            print(f"{'engine':>12} {'buffer':>8} {'sessions':>8} {'size':>8} {'MB/s':>10} "
+                  f"{'p50 ms':>10} {'p99 ms':>10} {'cpu s/GB':>10}")
+            for engine in args.engines:
+                for buffer_size in args.buffer_sizes:
+                    proxy_proc, proxy_port = harness.start_proxy(
+                        usbipd_port, cert_path,
+                        ["--engine", engine, "--buffer-size", str(buffer_size)])
+                    try:
+                        for sessions in args.sessions:
+                            for size in args.sizes:
+                                cpu = harness.cpu_time([proxy_proc])
+                                throughput, transferred, latencies = harness.run_urb_load(
+                                    proxy_port, sessions, args.urbs, size,
+                                    DIRECTIONS[args.direction], args.depth)
+                                cpu = harness.cpu_time([proxy_proc]) - cpu
+                                result = {
+                                    "engine": engine,
+                                    "buffer_size": buffer_size,
+                                    "sessions": sessions,
+                                    "size": size,
+                                    "mb_per_s": throughput / 1e6,
+                                    "p50_ms": harness.percentile(latencies, 0.5) * 1e3,
+                                    "p99_ms": harness.percentile(latencies, 0.99) * 1e3,
+                                    "cpu_s_per_gb": cpu / (transferred / 1e9),
+                                }
+                                results.append(result)
+                                print(f"{engine:>12} {buffer_size:>8} {sessions:>8} {size:>8} "
+                                      f"{result['mb_per_s']:>10.2f} {result['p50_ms']:>10.3f} "
+                                      f"{result['p99_ms']:>10.3f} "
+                                      f"{result['cpu_s_per_gb']:>10.3f}")
+                    finally:
+                        harness.stop_process(proxy_proc)
+        finally:
+            harness.stop_process(usbipd_proc)
+
+    if args.json_path:
+        with open(args.json_path, "w") as out:
+            json.dump({"direction": args.direction, "urbs": args.urbs, "depth": args.depth,
+                       "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Передача URB через глобальную сеть, эмулированную прокси (--impair): пропускная способность
+и задержка URB при разных RTT и потерях с заглушкой usbipd. RTT делится поровну между
+направлениями, потеря задерживает запись на время повторной передачи
+
+python3 -m benchmarks.tls_proxy_wan --rtts 0 20 80 200 --losses 0 0.01
+"""
+import tempfile
+import argparse
+import json
+
+from tls_proxy.protocol import USBIP_DIR_IN, USBIP_DIR_OUT
+from benchmarks import harness
+
+
+DIRECTIONS = {"in": USBIP_DIR_IN, "out": USBIP_DIR_OUT}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tls_proxy emulated WAN benchmark")
+    parser.add_argument('--rtts', type=float, nargs='+', default=[0, 20, 80, 200],
+                        help='Round trip times in milliseconds')
+    parser.add_argument('--losses', type=float, nargs='+', default=[0, 0.01],
+                        help='Probabilities of a lost write')
+    parser.add_argument('--jitter', type=float, default=0., help='Jitter in milliseconds')
+    parser.add_argument('--rate', type=float, default=0.,
+                        help='Link bandwidth in bytes per second, 0 - unlimited')
+    parser.add_argument('--directions', nargs='+', choices=DIRECTIONS.keys(),
+                        default=list(DIRECTIONS))
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--size', type=int, default=65536, help='URB transfer size')
+    parser.add_argument('--urbs', type=int, default=100, help='URBs per session')
+    parser.add_argument('--depth', type=int, default=8, help='Outstanding URBs per session')
+    parser.add_argument('--json', default=None, dest='json_path',
+                        help='Also write results to JSON file')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        usbipd_proc, usbipd_port = harness.start_usbipd_stub(cert_path, key_path)
+        try:
+            print(f"{'rtt ms':>8} {'loss':>6} {'dir':>4} {'MB/s':>10} {'p50 ms':>10} "
+                  f"{'p99 ms':>10} {'max ms':>10}")
+            for rtt in args.rtts:
+                for loss in args.losses:
+                    proxy_proc, proxy_port = harness.start_proxy(
+                        usbipd_port, cert_path,
+                        ["--impair", "--impair-delay", str(rtt / 2), "--impair-jitter",
+                         str(args.jitter), "--impair-rate", str(args.rate), "--impair-loss",
+                         str(loss), "--impair-seed", "0"])
+                    try:
+                        for direction in args.directions:
+                            throughput, _, latencies = harness.run_urb_load(
+                                proxy_port, args.sessions, args.urbs, args.size,
+                                DIRECTIONS[direction], args.depth)
+                            result = {
+                                "rtt_ms": rtt,
+                                "loss": loss,
+                                "direction": direction,
+                                "mb_per_s": throughput / 1e6,
+                                "p50_ms": harness.percentile(latencies, 0.5) * 1e3,
+                                "p99_ms": harness.percentile(latencies, 0.99) * 1e3,
+                                "max_ms": max(latencies) * 1e3,
+                            }
+                            results.append(result)
+                            print(f"{rtt:>8g} {loss:>6g} {direction:>4} "
+                                  f"{result['mb_per_s']:>10.2f} {result['p50_ms']:>10.1f} "
+                                  f"{result['p99_ms']:>10.1f} {result['max_ms']:>10.1f}")
+                    finally:
+                        harness.stop_process(proxy_proc)
+        finally:
+            harness.stop_process(usbipd_proc)
+
+    if args.json_path:
+        with open(args.json_path, "w") as out:
+            json.dump({"sessions": args.sessions, "size": args.size, "urbs": args.urbs,
+                       "depth": args.depth, "jitter_ms": args.jitter, "rate": args.rate,
+                       "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
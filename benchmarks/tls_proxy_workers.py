@@ -0,0 +1,54 @@
+"""
+Масштабирование пропускной способности tls_proxy с числом процессов (--workers).
+Нагрузку создают несколько клиентских процессов, эхо-сервер тоже работает в нескольких процессах,
+чтобы узким местом был прокси. Имеет смысл на машине с несколькими ядрами.
+
+python3 -m benchmarks.tls_proxy_workers --workers 1 2 4
+"""
+import tempfile
+import argparse
+import os
+
+from benchmarks import harness
+
+
+def main():
+    cpus = len(os.sched_getaffinity(0))
+    parser = argparse.ArgumentParser(description="tls_proxy worker processes benchmark")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--cpu-affinity', action='store_true', dest='cpu_affinity')
+    parser.add_argument('--sessions', type=int, default=64)
+    parser.add_argument('--messages', type=int, default=200, help='Messages per session')
+    parser.add_argument('--size', type=int, default=16384, help='Message size')
+    parser.add_argument('--load-processes', type=int, default=cpus, dest='load_processes',
+                        help='Client and echo server processes')
+    args = parser.parse_args()
+
+    harness.raise_nofile_limit()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert_path, key_path = harness.make_self_signed_cert(tmp_dir)
+        echo_procs, echo_port = harness.start_echo_server(cert_path, key_path,
+                                                          args.load_processes)
+        try:
+            print(f"cpus: {cpus}")
+            print(f"{'workers':>8} {'MB/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+            for workers in args.workers:
+                proxy_args = ["--workers", str(workers)]
+                if args.cpu_affinity:
+                    proxy_args.append("--cpu-affinity")
+                proxy_proc, proxy_port = harness.start_proxy(echo_port, cert_path, proxy_args)
+                try:
+                    throughput, latencies = harness.run_load(
+                        proxy_port, args.sessions, args.messages, args.size,
+                        args.load_processes)
+                finally:
+                    harness.stop_process(proxy_proc)
+                print(f"{workers:>8} {throughput / 1e6:>10.2f} "
+                      f"{harness.percentile(latencies, 0.5) * 1e3:>10.3f} "
+                      f"{harness.percentile(latencies, 0.99) * 1e3:>10.3f}")
+        finally:
+            harness.stop_processes(echo_procs)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,4 +20,6 @@ def build_prog(prog_name, main_file, version: str, gui: bool = False):
 
 if __name__ == "__main__":
     build_prog("autoredir", "./autoredir/__main__.py", "0.1")
+    build_prog("tls_proxy", "./tls_proxy/__main__.py", "0.2")
+    build_prog("tls_tunnel", "./tls_proxy/tunnel_server.py", "0.1")
     build_prog(gui_app.NAME, "./usbip_gui/__main__.py", gui_app.VERSION, True)
@@ -0,0 +1,134 @@
+"""
+Очередь сессий сверх ограничения: место освободившейся сессии передается ожидающей, ожидание
+по таймауту или отмене откатывает счетчики, ограничение сессий одного клиента учитывает
+ожидающие сессии. Ограничение частоты подключений к серверу
+
+python3 -m unittest tests.test_admission
+"""
+from unittest import mock
+import unittest
+import asyncio
+
+from tls_proxy import admission
+from tls_proxy.admission import Admission, AdmissionRejected, RateLimiter
+
+
+QUEUE_TIMEOUT_S = 0.05
+
+
+class AdmissionTest(unittest.IsolatedAsyncioTestCase):
+    async def test_queue_handoff(self):
+        limits = Admission(1, 0, 2, 5.)
+        await limits.admit("a")
+        waiting = [asyncio.ensure_future(limits.admit(client)) for client in ("b", "c")]
+        await asyncio.sleep(0)
+        self.assertEqual(limits.to_dict()["queue"], 2)
+
+        limits.release("a")
+        await waiting[0]
+        self.assertFalse(waiting[1].done())
+        self.assertEqual((limits.active, limits.clients), (1, {"b": 1, "c": 1}))
+        limits.release("b")
+        await waiting[1]
+        limits.release("c")
+        self.assertEqual((limits.active, limits.clients), (0, {}))
+        self.assertEqual((limits.admitted, limits.queued), (3, 2))
+
+    async def test_queue_full(self):
+        limits = Admission(1, 0, 1, 5.)
+        await limits.admit("a")
+        waiting = asyncio.ensure_future(limits.admit("b"))
+        await asyncio.sleep(0)
+        with self.assertRaises(AdmissionRejected):
+            await limits.admit("c")
+        self.assertEqual(limits.rejected_queue_full, 1)
+        self.assertNotIn("c", limits.clients)
+        limits.release("a")
+        await waiting
+        self.assertEqual(limits.active, 1)
+
+    async def test_timeout_rollback(self):
+        limits = Admission(1, 0, 1, QUEUE_TIMEOUT_S)
+        await limits.admit("a")
+        with self.assertRaises(AdmissionRejected):
+            await limits.admit("b")
+        self.assertEqual(limits.rejected_timeout, 1)
+        self.assertEqual((limits.active, limits.clients, limits.to_dict()["queue"]),
+                         (1, {"a": 1}, 0))
+        limits.release("a")
+        self.assertEqual((limits.active, limits.clients), (0, {}))
+
+    async def test_cancel_waiting(self):
+        limits = Admission(1, 0, 1, 5.)
+        await limits.admit("a")
+        waiting = asyncio.ensure_future(limits.admit("b"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        limits.release("a")
+        self.assertEqual((limits.active, limits.clients), (0, {}))
+
+    async def test_cancel_after_handoff(self):
+        """
+        Сессия отменена, когда место ей уже передано: место не теряется. asyncio.wait_for
+        до Python 3.12 может вернуть результат вместо отмены, тогда сессия допущена
+        """
+        limits = Admission(1, 0, 2, 5.)
+        await limits.admit("a")
+        cancelled = asyncio.ensure_future(limits.admit("b"))
+        waiting = asyncio.ensure_future(limits.admit("c"))
+        await asyncio.sleep(0)
+        limits.release("a")
+        cancelled.cancel()
+        result, = await asyncio.gather(cancelled, return_exceptions=True)
+        if result is None:
+            self.assertFalse(waiting.done())
+            limits.release("b")
+        else:
+            self.assertIsInstance(result, asyncio.CancelledError)
+        await waiting
+        self.assertEqual((limits.active, limits.clients), (1, {"c": 1}))
+        limits.release("c")
+        self.assertEqual((limits.active, limits.clients), (0, {}))
+
+    async def test_client_limit(self):
+        limits = Admission(1, 2, 2, 5.)
+        await limits.admit("a")
+        # Сессия в очереди тоже считается сессией клиента
+        waiting = asyncio.ensure_future(limits.admit("a"))
+        await asyncio.sleep(0)
+        with self.assertRaises(AdmissionRejected):
+            await limits.admit("a")
+        self.assertEqual(limits.rejected_client_limit, 1)
+        other = asyncio.ensure_future(limits.admit("b"))
+        await asyncio.sleep(0)
+        self.assertEqual(limits.clients, {"a": 2, "b": 1})
+        limits.release("a")
+        await waiting
+        limits.release("a")
+        await other
+        self.assertEqual(limits.clients, {"b": 1})
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.
+        patcher = mock.patch.object(admission.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_and_rate(self):
+        limiter = RateLimiter(10., 2)
+        self.assertEqual([limiter.reserve(1.), limiter.reserve(1.)], [0., 0.])
+        self.assertAlmostEqual(limiter.reserve(1.), 0.1)
+        with self.assertRaises(AdmissionRejected):
+            limiter.reserve(0.15)
+        self.assertEqual((limiter.delayed, limiter.rejected), (1, 1))
+        self.now += 1.
+        self.assertEqual(limiter.reserve(0.), 0.)
+        self.assertLessEqual(limiter.tokens, 1.)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Кольцо захвата: после переноса записей в начало кольца и вытеснения старых записей read_ring
+возвращает последние записи по порядку, захват сессии обрезает данные PDU до snaplen,
+экспорт в JSONL и pcap сохраняет записи и их полные размеры
+
+python3 -m unittest tests.test_capture
+"""
+import tempfile
+import unittest
+import random
+import struct
+import json
+import io
+import os
+
+from tls_proxy.protocol import OP_COMMON, OP_REQ_IMPORT, USBIP_CMD_SUBMIT, USBIP_DIR_OUT, \
+    USBIP_HEADER, UsbipStreamParser
+from tls_proxy.capture import Capture, CaptureRecord, CaptureRing, RECORD, TO_CLIENT, \
+    TO_SERVER, export_jsonl, export_pcap, read_ring
+from tls_proxy.config import USBIP_SERVER_PORT
+
+
+RING_SIZE = 4096
+WRITES = 2000
+SNAPLEN = 16
+
+
+def _records() -> list:
+    return [
+        CaptureRecord(1_000_000_123_456_789, 1, TO_SERVER, 48 + 512, b"\x01" * 48 + b"\x02" * 16),
+        CaptureRecord(1_000_000_123_556_789, 1, TO_CLIENT, 48, b"\x03" * 48),
+        CaptureRecord(1_000_000_124_000_000, 7, TO_SERVER, 48, b"\x04" * 48),
+        CaptureRecord(1_000_000_125_000_000, 1, TO_SERVER, 100000, b"\x05" * 64),
+    ]
+
+
+class CaptureRingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.ring_path = os.path.join(self.tmp_dir.name, "ring.cap")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_wrap_and_overwrite(self):
+        rng = random.Random(0)
+        ring = CaptureRing(self.ring_path, RING_SIZE)
+        written = []
+        wrapped = False
+        for number in range(WRITES):
+            data = bytes([number & 0xff]) * rng.choice([0, 1, 40, 100, 300, 1000])
+            head = ring.head
+            ring.write(number % 5, number & 1, data, len(data) + number)
+            written.append((number % 5, number & 1, len(data) + number, data))
+            wrapped = wrapped or ring.head < head
+            self.assertEqual(ring.records + ring.overwritten, ring.written)
+            if number % 97 == 0:
+                records = [(record.session, record.direction, record.length, record.data)
+                           for record in read_ring(self.ring_path)]
+                self.assertEqual(records, written[len(written) - ring.records:])
+                self.assertLessEqual(sum(RECORD.size + len(record[3]) for record in records),
+                                     RING_SIZE)
+        self.assertTrue(wrapped)
+        self.assertGreater(ring.overwritten, WRITES // 2)
+        ring.close()
+
+    def test_record_larger_than_ring_is_dropped(self):
+        ring = CaptureRing(self.ring_path, RING_SIZE)
+        ring.write(1, TO_SERVER, b"\x01" * 100, 100)
+        ring.write(1, TO_SERVER, bytes(RING_SIZE), RING_SIZE)
+        ring.close()
+        self.assertEqual([record.data for record in read_ring(self.ring_path)], [b"\x01" * 100])
+
+    def test_not_a_capture_file(self):
+        with open(self.ring_path, "wb") as ring_file:
+            ring_file.write(bytes(1024))
+        with self.assertRaises(ValueError):
+            list(read_ring(self.ring_path))
+
+    def test_session_snaplen(self):
+        capture = Capture()
+        parser = UsbipStreamParser()
+        capture.attach(3, parser)
+        capture.start(self.ring_path, RING_SIZE, SNAPLEN)
+        header = USBIP_HEADER.pack(USBIP_CMD_SUBMIT, 1, 0, USBIP_DIR_OUT, 1, 0, 1000, 0, 0, 0)
+        parser.feed_to_server(memoryview(
+            OP_COMMON.pack(0x0111, OP_REQ_IMPORT, 0) + b"1-1".ljust(32, b"\0") +
+            header + bytes(range(256)) * 4))
+        capture.stop()
+        record = list(read_ring(self.ring_path))[-1]
+        self.assertEqual((record.session, record.direction, record.length),
+                         (3, TO_SERVER, USBIP_HEADER.size + 1000))
+        self.assertEqual(record.data, header + bytes(range(SNAPLEN)))
+
+
+class ExportTest(unittest.TestCase):
+    def test_jsonl(self):
+        out = io.BytesIO()
+        export_jsonl(iter(_records()), out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(lines), len(_records()))
+        for line, record in zip(lines, _records()):
+            self.assertAlmostEqual(line["ts"], record.timestamp_ns / 1e9, places=6)
+            self.assertEqual(line["session"], record.session)
+            self.assertEqual(line["direction"],
+                             "to_server" if record.direction == TO_SERVER else "to_client")
+            self.assertEqual(line["length"], record.length)
+            self.assertEqual(bytes.fromhex(line["data"]), record.data)
+
+    def test_pcap(self):
+        out = io.BytesIO()
+        export_pcap(iter(_records()), out)
+        data = out.getvalue()
+        self.assertEqual(struct.unpack_from("<IHHiIII", data, 0)[0], 0xa1b2c3d4)
+        position = 24
+        # (сессия, направление) -> следующий номер последовательности TCP
+        sequences = {}
+        for record in _records():
+            seconds, microseconds, captured, length = struct.unpack_from("<IIII", data, position)
+            position += 16
+            self.assertEqual(seconds * 1000000 + microseconds, record.timestamp_ns // 1000)
+            self.assertEqual(captured, 40 + len(record.data))
+            self.assertEqual(length, 40 + record.length)
+            total_length = struct.unpack_from(">H", data, position + 2)[0]
+            self.assertEqual(total_length, 40 + record.length if record.length < 65496 else 0)
+            src_port, dst_port, seq, ack = struct.unpack_from(">HHII", data, position + 20)
+            client_port = 1024 + record.session
+            to_server = record.direction == TO_SERVER
+            self.assertEqual((src_port, dst_port),
+                             (client_port, USBIP_SERVER_PORT) if to_server else
+                             (USBIP_SERVER_PORT, client_port))
+            # Номера последовательности растут на полный размер PDU, а не на сохраненные байты
+            self.assertEqual(seq, sequences.get((record.session, record.direction), 1))
+            self.assertEqual(ack, sequences.get((record.session, 1 - record.direction), 1))
+            sequences[(record.session, record.direction)] = seq + record.length
+            self.assertEqual(data[position + 40:position + captured], record.data)
+            position += captured
+        self.assertEqual(position, len(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+"""
+Профиль auto не ограничивает соединения TLS 1.2 без явного разрешения
+
+python3 -m unittest tests.test_ciphers
+"""
+from unittest import mock
+import unittest
+
+from tls_proxy import ciphers
+
+
+RATES = {"aes-gcm": 1e8, "chacha20": 3e8}
+
+
+class SelectProfileTest(unittest.TestCase):
+    @mock.patch.object(ciphers, "measure_ciphers", return_value=RATES)
+    def test_chacha20_requires_opt_in(self, _):
+        self.assertEqual(ciphers.select_profile(), ("default", RATES, None))
+        self.assertEqual(ciphers.select_profile(allow_tls12=True), ("chacha20", RATES, None))
+
+    @mock.patch.object(ciphers, "measure_ciphers", return_value={"aes-gcm": 3e8,
+                                                                 "chacha20": 1e8})
+    def test_aes_gcm_keeps_tls13(self, _):
+        self.assertEqual(ciphers.select_profile()[0], "aes-gcm")
+
+
+if __name__ == "__main__":
+    unittest.main()
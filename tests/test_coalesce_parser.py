@@ -0,0 +1,45 @@
+"""
+Объединение записей к серверу на долгой сессии: CoalescingWriter видит только направление
+к серверу и не должен запоминать URB
+
+python3 -m unittest tests.test_coalesce_parser
+"""
+import unittest
+
+from tls_proxy.protocol import OP_COMMON, OP_REQ_IMPORT, USBIP_CMD_SUBMIT, USBIP_DIR_OUT, \
+    USBIP_HEADER
+from tls_proxy.coalesce import CoalesceStats, CoalescingWriter
+
+
+URBS = 10000
+SIZE = 64
+IMPORT = OP_COMMON.pack(0x0111, OP_REQ_IMPORT, 0) + b"1-1".ljust(32, b"\0")
+
+
+class _Sink:
+    def __init__(self):
+        self.data = bytearray()
+
+    async def sendall(self, data: bytes):
+        self.data += data
+
+
+class CoalescingWriterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_submits_are_not_stored(self):
+        sink = _Sink()
+        writer = CoalescingWriter(sink, 65536, 0., CoalesceStats())
+        sent = bytearray(IMPORT)
+        await writer.sendall(memoryview(IMPORT))
+        for seqnum in range(1, URBS + 1):
+            pdu = USBIP_HEADER.pack(USBIP_CMD_SUBMIT, seqnum, 0, USBIP_DIR_OUT, 1, 0, SIZE, 0,
+                                    0, 0) + bytes(SIZE)
+            sent += pdu
+            await writer.sendall(memoryview(pdu))
+        await writer.flush()
+        writer.close()
+        self.assertEqual(sink.data, sent)
+        self.assertEqual(writer.parser.outstanding, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
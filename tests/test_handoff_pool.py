@@ -0,0 +1,98 @@
+"""
+После передачи слушающего сокета новому процессу (--handoff) старый процесс закрывает готовые
+соединения пула с серверами и только дожидается конца своих сессий
+
+python3 -m unittest tests.test_handoff_pool
+"""
+import tempfile
+import unittest
+import socket
+import signal
+import time
+import os
+
+from benchmarks import harness
+
+
+POOL_SIZE = 3
+
+
+def _upstream_connections(pid: int, upstream_port: int) -> int:
+    """
+    Число TCP-соединений процесса с портом upstream_port
+    """
+    fd_dir = f"/proc/{pid}/fd"
+    inodes = set()
+    for fd in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except FileNotFoundError:
+            continue
+        if target.startswith("socket:["):
+            inodes.add(target[len("socket:["):-1])
+    count = 0
+    with open("/proc/net/tcp") as tcp:
+        for line in tcp.readlines()[1:]:
+            fields = line.split()
+            if fields[9] in inodes and int(fields[2].split(":")[1], 16) == upstream_port:
+                count += 1
+    return count
+
+
+class HandoffPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        cert_path, key_path = harness.make_self_signed_cert(self.tmp_dir.name)
+        self.usbipd_proc, self.usbipd_port = harness.start_usbipd_stub(cert_path, key_path)
+        servers_file = os.path.join(self.tmp_dir.name, "settings.ini")
+        with open(servers_file, "w") as servers:
+            servers.write('[main]\nservers = ["stub"]\n[stub]\naddress = localhost\n')
+        self.handoff_socket = os.path.join(self.tmp_dir.name, "handoff.sock")
+        self.proxy_proc, self.proxy_port = harness.start_proxy(
+            self.usbipd_port, cert_path,
+            ["--pool-size", str(POOL_SIZE), "--servers-file", servers_file,
+             "--handoff", self.handoff_socket])
+        self.successor_pid = None
+
+    def tearDown(self):
+        if self.successor_pid is not None:
+            try:
+                os.kill(self.successor_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        harness.stop_processes([self.proxy_proc, self.usbipd_proc])
+        self.tmp_dir.cleanup()
+
+    def wait_connections(self, count: int) -> int:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            connections = _upstream_connections(self.proxy_proc.pid, self.usbipd_port)
+            if connections == count:
+                break
+            time.sleep(0.1)
+        return connections
+
+    def wait_successor(self) -> int:
+        children_path = f"/proc/{self.proxy_proc.pid}/task/{self.proxy_proc.pid}/children"
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with open(children_path) as children_file:
+                children = children_file.read().split()
+            if children:
+                return int(children[0])
+            time.sleep(0.1)
+        self.fail("Successor process was not started")
+
+    def test_pool_closed_after_handoff(self):
+        self.assertEqual(self.wait_connections(POOL_SIZE), POOL_SIZE)
+        # Сессия без данных держит старый процесс после передачи сокета
+        with socket.create_connection(("localhost", self.proxy_port)):
+            os.kill(self.proxy_proc.pid, signal.SIGHUP)
+            self.successor_pid = self.wait_successor()
+            self.assertEqual(self.wait_connections(0), 0)
+            self.assertIsNone(self.proxy_proc.poll())
+        self.assertEqual(self.proxy_proc.wait(5), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
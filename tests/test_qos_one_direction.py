@@ -0,0 +1,38 @@
+"""
+Классы URB на клиентской стороне туннеля, где разбирается только направление к серверу
+
+python3 -m unittest tests.test_qos_one_direction
+"""
+import unittest
+
+from tls_proxy.protocol import OP_COMMON, OP_REQ_IMPORT, USBIP_CMD_SUBMIT, USBIP_CMD_UNLINK, \
+    USBIP_DIR_IN, USBIP_HEADER
+from tls_proxy.qos import QOS_BULK, QOS_INTERRUPT, SessionQos
+
+
+URBS = 10000
+IMPORT = OP_COMMON.pack(0x0111, OP_REQ_IMPORT, 0) + b"1-1".ljust(32, b"\0")
+
+
+def submit(seqnum: int, interval: int) -> bytes:
+    return USBIP_HEADER.pack(USBIP_CMD_SUBMIT, seqnum, 0, USBIP_DIR_IN, 1, 0, 512, 0, 0,
+                             interval)
+
+
+class OneDirectionQosTest(unittest.TestCase):
+    def test_submits_are_not_stored(self):
+        qos = SessionQos(track_urbs=False)
+        qos.to_server(memoryview(IMPORT))
+        classes = set()
+        for seqnum in range(1, URBS + 1):
+            segments = qos.to_server(memoryview(submit(seqnum, seqnum % 2)))
+            classes.update(qos_class for qos_class, _ in segments)
+        qos.to_server(memoryview(USBIP_HEADER.pack(USBIP_CMD_UNLINK, URBS + 1, 0, 0, 0, 1, 0,
+                                                   0, 0, 0)))
+        self.assertEqual(classes, {QOS_BULK, QOS_INTERRUPT})
+        self.assertEqual(qos.parser.outstanding, 0)
+        self.assertFalse(qos.parser._unlinks)
+
+
+if __name__ == "__main__":
+    unittest.main()
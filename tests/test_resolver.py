@@ -0,0 +1,168 @@
+"""
+Кэш разрешения имен (TTL ответов и ошибок, объединение одновременных запросов) и параллельное
+подключение к адресам сервера connect_any
+
+python3 -m unittest tests.test_resolver
+"""
+from unittest import mock
+import unittest
+import asyncio
+import socket
+import time
+
+from tls_proxy import resolver
+from tls_proxy.resolver import ConnectRaceStats, Resolver, connect_any, interleave_families
+
+
+TTL_S = 10.
+NEGATIVE_TTL_S = 2.
+STAGGER_S = 0.2
+
+
+def _info(family: int, host: str, port: int) -> tuple:
+    return family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (host, port)
+
+
+class _Loop:
+    """
+    Цикл событий, getaddrinfo которого отвечает заданными адресами или ошибкой
+    """
+    def __init__(self, result):
+        self.loop = asyncio.get_running_loop()
+        self.result = result
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    def create_task(self, coro):
+        return self.loop.create_task(coro)
+
+    async def getaddrinfo(self, host: str, port: int, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class ResolverTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.now = 1000.
+        patcher = mock.patch.object(resolver.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_ttl(self):
+        infos = [_info(socket.AF_INET, "192.0.2.1", 3240)]
+        loop = _Loop(infos)
+        cache = Resolver(TTL_S, NEGATIVE_TTL_S)
+        self.assertEqual(await cache.resolve(loop, "server", 3240), infos)
+        self.now += TTL_S - 1
+        self.assertEqual(await cache.resolve(loop, "server", 3240), infos)
+        self.assertEqual(loop.calls, 1)
+        self.now += 2
+        self.assertEqual(await cache.resolve(loop, "server", 3240), infos)
+        self.assertEqual(loop.calls, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    async def test_no_cache(self):
+        loop = _Loop([_info(socket.AF_INET, "192.0.2.1", 3240)])
+        cache = Resolver()
+        await cache.resolve(loop, "server", 3240)
+        await cache.resolve(loop, "server", 3240)
+        self.assertEqual(loop.calls, 2)
+        self.assertEqual(cache.to_dict()["cached"], 0)
+
+    async def test_negative_ttl(self):
+        loop = _Loop(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+        cache = Resolver(TTL_S, NEGATIVE_TTL_S)
+        for _ in range(3):
+            with self.assertRaises(socket.gaierror) as raised:
+                await cache.resolve(loop, "missing", 3240)
+            self.assertEqual(raised.exception.errno, socket.EAI_NONAME)
+        self.assertEqual(loop.calls, 1)
+        self.now += NEGATIVE_TTL_S + 1
+        with self.assertRaises(socket.gaierror):
+            await cache.resolve(loop, "missing", 3240)
+        self.assertEqual(loop.calls, 2)
+        self.assertEqual((cache.negative_hits, cache.failures), (2, 2))
+
+    async def test_coalescing(self):
+        infos = [_info(socket.AF_INET, "192.0.2.1", 3240)]
+        loop = _Loop(infos)
+        loop.release.clear()
+        cache = Resolver()
+        lookups = [asyncio.ensure_future(cache.resolve(loop, "server", 3240)) for _ in range(5)]
+        await asyncio.sleep(0)
+        # Отмена одного ожидающего не отменяет общий запрос
+        lookups[0].cancel()
+        loop.release.set()
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+        self.assertIsInstance(results[0], asyncio.CancelledError)
+        self.assertEqual(results[1:], [infos] * 4)
+        self.assertEqual(loop.calls, 1)
+        self.assertEqual((cache.misses, cache.coalesced), (1, 4))
+        self.assertEqual(cache.to_dict()["hit_ratio"], 0.)
+
+
+class ConnectAnyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.addCleanup(self.server.close)
+        # Порт, на котором никто не слушает
+        with socket.create_server(("127.0.0.1", 0)) as closed:
+            self.closed_port = closed.getsockname()[1]
+
+    def test_interleave_families(self):
+        v4 = [_info(socket.AF_INET, f"192.0.2.{i}", 1) for i in range(3)]
+        v6 = [_info(socket.AF_INET6, f"2001:db8::{i}", 1) for i in range(2)]
+        self.assertEqual(interleave_families(v6 + v4), [v6[0], v4[0], v6[1], v4[1], v4[2]])
+
+    async def test_refused_address_does_not_wait_stagger(self):
+        stats = ConnectRaceStats()
+        start = time.monotonic()
+        sock = await connect_any(asyncio.get_running_loop(), "server",
+                                 [_info(socket.AF_INET, "127.0.0.1", self.closed_port),
+                                  _info(socket.AF_INET, "127.0.0.1", self.port)],
+                                 5., stats)
+        sock.close()
+        self.assertLess(time.monotonic() - start, 1.)
+        self.assertEqual((stats.attempts, stats.attempt_errors, stats.fallback_wins), (2, 1, 1))
+
+    async def test_slow_address_loses_race(self):
+        connect_one = resolver._connect_one
+        slow_attempts = []
+
+        async def connect(loop, info):
+            if info[4][1] == self.closed_port:
+                slow_attempts.append(asyncio.current_task())
+                await asyncio.sleep(60)
+            return await connect_one(loop, info)
+
+        stats = ConnectRaceStats()
+        with mock.patch.object(resolver, "_connect_one", connect):
+            start = time.monotonic()
+            sock = await connect_any(asyncio.get_running_loop(), "server",
+                                     [_info(socket.AF_INET6, "::1", self.closed_port),
+                                      _info(socket.AF_INET, "127.0.0.1", self.port)],
+                                     STAGGER_S, stats)
+        sock.close()
+        self.assertGreaterEqual(time.monotonic() - start, STAGGER_S)
+        self.assertTrue(slow_attempts[0].cancelled())
+        self.assertEqual(stats.wins, {"ipv4": 1})
+        self.assertEqual((stats.attempts, stats.fallback_wins, stats.failed), (2, 1, 0))
+
+    async def test_all_failed(self):
+        stats = ConnectRaceStats()
+        with self.assertRaises(ConnectionRefusedError):
+            await connect_any(asyncio.get_running_loop(), "server",
+                              [_info(socket.AF_INET, "127.0.0.1", self.closed_port)] * 2,
+                              STAGGER_S, stats)
+        self.assertEqual((stats.attempts, stats.attempt_errors, stats.failed), (2, 2, 1))
+        with self.assertRaises(OSError):
+            await connect_any(asyncio.get_running_loop(), "server", [], STAGGER_S)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Token bucket ограничения скорости: отправка в пределах burst без задержки, долг задерживает
+следующую отправку, изменение ограничений действует на идущие сессии, ограничение сервера
+общее для его сессий
+
+python3 -m unittest tests.test_shaping
+"""
+from unittest import mock
+import unittest
+import math
+
+from tls_proxy import shaping
+from tls_proxy.shaping import RATE_WINDOW_S, Shaping, TokenBucket
+
+
+RATE = 1000.
+BURST = 500
+
+
+class _Clock:
+    def setUp(self):
+        self.now = 1000.
+        patcher = mock.patch.object(shaping.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(_Clock, unittest.TestCase):
+    def test_burst_and_debt(self):
+        bucket = TokenBucket(RATE, BURST)
+        self.assertEqual(bucket.consume(BURST), 0.)
+        self.assertAlmostEqual(bucket.consume(250), 0.25)
+        self.assertTrue(bucket.to_dict()["throttling"])
+        self.now += 0.25
+        self.assertAlmostEqual(bucket.consume(100), 0.1)
+        self.assertAlmostEqual(bucket.throttled_s, 0.35)
+        # Токены накапливаются не больше burst
+        self.now += 10.
+        self.assertEqual(bucket.consume(BURST), 0.)
+        self.assertAlmostEqual(bucket.consume(1), 0.001)
+        self.assertEqual(bucket.bytes, 2 * BURST + 351)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(0., BURST)
+        self.assertEqual(bucket.consume(10 * BURST), 0.)
+        self.assertEqual((bucket.bytes, bucket.throttled_s), (10 * BURST, 0.))
+
+    def test_set_rate(self):
+        bucket = TokenBucket(0., BURST)
+        bucket.consume(10 * BURST)
+        # Ограничение с нуля начинается с полного burst
+        bucket.set_rate(RATE, BURST)
+        self.assertEqual(bucket.consume(BURST), 0.)
+        self.assertAlmostEqual(bucket.consume(100), 0.1)
+        self.now += 1.
+        bucket.set_rate(RATE, 200)
+        self.assertEqual(bucket.tokens, 200.)
+
+    def test_current_rate(self):
+        bucket = TokenBucket(0., BURST)
+        bucket.consume(1000)
+        self.assertAlmostEqual(bucket.current_rate, 1000 / RATE_WINDOW_S)
+        self.now += RATE_WINDOW_S
+        self.assertAlmostEqual(bucket.current_rate, 1000 / RATE_WINDOW_S / math.e)
+
+
+class ShapingTest(_Clock, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        _Clock.setUp(self)
+        self.sleep = mock.AsyncMock()
+        patcher = mock.patch.object(shaping.asyncio, "sleep", self.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_server_limit_shared(self):
+        limits = Shaping(0., RATE, BURST)
+        sessions = [limits.session("server"), limits.session("server")]
+        other = limits.session("other")
+        await sessions[0].to_server(BURST)
+        await sessions[1].to_server(BURST)
+        self.sleep.assert_awaited_once()
+        self.assertAlmostEqual(self.sleep.await_args.args[0], BURST / RATE)
+        # У другого сервера и другого направления свои токены
+        await other.to_server(BURST)
+        await sessions[1].to_client(BURST)
+        self.assertEqual(self.sleep.await_count, 1)
+
+    async def test_session_and_server_limits(self):
+        limits = Shaping(RATE, 4 * RATE, BURST)
+        session = limits.session("server")
+        await session.to_client(BURST + 200)
+        # Задержка - большая из задержек сессии и сервера
+        self.assertAlmostEqual(self.sleep.await_args.args[0], 200 / RATE)
+
+    async def test_update_running_sessions(self):
+        limits = Shaping(0., 0., BURST)
+        session = limits.session("server")
+        limits.set_server_rate(RATE, "server")
+        self.assertEqual(session.server_buckets.rate, RATE)
+        limits.set_session_rate(2 * RATE)
+        self.assertEqual(session.buckets.rate, 0.)
+        limits.update_session(session)
+        self.assertEqual(session.buckets.rate, 2 * RATE)
+        session.rate = 3 * RATE
+        limits.update_session(session)
+        self.assertEqual(session.buckets.rate, 3 * RATE)
+        limits.set_burst(100)
+        self.assertEqual(session.server_buckets.to_server.burst, 100)
+        self.assertEqual(limits.session("new").server_buckets.rate, 0.)
+        self.assertEqual(limits.to_dict()["server_rates"], {"server": RATE})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Кэш TLS-сессий UpstreamTls, когда сервер переходит на шифры по умолчанию, пока открыто
+соединение с выбранными шифрами
+
+python3 -m unittest tests.test_tls_sessions
+"""
+import tempfile
+import threading
+import unittest
+import socket
+import ssl
+
+from tls_proxy.tls_context import UpstreamTls, create_client_context
+from benchmarks import harness
+
+
+class TlsSessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        cert_path, key_path = harness.make_self_signed_cert(self.tmp_dir.name)
+        self.server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.server_context.load_cert_chain(cert_path, key_path)
+        self.listen_sock = socket.create_server(("127.0.0.1", 0))
+        self.server = self.listen_sock.getsockname()
+        threading.Thread(target=self._serve, daemon=True).start()
+        self.tls = UpstreamTls(cert_path)
+        # Как после выбора профиля auto: отдельный контекст для серверов, не принявших шифры
+        self.tls.fallback_context = create_client_context(cert_path)
+
+    def tearDown(self):
+        self.listen_sock.close()
+        self.tmp_dir.cleanup()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listen_sock.accept()
+            except OSError:
+                return
+            try:
+                with self.server_context.wrap_socket(conn, server_side=True) as tls_conn:
+                    # После данных клиент получает тикет сессии TLS 1.3
+                    tls_conn.sendall(b"x")
+                    tls_conn.recv(1)
+            except (OSError, ssl.SSLError):
+                pass
+
+    def connect(self) -> ssl.SSLSocket:
+        tls_sock = self.tls.wrap_socket(socket.create_connection(self.server), self.server)
+        tls_sock.do_handshake()
+        self.assertEqual(tls_sock.recv(1), b"x")
+        return tls_sock
+
+    def test_session_of_previous_context_is_not_used(self):
+        tls_sock = self.connect()
+        self.tls.handshake_done(tls_sock, self.server, 0.)
+        self.tls.fallback_servers.add(self.server)
+        # Старое соединение закрывается после перехода сервера на другой контекст
+        self.tls.save_session(tls_sock, self.server)
+        tls_sock.close()
+
+        fallback_sock = self.connect()
+        self.assertIs(fallback_sock.context, self.tls.fallback_context)
+        self.assertFalse(fallback_sock.session_reused)
+        self.tls.save_session(fallback_sock, self.server)
+        fallback_sock.close()
+
+        resumed_sock = self.connect()
+        self.assertTrue(resumed_sock.session_reused)
+        resumed_sock.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+tls_proxy.tunnel_server открывает туннель только клиентам с сертификатом от --client-ca:
+usbipd2 видит потоки туннеля с 127.0.0.1 и не может проверить адрес клиента сам
+
+python3 -m unittest tests.test_tunnel_auth
+"""
+from typing import Optional
+import subprocess
+import tempfile
+import unittest
+import socket
+import ssl
+import sys
+
+from tls_proxy.protocol import USBIP_DIR_IN
+from tls_proxy.tls_context import create_client_context
+from benchmarks import harness
+
+
+class TunnelAuthTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cert_path, self.key_path = harness.make_self_signed_cert(self.tmp_dir.name)
+        self.procs = []
+        usbipd_proc, self.usbipd_port = harness.start_usbipd_stub(self.cert_path, self.key_path)
+        self.procs.append(usbipd_proc)
+        tunnel_proc, self.tunnel_port = harness.start_tunnel_server(
+            self.usbipd_port, self.cert_path, self.key_path)
+        self.procs.append(tunnel_proc)
+
+    def tearDown(self):
+        harness.stop_processes(self.procs)
+        self.tmp_dir.cleanup()
+
+    def server_closes(self, cert_file: Optional[str]) -> bool:
+        """
+        Закрывает ли сервер туннель после рукопожатия. В TLS 1.3 сервер проверяет сертификат
+        клиента, когда рукопожатие у клиента уже закончено
+        """
+        context = create_client_context(self.cert_path, cert_file, self.key_path)
+        with socket.create_connection(("localhost", self.tunnel_port)) as sock, \
+                context.wrap_socket(sock) as tls_sock:
+            tls_sock.settimeout(1)
+            try:
+                return not tls_sock.recv(1)
+            except TimeoutError:
+                return False
+            except (ssl.SSLError, ConnectionError):
+                return True
+
+    def test_client_without_certificate_is_rejected(self):
+        self.assertTrue(self.server_closes(None))
+        self.assertFalse(self.server_closes(self.cert_path))
+
+    def test_proxy_with_certificate(self):
+        proxy_proc, proxy_port = harness.start_proxy(
+            self.usbipd_port, self.cert_path,
+            ["--tunnel", "--tunnel-port", str(self.tunnel_port), "--tunnel-cert", self.cert_path,
+             "--tunnel-key", self.key_path])
+        self.procs.append(proxy_proc)
+        throughput, _, latencies = harness.run_urb_load(proxy_port, 2, 20, 4096, USBIP_DIR_IN,
+                                                        2)
+        self.assertEqual(len(latencies), 40)
+
+    def test_tunnel_requires_certificate_option(self):
+        result = subprocess.run([sys.executable, "-m", "tls_proxy", "--tunnel"],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--tunnel requires --tunnel-cert", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
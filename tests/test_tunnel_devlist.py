@@ -0,0 +1,75 @@
+"""
+Запрос списка устройств через поток туннеля, как его читает кэш списка устройств
+(--tunnel --devlist-cache)
+
+python3 -m unittest tests.test_tunnel_devlist
+"""
+import unittest
+import asyncio
+import socket
+import struct
+
+from tls_proxy.protocol import OP_COMMON, OP_REP_DEVLIST, OP_REQ_DEVLIST, USB_DEVICE
+from tls_proxy.tunnel import TunnelConnection, TunnelStream
+from tls_proxy.devlist_cache import read_devlist_reply
+from tls_proxy.relay_socket import RelaySocket
+
+
+USBIP_VERSION = 0x0111
+DEVICE = USB_DEVICE.pack(b"/sys/devices/platform/stub/usb1/1-1", b"1-1", 1, 2, 3, 0x1d6b,
+                         0x0104, 0x0100, 0, 0, 0, 1, 1, 1)
+INTERFACE = bytes([0xff, 0, 0, 0])
+REPLY = OP_COMMON.pack(USBIP_VERSION, OP_REP_DEVLIST, 0) + struct.pack(">I", 1) + DEVICE + \
+    INTERFACE
+
+
+class TunnelDevlistTest(unittest.IsolatedAsyncioTestCase):
+    async def test_devlist_reply_through_stream(self):
+        loop = asyncio.get_running_loop()
+        client_sock, server_sock = socket.socketpair()
+        requests = []
+
+        async def answer(stream: TunnelStream):
+            requests.append(await stream.recv_exactly(OP_COMMON.size))
+            await stream.sendall(REPLY)
+
+        server = TunnelConnection(RelaySocket(server_sock, loop),
+                                  lambda stream: loop.create_task(answer(stream)))
+        client = TunnelConnection(RelaySocket(client_sock, loop))
+        server.start()
+        client.start()
+        try:
+            stream = client.open_stream()
+            await stream.sendall(OP_COMMON.pack(USBIP_VERSION, OP_REQ_DEVLIST, 0))
+            reply, cacheable = await asyncio.wait_for(read_devlist_reply(stream), 5)
+            self.assertEqual(reply, REPLY)
+            self.assertTrue(cacheable)
+            self.assertEqual(OP_COMMON.unpack(requests[0])[1], OP_REQ_DEVLIST)
+        finally:
+            client.close()
+            server.close()
+
+    async def test_recv_exactly_stops_at_close(self):
+        loop = asyncio.get_running_loop()
+        client_sock, server_sock = socket.socketpair()
+
+        async def answer(stream: TunnelStream):
+            await stream.sendall(b"abc")
+            stream.close()
+
+        server = TunnelConnection(RelaySocket(server_sock, loop),
+                                  lambda stream: loop.create_task(answer(stream)))
+        client = TunnelConnection(RelaySocket(client_sock, loop))
+        server.start()
+        client.start()
+        try:
+            stream = client.open_stream()
+            await stream.sendall(b"x")
+            self.assertEqual(await asyncio.wait_for(stream.recv_exactly(10), 5), b"abc")
+        finally:
+            client.close()
+            server.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
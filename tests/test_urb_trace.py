@@ -0,0 +1,85 @@
+"""
+Столбцы заголовков URB из кольца захвата и его экспорта в JSONL совпадают с записями,
+которые читает tls_proxy.capture.read_ring, в том числе после переноса записей в начало кольца
+
+python3 -m unittest tests.test_urb_trace
+"""
+import tempfile
+import unittest
+import random
+import os
+
+import numpy as np
+
+from tls_proxy.protocol import USBIP_CMD_SUBMIT, USBIP_DIR_IN, USBIP_HEADER, USBIP_RET_SUBMIT
+from tls_proxy.capture import CaptureRing, export_jsonl, read_ring
+from tls_proxy.urb_trace import COLUMNS, TraceStats, read_trace
+
+
+RING_SIZE = 64 * 1024
+URBS = 3000
+CHUNK_RECORDS = 500
+
+
+class CaptureDecodeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.ring_path = os.path.join(self.tmp_dir.name, "ring.cap")
+        rng = random.Random(0)
+        ring = CaptureRing(self.ring_path, RING_SIZE)
+        for seqnum in range(URBS):
+            # Записи этапа импорта короче заголовка URB
+            ring.write(seqnum % 3, 1, bytes(rng.randrange(1, USBIP_HEADER.size)), 40)
+            ring.write(seqnum % 3, 0, USBIP_HEADER.pack(
+                USBIP_CMD_SUBMIT, seqnum, 2, USBIP_DIR_IN, 1, 0, 512, 0, 0, 0) +
+                bytes(rng.randrange(64)), USBIP_HEADER.size)
+            ring.write(seqnum % 3, 1, USBIP_HEADER.pack(
+                USBIP_RET_SUBMIT, seqnum, 2, USBIP_DIR_IN, 1, -32 if seqnum % 7 else 0, 512, 0,
+                0, 0) + bytes(rng.randrange(64)), USBIP_HEADER.size + 512)
+        ring.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def expected(self) -> dict:
+        records = [record for record in read_ring(self.ring_path)
+                   if len(record.data) >= USBIP_HEADER.size]
+        self.assertLess(len(records), 2 * URBS)
+        headers = [USBIP_HEADER.unpack(record.data[:USBIP_HEADER.size]) for record in records]
+        return {
+            "ts_ns": [record.timestamp_ns for record in records],
+            "session": [record.session for record in records],
+            "size": [record.length for record in records],
+            "command": [header[0] for header in headers],
+            "seqnum": [header[1] for header in headers],
+            "status": [header[5] for header in headers],
+        }
+
+    def decode(self, path: str) -> dict:
+        stats = TraceStats()
+        chunks = list(read_trace(path, chunk_records=CHUNK_RECORDS, stats=stats))
+        self.assertEqual(stats.records, sum(1 for _ in read_ring(self.ring_path)))
+        self.assertEqual(set(chunks[0]), set(COLUMNS))
+        return {name: np.concatenate([chunk[name] for chunk in chunks]).tolist()
+                for name in COLUMNS}
+
+    def test_ring(self):
+        columns = self.decode(self.ring_path)
+        for name, values in self.expected().items():
+            self.assertEqual(columns[name], values, name)
+
+    def test_jsonl(self):
+        jsonl_path = os.path.join(self.tmp_dir.name, "ring.jsonl")
+        with open(jsonl_path, "wb") as out:
+            export_jsonl(read_ring(self.ring_path), out)
+        columns = self.decode(jsonl_path)
+        for name, values in self.expected().items():
+            if name == "ts_ns":
+                # Время в JSONL - секунды в double
+                np.testing.assert_allclose(columns[name], values, rtol=0, atol=1000)
+            else:
+                self.assertEqual(columns[name], values, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
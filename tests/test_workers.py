@@ -0,0 +1,112 @@
+"""
+Процессы --workers создаются процессом запуска и не наследуют цикл событий и сокеты
+супервизора, упавший процесс перезапускается. Статистика процессов объединяется супервизором
+
+python3 -m unittest tests.test_workers
+"""
+import tempfile
+import unittest
+import signal
+import time
+import os
+
+from tls_proxy.workers import WORKER_RESTART_DELAY_S, merge_stats
+from tls_proxy.control import request
+from benchmarks import harness
+
+
+def _descriptors(pid: int) -> set:
+    """
+    Объекты открытых дескрипторов процесса, кроме стандартных потоков
+    """
+    fd_dir = f"/proc/{pid}/fd"
+    return {os.readlink(os.path.join(fd_dir, fd)) for fd in os.listdir(fd_dir) if int(fd) > 2}
+
+
+class WorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        cert_path, key_path = harness.make_self_signed_cert(self.tmp_dir.name)
+        self.usbipd_proc, usbipd_port = harness.start_usbipd_stub(cert_path, key_path)
+        self.control_socket = os.path.join(self.tmp_dir.name, "control.sock")
+        self.proxy_proc, self.proxy_port = harness.start_proxy(
+            usbipd_port, cert_path,
+            ["--workers", "2", "--control", self.control_socket, "--urb-stats"])
+
+    def tearDown(self):
+        harness.stop_processes([self.proxy_proc, self.usbipd_proc])
+        self.tmp_dir.cleanup()
+
+    def test_workers_do_not_inherit_supervisor_descriptors(self):
+        supervisor = _descriptors(self.proxy_proc.pid)
+        for pid in request("workers", self.control_socket).values():
+            worker = _descriptors(pid)
+            self.assertEqual(sum(fd == "anon_inode:[eventpoll]" for fd in worker), 1)
+            # У eventpoll в /proc нет номера, сокеты различаются номерами inode
+            self.assertFalse({fd for fd in worker & supervisor if fd.startswith("socket:")})
+
+    def test_restart(self):
+        workers = request("workers", self.control_socket)
+        os.kill(workers["0"], signal.SIGKILL)
+        deadline = time.monotonic() + WORKER_RESTART_DELAY_S + 5
+        while time.monotonic() < deadline:
+            restarted = request("workers", self.control_socket)
+            if restarted.get("0") not in (None, workers["0"]):
+                break
+            time.sleep(0.1)
+        self.assertNotEqual(restarted.get("0"), workers["0"])
+        self.assertEqual(restarted["1"], workers["1"])
+        throughput, _, latencies = harness.run_urb_load(self.proxy_port, 2, 50, 4096, 1, 4)
+        self.assertEqual(len(latencies), 100)
+
+    def test_control_commands(self):
+        harness.run_urb_load(self.proxy_port, 2, 50, 4096, 1, 4)
+        stats = request("stats", self.control_socket)
+        self.assertIs(stats["total"]["tls_handshakes"]["ktls"]["enabled"], False)
+        urb_stats = request("urb_stats", self.control_socket)
+        self.assertEqual(sum(server["pdus_to_server"]
+                             for server in urb_stats["servers"].values()), 2 * 50)
+        for command in ("pool", "devlist_cache"):
+            reply = request(command, self.control_socket)
+            self.assertEqual(set(reply["workers"]), {"0", "1"})
+        capture_file = os.path.join(self.tmp_dir.name, "capture")
+        reply = request("capture", self.control_socket, enable=True, file=capture_file)
+        self.assertTrue(all(worker["enabled"] for worker in reply.values()))
+        self.assertTrue(os.path.exists(f"{capture_file}.0"))
+        events = request("session_events", self.control_socket)
+        self.assertEqual(set(events), {"0", "1"})
+
+
+class MergeStatsTest(unittest.TestCase):
+    def test_merge(self):
+        worker = {
+            "sessions": 2,
+            "ktls": {"enabled": True},
+            "rates_mb_per_s": {"aes": 900.},
+            "connect_rate": {"server": {"tokens": 3., "delayed": 1}},
+            "resolver": {"hits": 3, "negative_hits": 0, "misses": 1, "coalesced": 0,
+                         "hit_ratio": 0.75},
+            "latency": {"max_us": 10, "avg_us": 5., "p99_us": 9},
+        }
+        other = {
+            "sessions": 1,
+            "ktls": {"enabled": True},
+            "rates_mb_per_s": {"aes": 1100.},
+            "connect_rate": {"server": {"tokens": 5., "delayed": 2}},
+            "resolver": {"hits": 0, "negative_hits": 0, "misses": 4, "coalesced": 0,
+                         "hit_ratio": 0.},
+            "latency": {"max_us": 20, "avg_us": 6., "p99_us": 19},
+        }
+        self.assertEqual(merge_stats(merge_stats({}, worker), other), {
+            "sessions": 3,
+            "ktls": {"enabled": True},
+            "rates_mb_per_s": {"aes": 900.},
+            "connect_rate": {"server": {"tokens": 3., "delayed": 3}},
+            "resolver": {"hits": 3, "negative_hits": 0, "misses": 5, "coalesced": 0,
+                         "hit_ratio": 3 / 8},
+            "latency": {"max_us": 20},
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+import argparse
+import logging
+
+from tls_proxy import config, async_relay, socketserver_relay, workers, systemd
+
+
+ENGINES = {
+    "asyncio": async_relay.server_run,
+    "socketserver": socketserver_relay.server_run,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS proxy for usbip client connections")
+    parser.add_argument('-d', action='store_true', dest='debug', help='Show debug messages')
+    parser.add_argument('--engine', choices=ENGINES.keys(), default="asyncio",
+                        help='Relay engine')
+    parser.add_argument('--address', default=config.PROXY_ADDRESS, help='Listen address')
+    parser.add_argument('--port', type=int, default=config.PROXY_PORT, help='Listen port')
+    parser.add_argument('--upstream-port', type=int, default=config.USBIP_SERVER_PORT,
+                        dest='upstream_port', help='usbipd port on target hosts')
+    parser.add_argument('--cafile', default=None, dest='ca_file',
+                        help='CA certificates to verify usbipd certificate')
+    parser.add_argument('--buffer-size', type=int, default=config.RELAY_BUFFER_SIZE,
+                        dest='buffer_size', help='Relay buffer size (two per session)')
+    parser.add_argument('--control', default=None, dest='control_socket',
+                        help=f'Control socket path, e.g. {config.CONTROL_SOCKET_PATH}')
+    parser.add_argument('--urb-stats', action='store_true', dest='urb_stats',
+                        help='Parse usbip URBs and collect latency histograms')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Run N asyncio proxy processes sharing the port (SO_REUSEPORT)')
+    parser.add_argument('--cpu-affinity', action='store_true', dest='cpu_affinity',
+                        help='Pin each worker process to its own CPU')
+    parser.add_argument('--pool-size', type=int, default=0, dest='pool_size',
+                        help='Keep N ready TLS connections to each server from servers file')
+    parser.add_argument('--pool-idle-timeout', type=float, default=config.POOL_IDLE_TIMEOUT_S,
+                        dest='pool_idle_timeout_s', help='Close pooled connections after N seconds')
+    parser.add_argument('--servers-file', default=config.SERVERS_FILE_PATH, dest='servers_file',
+                        help='usbip2 settings file with servers list')
+    parser.add_argument('--devlist-cache', type=float, default=0., dest='devlist_cache_ttl_s',
+                        metavar='TTL', help='Answer repeated device list requests from cache '
+                                            'for TTL seconds')
+    parser.add_argument('--tunnel', action='store_true',
+                        help='Relay all sessions with a server over one connection to '
+                             'tls_proxy.tunnel_server')
+    parser.add_argument('--tunnel-port', type=int, default=config.TUNNEL_PORT, dest='tunnel_port',
+                        help='tls_proxy.tunnel_server port on target hosts')
+    parser.add_argument('--tunnel-cert', default=None, dest='tunnel_cert_file',
+                        help='Client certificate for tls_proxy.tunnel_server')
+    parser.add_argument('--tunnel-key', default=None, dest='tunnel_key_file',
+                        help='Client certificate private key for tls_proxy.tunnel_server')
+    parser.add_argument('--qos', action='store_true',
+                        help='Send interrupt and isochronous URBs through the tunnel ahead of bulk')
+    parser.add_argument('--plain-server', action='append', default=[], dest='plain_servers',
+                        metavar='HOST', help='Connect to usbipd on HOST without TLS '
+                                             '(trusted networks only), may be repeated')
+    parser.add_argument('--no-splice', action='store_false', dest='splice',
+                        help='Relay plain sessions through userspace buffers instead of splice')
+    parser.add_argument('--cipher-profile', choices=config.CIPHER_PROFILES, default="default",
+                        dest='cipher_profile',
+                        help='Ciphers for connections to servers: auto picks the faster of '
+                             'aes-gcm and chacha20 (TLS 1.2) by a startup benchmark, tls13 '
+                             'allows only TLS 1.3')
+    parser.add_argument('--cipher-allow-tls12', action='store_true', dest='cipher_allow_tls12',
+                        help='Let --cipher-profile auto pick chacha20, which limits connections '
+                             'to TLS 1.2')
+    parser.add_argument('--ktls', action='store_true',
+                        help='Encrypt TLS records to servers in the kernel when supported '
+                             '(Python 3.12+, kernel tls module), falls back to userspace TLS')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Gather bulk URBs from the client into larger writes to the server')
+    parser.add_argument('--coalesce-size', type=int, default=config.COALESCE_SIZE,
+                        dest='coalesce_size', help='Write gathered URBs at this many bytes')
+    parser.add_argument('--coalesce-delay', type=int, default=config.COALESCE_DELAY_US,
+                        dest='coalesce_delay_us', metavar='US',
+                        help='Write gathered URBs after N microseconds (0 - when the event loop '
+                             'is idle)')
+    parser.add_argument('--tcp-tune', action='store_true', dest='tcp_tune',
+                        help='Size socket buffers of connections to servers by the measured '
+                             'bandwidth-delay product')
+    parser.add_argument('--dead-peer-timeout', type=float, default=0., dest='dead_peer_timeout_s',
+                        metavar='S',
+                        help='Close sessions whose server sent no data or acks for S seconds '
+                             '(TCP_USER_TIMEOUT and keepalive probes) and report session_lost '
+                             'events, 0 - disabled')
+    parser.add_argument('--impair', action='store_true',
+                        help='Testing only: emulate a WAN on the relay path (impair control '
+                             'command changes it per session)')
+    parser.add_argument('--impair-delay', type=float, default=0., dest='impair_delay_ms',
+                        metavar='MS', help='One way delay of each direction')
+    parser.add_argument('--impair-jitter', type=float, default=0., dest='impair_jitter_ms',
+                        metavar='MS', help='Random delay variation, without reordering')
+    parser.add_argument('--impair-rate', type=float, default=0., dest='impair_rate',
+                        metavar='B', help='Link bandwidth in bytes per second, 0 - unlimited')
+    parser.add_argument('--impair-loss', type=float, default=0., dest='impair_loss',
+                        metavar='P', help='Probability of a lost write, delayed by a '
+                                          'retransmission')
+    parser.add_argument('--impair-seed', type=int, default=None, dest='impair_seed',
+                        help='Random seed for reproducible jitter and losses')
+    parser.add_argument('--dns-ttl', type=float, default=config.DNS_CACHE_TTL_S,
+                        dest='dns_cache_ttl_s', help='Cache resolved server addresses for N seconds')
+    parser.add_argument('--dns-negative-ttl', type=float, default=config.DNS_NEGATIVE_TTL_S,
+                        dest='dns_negative_ttl_s', help='Cache name resolution errors for N seconds')
+    parser.add_argument('--connect-stagger', type=float, default=config.CONNECT_STAGGER_S,
+                        dest='connect_stagger_s',
+                        help='Delay between parallel connection attempts to server addresses')
+    parser.add_argument('--max-sessions', type=int, default=0, dest='max_sessions',
+                        help='Queue sessions above this number')
+    parser.add_argument('--max-client-sessions', type=int, default=0, dest='max_client_sessions',
+                        help='Reject sessions above this number from one client address')
+    parser.add_argument('--memory-budget', type=int, default=0, dest='memory_budget',
+                        help='Relay buffers memory limit in bytes (limits sessions)')
+    parser.add_argument('--admission-queue', type=int, default=config.ADMISSION_QUEUE_SIZE,
+                        dest='admission_queue', help='Sessions waiting for a free slot')
+    parser.add_argument('--admission-timeout', type=float, default=config.ADMISSION_TIMEOUT_S,
+                        dest='admission_timeout_s',
+                        help='Reject sessions waiting for a slot longer than N seconds')
+    parser.add_argument('--server-connect-rate', type=float, default=0.,
+                        dest='server_connect_rate',
+                        help='New connections per second to one server')
+    parser.add_argument('--server-connect-burst', type=int, default=config.SERVER_CONNECT_BURST,
+                        dest='server_connect_burst',
+                        help='New connections to one server allowed at once')
+    parser.add_argument('--session-rate', type=float, default=0., dest='session_rate_limit',
+                        metavar='BYTES', help='Bytes per second in each direction of a session')
+    parser.add_argument('--server-rate', type=float, default=0., dest='server_rate_limit',
+                        metavar='BYTES', help='Bytes per second in each direction of all '
+                                              'sessions with one server')
+    parser.add_argument('--rate-burst', type=int, default=config.RATE_LIMIT_BURST,
+                        dest='rate_limit_burst', metavar='BYTES',
+                        help='Bytes allowed at once above --session-rate and --server-rate')
+    parser.add_argument('--capture', default=None, dest='capture_path',
+                        help='Capture session PDUs to ring file from start')
+    parser.add_argument('--capture-size', type=int, default=config.CAPTURE_SIZE,
+                        dest='capture_size', help='Capture ring file size in bytes')
+    parser.add_argument('--capture-snaplen', type=int, default=config.CAPTURE_SNAPLEN,
+                        dest='capture_snaplen', help='PDU payload bytes to capture')
+    parser.add_argument('--handoff', default=None, dest='handoff_socket',
+                        help='Unix socket for passing the listening socket to a new process '
+                             f'started on SIGHUP, e.g. {config.HANDOFF_SOCKET_PATH}')
+    parser.add_argument('--takeover', action='store_true',
+                        help='Take the listening socket from the process running with --handoff')
+    args = parser.parse_args()
+    if args.workers and args.engine != "asyncio":
+        parser.error("--workers requires asyncio engine")
+    if args.pool_size and args.engine != "asyncio":
+        parser.error("--pool-size requires asyncio engine")
+    if args.devlist_cache_ttl_s and args.engine != "asyncio":
+        parser.error("--devlist-cache requires asyncio engine")
+    if args.tunnel and args.engine != "asyncio":
+        parser.error("--tunnel requires asyncio engine")
+    if args.plain_servers and args.engine != "asyncio":
+        parser.error("--plain-server requires asyncio engine")
+    if args.capture_path and args.engine != "asyncio":
+        parser.error("--capture requires asyncio engine")
+    if (args.session_rate_limit or args.server_rate_limit) and args.engine != "asyncio":
+        parser.error("--session-rate and --server-rate require asyncio engine")
+    if args.handoff_socket and args.engine != "asyncio":
+        parser.error("--handoff requires asyncio engine")
+    if args.handoff_socket and args.workers:
+        parser.error("--handoff can not be used with --workers")
+    if args.takeover and not args.handoff_socket:
+        parser.error("--takeover requires --handoff")
+    if args.tunnel and not (args.tunnel_cert_file and args.tunnel_key_file):
+        parser.error("--tunnel requires --tunnel-cert and --tunnel-key")
+    if (args.tunnel_cert_file or args.tunnel_key_file) and not args.tunnel:
+        parser.error("--tunnel-cert and --tunnel-key require --tunnel")
+    if args.qos and not args.tunnel:
+        parser.error("--qos requires --tunnel")
+    if args.cipher_profile != "default" and args.engine != "asyncio":
+        parser.error("--cipher-profile requires asyncio engine")
+    if args.cipher_allow_tls12 and args.cipher_profile != "auto":
+        parser.error("--cipher-allow-tls12 requires --cipher-profile auto")
+    if args.ktls and args.engine != "asyncio":
+        parser.error("--ktls requires asyncio engine")
+    if args.tcp_tune and args.engine != "asyncio":
+        parser.error("--tcp-tune requires asyncio engine")
+    if args.dead_peer_timeout_s < 0:
+        parser.error("--dead-peer-timeout must not be negative")
+    if args.dead_peer_timeout_s and args.engine != "asyncio":
+        parser.error("--dead-peer-timeout requires asyncio engine")
+    if (args.impair_delay_ms or args.impair_jitter_ms or args.impair_rate or args.impair_loss or
+            args.impair_seed is not None) and not args.impair:
+        parser.error("--impair-* options require --impair")
+    if args.impair and args.engine != "asyncio":
+        parser.error("--impair requires asyncio engine")
+    if min(args.impair_delay_ms, args.impair_jitter_ms, args.impair_rate) < 0 or \
+            not 0 <= args.impair_loss < 1:
+        parser.error("--impair-* values must not be negative and --impair-loss must be below 1")
+    if args.coalesce and args.engine != "asyncio":
+        parser.error("--coalesce requires asyncio engine")
+    if args.coalesce and args.tunnel:
+        parser.error("--coalesce can not be used with --tunnel")
+    if args.tunnel and args.pool_size:
+        parser.error("--tunnel and --pool-size can not be used together")
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(
+        level=log_level, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S')
+
+    proxy_config = config.ProxyConfig(
+        address=args.address,
+        port=args.port,
+        upstream_port=args.upstream_port,
+        ca_file=args.ca_file,
+        buffer_size=args.buffer_size,
+        control_socket=args.control_socket,
+        urb_stats=args.urb_stats,
+        workers=args.workers,
+        cpu_affinity=args.cpu_affinity,
+        pool_size=args.pool_size,
+        pool_idle_timeout_s=args.pool_idle_timeout_s,
+        servers_file=args.servers_file,
+        devlist_cache_ttl_s=args.devlist_cache_ttl_s,
+        tunnel=args.tunnel,
+        tunnel_port=args.tunnel_port,
+        tunnel_cert_file=args.tunnel_cert_file,
+        tunnel_key_file=args.tunnel_key_file,
+        qos=args.qos,
+        plain_servers=args.plain_servers,
+        splice=args.splice,
+        cipher_profile=args.cipher_profile,
+        cipher_allow_tls12=args.cipher_allow_tls12,
+        ktls=args.ktls,
+        coalesce=args.coalesce,
+        coalesce_size=args.coalesce_size,
+        coalesce_delay_us=args.coalesce_delay_us,
+        tcp_tune=args.tcp_tune,
+        dead_peer_timeout_s=args.dead_peer_timeout_s,
+        impair=args.impair,
+        impair_delay_ms=args.impair_delay_ms,
+        impair_jitter_ms=args.impair_jitter_ms,
+        impair_rate=args.impair_rate,
+        impair_loss=args.impair_loss,
+        impair_seed=args.impair_seed,
+        dns_cache_ttl_s=args.dns_cache_ttl_s,
+        dns_negative_ttl_s=args.dns_negative_ttl_s,
+        connect_stagger_s=args.connect_stagger_s,
+        max_sessions=args.max_sessions,
+        max_client_sessions=args.max_client_sessions,
+        memory_budget=args.memory_budget,
+        admission_queue=args.admission_queue,
+        admission_timeout_s=args.admission_timeout_s,
+        server_connect_rate=args.server_connect_rate,
+        server_connect_burst=args.server_connect_burst,
+        session_rate_limit=args.session_rate_limit,
+        server_rate_limit=args.server_rate_limit,
+        rate_limit_burst=args.rate_limit_burst,
+        capture_path=args.capture_path,
+        capture_size=args.capture_size,
+        capture_snaplen=args.capture_snaplen,
+        handoff_socket=args.handoff_socket,
+        takeover=args.takeover,
+    )
+
+    # Сокет от systemd (tls_proxy.socket) заменяет --address и --port
+    listen_fds = systemd.listen_fds()
+    if listen_fds:
+        proxy_config.listen_fd = listen_fds[0]
+
+    try:
+        if proxy_config.workers:
+            workers.server_run(proxy_config)
+        else:
+            ENGINES[args.engine](proxy_config)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
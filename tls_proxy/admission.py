@@ -0,0 +1,137 @@
+"""
+Ограничение нагрузки на прокси: число одновременных сессий всего и с одного адреса клиента
+и частота новых соединений с каждым сервером.
+Сессии сверх общего ограничения ждут в очереди, пока не освободится место, и отклоняются,
+если очередь заполнена или место не освободилось за время ожидания. Так всплеск новых
+соединений не отнимает процессор и память у уже работающих сессий
+"""
+from typing import Deque, Dict
+from collections import deque
+import asyncio
+import time
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class Admission:
+    """
+    max_sessions, max_client_sessions - 0 без ограничения
+    """
+    def __init__(self, max_sessions: int, max_client_sessions: int, queue_size: int,
+                 queue_timeout_s: float):
+        self.max_sessions = max_sessions
+        self.max_client_sessions = max_client_sessions
+        self.queue_size = queue_size
+        self.queue_timeout_s = queue_timeout_s
+        self.active = 0
+        # Сессии клиентов, в том числе ожидающие в очереди
+        self.clients: Dict[str, int] = {}
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_client_limit = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    async def admit(self, client: str):
+        sessions = self.clients.get(client, 0)
+        if self.max_client_sessions and sessions >= self.max_client_sessions:
+            self.rejected_client_limit += 1
+            raise AdmissionRejected(f"client has {sessions} sessions")
+
+        if self.max_sessions and self.active >= self.max_sessions:
+            if len(self._waiters) >= self.queue_size:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected(f"{self.active} sessions, admission queue is full")
+            self.clients[client] = sessions + 1
+            self.queued += 1
+            await self._wait_slot(client)
+        else:
+            self.clients[client] = sessions + 1
+            self.active += 1
+        self.admitted += 1
+
+    async def _wait_slot(self, client: str):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout_s)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Место уже передано этой сессии
+                self.release(client)
+            else:
+                waiter.cancel()
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                self._remove_client(client)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected_timeout += 1
+                raise AdmissionRejected(
+                    f"no free session slot in {self.queue_timeout_s} s") from None
+            raise
+
+    def release(self, client: str):
+        self._remove_client(client)
+        # Место передается первой ожидающей сессии, active не меняется
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _remove_client(self, client: str):
+        self.clients[client] -= 1
+        if not self.clients[client]:
+            del self.clients[client]
+
+    def to_dict(self) -> dict:
+        return {
+            "active": self.active,
+            "queue": sum(not waiter.done() for waiter in self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_client_limit": self.rejected_client_limit,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+
+class RateLimiter:
+    """
+    Token bucket: в среднем rate событий в секунду, до burst подряд
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+        self.delayed = 0
+        self.rejected = 0
+
+    def reserve(self, max_delay_s: float) -> float:
+        """
+        Занимает место для события и возвращает, сколько секунд его подождать.
+        Если ждать дольше max_delay_s - AdmissionRejected
+        """
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        delay = (1. - self.tokens) / self.rate if self.tokens < 1. else 0.
+        if delay > max_delay_s:
+            self.rejected += 1
+            raise AdmissionRejected(f"connection rate limit {self.rate}/s exceeded")
+        self.tokens -= 1.
+        self.delayed += delay > 0
+        return delay
+
+    async def acquire(self, max_delay_s: float):
+        delay = self.reserve(max_delay_s)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def to_dict(self) -> dict:
+        return {"tokens": self.tokens, "delayed": self.delayed, "rejected": self.rejected}
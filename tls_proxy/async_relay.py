@@ -0,0 +1,871 @@
+from typing import Awaitable, Dict, Optional, Set, Tuple, Union
+import subprocess
+import logging
+import asyncio
+import signal
+import socket
+import json
+import time
+import ssl
+import os
+
+from tls_proxy.config import ProxyConfig, LISTEN_BACKLOG, TARGET_HOST_SIZE, TARGET_HOST_TIMEOUT_S
+from tls_proxy.config import CAPTURE_PATH, TCP_TUNE_INTERVAL_S
+from tls_proxy.relay_socket import RelaySocket, HAVE_SPLICE, pump, splice_pump
+from tls_proxy.resolver import ConnectRaceStats, Resolver, connect_any
+from tls_proxy.session_timing import ServerTimings, SessionTiming
+from tls_proxy.admission import Admission, AdmissionRejected, RateLimiter
+from tls_proxy.urb_stats import SessionMonitor, UrbStats
+from tls_proxy.coalesce import CoalesceStats, CoalescingWriter
+from tls_proxy.shaping import SessionShaper, Shaping
+from tls_proxy.impair import ImpairedWriter, Impairment, SessionImpairment
+from tls_proxy.capture import Capture
+from tls_proxy.qos import SessionQos
+from tls_proxy.devlist_cache import DevlistCache, FetchResult, read_devlist_reply
+from tls_proxy.protocol import OP_COMMON, OP_REQ_DEVLIST, OP_REQ_IMPORT, SYSFS_BUS_ID_SIZE
+from tls_proxy.protocol import ProtocolError, c_string
+from tls_proxy.tunnel import TunnelConnection, TunnelStream
+from tls_proxy.upstream_pool import UpstreamPool
+from tls_proxy.tls_context import TLS_TX, UpstreamTls, ktls_active
+from tls_proxy.tcp_info import BufferTuner, configure_socket, connection_aborted, peer_silent
+from tls_proxy.tcp_info import set_dead_peer_timeout, tcp_info
+from tls_proxy.session_events import SessionEvents
+from tls_proxy.control import ControlServer, ControlError
+from tls_proxy.handoff import HandoffError, HandoffServer
+from tls_proxy.buffers import BufferPool
+from tls_proxy import handoff, systemd
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+# Соединение с usbipd2 или поток туннеля к нему
+Upstream = Union[RelaySocket, TunnelStream]
+
+
+def parse_target_host(preamble: bytes) -> str:
+    """
+    Разбирает op_target_host_request: имя сервера, дополненное нулями до TARGET_HOST_SIZE байт
+    """
+    return preamble.split(b'\0', 1)[0].strip().decode(encoding="ascii")
+
+
+def upstream_socket(upstream: Upstream) -> socket.socket:
+    """
+    TCP-сокет соединения с сервером, у потока туннеля - сокет туннеля
+    """
+    if isinstance(upstream, TunnelStream):
+        return upstream.tunnel.sock.sock
+    return upstream.sock
+
+
+class Session:
+    """
+    Соединение клиента с прокси и соединение прокси с сервером
+    """
+    def __init__(self, id_: int, client: RelaySocket, client_address: str):
+        self.id = id_
+        self.client = client
+        self.client_address = client_address
+        self.upstream: Optional[Upstream] = None
+        self.target_host: Optional[str] = None
+        self.started = time.time()
+        self.timing = SessionTiming()
+        self.monitor: Optional[SessionMonitor] = None
+        self.shaper: Optional[SessionShaper] = None
+        self.tuner: Optional[BufferTuner] = None
+        self.impairment: Optional[SessionImpairment] = None
+        # busid из op_req_import, если прокси читает его до подключения к серверу
+        self.busid: Optional[str] = None
+        # Соединение с сервером признано мертвым (ProxyServer.watch_peers)
+        self.lost = asyncio.Event()
+        self.lost_reason: Optional[str] = None
+
+    @property
+    def import_busid(self) -> Optional[str]:
+        return self.monitor.busid if self.monitor is not None else self.busid
+
+    def to_dict(self) -> dict:
+        return {
+            "client": self.client_address,
+            "target_host": self.target_host,
+            "busid": self.import_busid,
+            "duration_s": time.time() - self.started,
+            "timing": self.timing.to_dict(),
+        }
+
+
+class ProxyServer:
+    def __init__(self, config: ProxyConfig):
+        self.config = config
+        self.sessions: Dict[int, Session] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self._last_session_id = 0
+        self.buffers = BufferPool(config.buffer_size, config.preallocated_buffers)
+        self.tls = UpstreamTls(config.ca_file, config.ktls, config.cipher_profile,
+                               config.cipher_allow_tls12, config.tunnel_cert_file,
+                               config.tunnel_key_file)
+        self.resolver = Resolver(config.dns_cache_ttl_s, config.dns_negative_ttl_s)
+        self.connect_race = ConnectRaceStats()
+        self.admission = Admission(self.session_limit(), config.max_client_sessions,
+                                   config.admission_queue, config.admission_timeout_s)
+        self.connect_limiters: Dict[str, RateLimiter] = {}
+        self.shaping = Shaping(config.session_rate_limit, config.server_rate_limit,
+                               config.rate_limit_burst)
+        # Статистика URB закрытых сессий по серверам
+        self.server_urb_stats: Dict[str, UrbStats] = {}
+        self.server_timings: Dict[str, ServerTimings] = {}
+        self.pool: Optional[UpstreamPool] = None
+        if config.pool_size > 0:
+            self.pool = UpstreamPool(self.connect_upstream, config.pool_size,
+                                     config.pool_idle_timeout_s, config.servers_file)
+        self.devlist_cache: Optional[DevlistCache] = None
+        if config.devlist_cache_ttl_s > 0:
+            self.devlist_cache = DevlistCache(config.devlist_cache_ttl_s)
+        self.coalesce_stats = CoalesceStats()
+        self.tunnels: Dict[str, TunnelConnection] = {}
+        self.tunnel_tuners: Dict[str, BufferTuner] = {}
+        self.events = SessionEvents()
+        # Параметры эмуляции сети для новых сессий (только для тестов)
+        self.impairment: Optional[Impairment] = None
+        if config.impair:
+            self.impairment = Impairment(config.impair_delay_ms, config.impair_jitter_ms,
+                                         config.impair_rate, config.impair_loss)
+        self._tunnel_connects: Dict[str, asyncio.Task] = {}
+        self.capture = Capture()
+        if config.capture_path:
+            self.capture.start(config.capture_path, config.capture_size, config.capture_snaplen)
+        self.control: Optional[ControlServer] = None
+        if config.control_socket:
+            self.control = ControlServer(config.control_socket)
+            self.control.register("stats", self.stats)
+            self.control.register("sessions", self.sessions_info)
+            self.control.register("urb_stats", self.urb_stats)
+            self.control.register("pool", self.pool_info)
+            self.control.register("devlist_cache", self.devlist_cache_info)
+            self.control.register("timings", self.timings)
+            self.control.register("capture", self.capture_control)
+            self.control.register("rate_limits", self.rate_limits)
+            self.control.register("tcp_info", self.connections_info)
+            self.control.register("session_events", self.session_events)
+            if config.impair:
+                self.control.register("impair", self.impair)
+            self.control.register("upgrade", self.upgrade)
+        # Новый процесс, которому передается слушающий сокет
+        self.successor: Optional[subprocess.Popen] = None
+
+    def session_limit(self) -> int:
+        """
+        Ограничение числа сессий с учетом бюджета памяти: каждой сессии нужно два буфера
+        """
+        limit = self.config.max_sessions
+        if self.config.memory_budget:
+            memory_limit = max(1, self.config.memory_budget // (2 * self.config.buffer_size))
+            limit = min(limit, memory_limit) if limit else memory_limit
+        return limit
+
+    def sessions_info(self) -> dict:
+        return {session_id: session.to_dict() for session_id, session in self.sessions.items()}
+
+    def urb_stats(self) -> dict:
+        servers: Dict[str, UrbStats] = {}
+        for server, stats in self.server_urb_stats.items():
+            servers[server] = UrbStats()
+            servers[server].merge(stats)
+        for session in self.sessions.values():
+            if session.monitor is not None and session.target_host is not None:
+                servers.setdefault(session.target_host, UrbStats()).merge(session.monitor.stats)
+        return {
+            "servers": {server: stats.to_dict() for server, stats in servers.items()},
+            "sessions": {session_id: session.monitor.to_dict()
+                         for session_id, session in self.sessions.items()
+                         if session.monitor is not None},
+        }
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "buffers": {
+                "allocated": self.buffers.allocated,
+                "in_use": self.buffers.in_use,
+                "memory_in_use": self.buffers.memory_in_use,
+            },
+            "tls_handshakes": self.tls.to_dict(),
+            "resolver": self.resolver.to_dict(),
+            "connect_race": self.connect_race.to_dict(),
+            "admission": self.admission.to_dict(),
+            "connect_rate": {server: limiter.to_dict()
+                             for server, limiter in self.connect_limiters.items()},
+            "tunnels": {server: tunnel.to_dict() for server, tunnel in self.tunnels.items()},
+            "coalesce": self.coalesce_stats.to_dict(),
+        }
+
+    def connections_info(self) -> dict:
+        """
+        Состояние TCP-соединений сессий с клиентом и с сервером и туннелей
+        """
+        sessions = {}
+        for session_id, session in self.sessions.items():
+            upstream = session.upstream
+            sessions[session_id] = {
+                "target_host": session.target_host,
+                "client": tcp_info(session.client.sock),
+                "upstream": tcp_info(upstream_socket(upstream)) if upstream is not None else None,
+                "tuning": session.tuner.to_dict() if session.tuner is not None else None,
+            }
+        tunnels = {}
+        for server, tunnel in self.tunnels.items():
+            tuner = self.tunnel_tuners.get(server)
+            tunnels[server] = {
+                "upstream": tcp_info(tunnel.sock.sock),
+                "tuning": tuner.to_dict() if tuner is not None else None,
+            }
+        return {"sessions": sessions, "tunnels": tunnels}
+
+    async def tune_sockets(self):
+        """
+        Периодически подстраивает буферы соединений с серверами под измеренный BDP
+        """
+        while True:
+            await asyncio.sleep(TCP_TUNE_INTERVAL_S)
+            sockets = [(session.tuner, session.upstream.sock)
+                       for session in self.sessions.values() if session.tuner is not None]
+            sockets.extend((self.tunnel_tuners[server], tunnel.sock.sock)
+                           for server, tunnel in self.tunnels.items()
+                           if server in self.tunnel_tuners and not tunnel.closed)
+            for tuner, sock in sockets:
+                info = tcp_info(sock)
+                if info is not None:
+                    tuner.update(sock, info)
+
+    def session_lost(self, session: Session, reason: str):
+        """
+        Отмечает сессию потерянной: relay закрывает оба соединения и сообщает о событии
+        """
+        if not session.lost.is_set():
+            session.lost_reason = reason
+            session.lost.set()
+
+    def report_lost(self, session: Session, reason: str):
+        event = self.events.emit("session_lost", session=session.id,
+                                 server=session.target_host, busid=session.import_busid,
+                                 client=session.client_address, reason=reason)
+        _LOGGER.warning(f"Session lost: {json.dumps(event)}")
+
+    async def watch_peers(self):
+        """
+        Ищет соединения с серверами, по которым дольше dead_peer_timeout_s не пришло ни данных,
+        ни подтверждений. Сессии таких соединений и сессии в таких туннелях закрываются
+        """
+        timeout_s = self.config.dead_peer_timeout_s
+        reason = f"No data or acks from server for {timeout_s:g} s"
+        while True:
+            await asyncio.sleep(timeout_s / 4)
+            for session in self.sessions.values():
+                if isinstance(session.upstream, RelaySocket):
+                    info = tcp_info(session.upstream.sock)
+                    if info is not None and peer_silent(info, timeout_s):
+                        self.session_lost(session, reason)
+            for server, tunnel in self.tunnels.items():
+                info = tcp_info(tunnel.sock.sock) if not tunnel.closed else None
+                if info is None or not peer_silent(info, timeout_s):
+                    continue
+                _LOGGER.warning(f"Tunnel to {server} lost: {reason}")
+                for session in self.sessions.values():
+                    if isinstance(session.upstream, TunnelStream) and \
+                            session.upstream.tunnel is tunnel:
+                        self.session_lost(session, reason)
+                tunnel.close()
+
+    async def session_events(self, since: int = 0, timeout: float = 0) -> dict:
+        """
+        События после номера since, без них ждет новое до timeout секунд. last_seq - since для
+        следующего запроса
+        """
+        if timeout < 0:
+            raise ControlError("timeout must not be negative")
+        events = await self.events.wait(since, timeout)
+        return {"last_seq": self.events.last_seq, "events": events}
+
+    def timings(self, server: Optional[str] = None) -> dict:
+        """
+        Перцентили длительности этапов последних сессий по серверам
+        """
+        if server is not None:
+            if server not in self.server_timings:
+                raise ControlError(f"No sessions with {server}")
+            return self.server_timings[server].to_dict()
+        return {server: timings.to_dict() for server, timings in self.server_timings.items()}
+
+    def capture_control(self, enable: Optional[bool] = None, file: Optional[str] = None,
+                        size: Optional[int] = None, snaplen: Optional[int] = None) -> dict:
+        """
+        Включает (enable=true) или выключает захват PDU, без enable - только состояние.
+        Захватываются сессии, начатые при включенном захвате, и все сессии с --urb-stats
+        """
+        if enable:
+            if (size is not None and size <= 0) or (snaplen is not None and snaplen < 0):
+                raise ControlError("size must be positive and snaplen not negative")
+            try:
+                self.capture.start(file or self.config.capture_path or CAPTURE_PATH,
+                                   size or self.config.capture_size,
+                                   snaplen if snaplen is not None else self.config.capture_snaplen)
+            except OSError as e:
+                raise ControlError(f"Failed to create capture file: {e}")
+            _LOGGER.info(f"Capture started: {self.capture.ring.path}")
+        elif enable is not None and self.capture.enabled:
+            self.capture.stop()
+            _LOGGER.info("Capture stopped")
+        return self.capture.to_dict()
+
+    def rate_limits(self, session_rate: Optional[float] = None,
+                    server_rate: Optional[float] = None, burst: Optional[int] = None,
+                    server: Optional[str] = None, session: Optional[int] = None) -> dict:
+        """
+        Меняет ограничения скорости в байтах в секунду (0 - без ограничения) для всех сессий
+        (session_rate) и серверов (server_rate) или только для session и server. Идущие сессии
+        сразу получают новые ограничения. Возвращает ограничения, текущую скорость и время
+        задержек сессий и серверов
+        """
+        if (session_rate is not None and session_rate < 0) or \
+                (server_rate is not None and server_rate < 0):
+            raise ControlError("Rates must not be negative")
+        if burst is not None and burst <= 0:
+            raise ControlError("burst must be positive")
+        if server is not None and server_rate is None:
+            raise ControlError("server requires server_rate")
+        if session is not None:
+            if session_rate is None:
+                raise ControlError("session requires session_rate")
+            if session not in self.sessions or self.sessions[session].shaper is None:
+                raise ControlError(f"No relaying session {session}")
+
+        if burst is not None:
+            self.shaping.set_burst(burst)
+        if server_rate is not None:
+            self.shaping.set_server_rate(server_rate, server)
+        if session is not None:
+            self.sessions[session].shaper.rate = session_rate
+        elif session_rate is not None:
+            self.shaping.set_session_rate(session_rate)
+        if session_rate is not None or burst is not None:
+            for relaying in self.sessions.values():
+                if relaying.shaper is not None:
+                    self.shaping.update_session(relaying.shaper)
+        if session_rate is not None or server_rate is not None or burst is not None:
+            _LOGGER.info(f"Rate limits changed: session {session or 'all'} {session_rate}, "
+                         f"server {server or 'all'} {server_rate}, burst {burst}")
+
+        info = self.shaping.to_dict()
+        info["sessions"] = {session_id: session.shaper.to_dict()
+                            for session_id, session in self.sessions.items()
+                            if session.shaper is not None}
+        return info
+
+    def impair(self, session: Optional[int] = None, delay_ms: Optional[float] = None,
+               jitter_ms: Optional[float] = None, rate: Optional[float] = None,
+               loss: Optional[float] = None, stall_ms: Optional[float] = None) -> dict:
+        """
+        Меняет эмуляцию сети сессии session или, без нее, новых и всех идущих сессий.
+        stall_ms останавливает доставку данных сессий на столько миллисекунд
+        """
+        if any(value is not None and value < 0 for value in (delay_ms, jitter_ms, rate, stall_ms)):
+            raise ControlError("Parameters must not be negative")
+        if loss is not None and not 0 <= loss < 1:
+            raise ControlError("loss must be in [0, 1)")
+        if session is not None:
+            if session not in self.sessions or self.sessions[session].impairment is None:
+                raise ControlError(f"No relaying session {session}")
+            targets = [self.sessions[session].impairment]
+        else:
+            self.impairment.update(delay_ms, jitter_ms, rate, loss)
+            targets = [relaying.impairment for relaying in self.sessions.values()
+                       if relaying.impairment is not None]
+        for target in targets:
+            target.impairment.update(delay_ms, jitter_ms, rate, loss)
+            if stall_ms:
+                target.stall(stall_ms / 1000)
+        return {
+            "default": self.impairment.to_dict(),
+            "sessions": {session_id: relaying.impairment.to_dict()
+                         for session_id, relaying in self.sessions.items()
+                         if relaying.impairment is not None},
+        }
+
+    def upgrade(self) -> dict:
+        """
+        Запускает новый процесс прокси, который заберет слушающий сокет
+        """
+        if not self.config.handoff_socket:
+            raise ControlError("Upgrade requires --handoff")
+        if self.successor is not None and self.successor.poll() is None:
+            raise ControlError(f"New process {self.successor.pid} is already starting")
+        self.successor = handoff.start_successor()
+        _LOGGER.info(f"Upgrade: started new process {self.successor.pid}")
+        return {"pid": self.successor.pid}
+
+    def _upgrade_signal(self):
+        try:
+            self.upgrade()
+        except (ControlError, OSError) as e:
+            _LOGGER.error(f"Upgrade failed: {e}")
+
+    def pool_info(self) -> dict:
+        return self.pool.to_dict() if self.pool is not None else {}
+
+    def devlist_cache_info(self) -> dict:
+        return self.devlist_cache.to_dict() if self.devlist_cache is not None else {}
+
+    def listen(self, listen_fd: Optional[int]) -> socket.socket:
+        if listen_fd is not None:
+            listen_sock = socket.socket(fileno=listen_fd)
+        else:
+            listen_sock = socket.create_server((self.config.address, self.config.port),
+                                               backlog=LISTEN_BACKLOG,
+                                               reuse_port=self.config.reuse_port)
+        listen_sock.setblocking(False)
+        return listen_sock
+
+    async def accept_sessions(self, listen_sock: socket.socket):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                conn, address = await loop.sock_accept(listen_sock)
+                configure_socket(conn)
+            except OSError as e:
+                # Например, закончились файловые дескрипторы
+                _LOGGER.error(f"Accept error: {e}")
+                await asyncio.sleep(0.1)
+                continue
+
+            task = loop.create_task(self.handle_session(conn, address))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        listen_fd = self.config.listen_fd
+        handoff_conn = None
+        if self.config.takeover:
+            try:
+                listen_fd, handoff_conn = handoff.takeover(self.config.handoff_socket)
+            except HandoffError as e:
+                _LOGGER.critical(str(e))
+                raise SystemExit(1)
+        listen_sock = self.listen(listen_fd)
+        address = listen_sock.getsockname()
+        _LOGGER.info(f"Listening on {address[0]}:{address[1]}")
+        if self.admission.max_sessions:
+            _LOGGER.info(f"Sessions limit: {self.admission.max_sessions}")
+        if self.tls.cipher_rates:
+            rates = ", ".join(f"{name} {rate / 1e6:.0f} MB/s"
+                              for name, rate in self.tls.cipher_rates.items())
+            _LOGGER.info(f"Cipher profile: {self.tls.selected_profile} ({rates})")
+        elif self.tls.cipher_benchmark_error:
+            _LOGGER.warning(f"Cipher benchmark failed, using default ciphers: "
+                            f"{self.tls.cipher_benchmark_error}")
+        if self.tls.ktls:
+            _LOGGER.info("Kernel TLS enabled")
+        elif self.config.ktls:
+            _LOGGER.warning(f"Kernel TLS is not available, using userspace TLS: "
+                            f"{self.tls.ktls_unavailable}")
+        if self.control is not None:
+            await self.control.start()
+        handoff_server = None
+        if self.config.handoff_socket:
+            handoff_server = HandoffServer(self.config.handoff_socket)
+            handoff_server.start()
+            loop.add_signal_handler(signal.SIGHUP, self._upgrade_signal)
+        pool_task = loop.create_task(self.pool.run()) if self.pool is not None else None
+        if handoff_conn is not None:
+            # Главным процессом службы становится этот процесс
+            _LOGGER.info("Took over listening socket from previous process")
+            systemd.notify(f"MAINPID={os.getpid()}\nREADY=1")
+            handoff.ready(handoff_conn)
+        else:
+            systemd.notify("READY=1")
+        watchdog_timeout_s = systemd.watchdog_timeout_s()
+        watchdog_task = loop.create_task(systemd.watchdog(watchdog_timeout_s)) \
+            if watchdog_timeout_s else None
+        tune_task = loop.create_task(self.tune_sockets()) if self.config.tcp_tune else None
+        watch_task = loop.create_task(self.watch_peers()) \
+            if self.config.dead_peer_timeout_s else None
+        accept_task = loop.create_task(self.accept_sessions(listen_sock))
+        handoff_task = loop.create_task(handoff_server.wait_takeover(listen_sock)) \
+            if handoff_server is not None else None
+        try:
+            done, _ = await asyncio.wait({task for task in (accept_task, handoff_task) if task},
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+
+            # Слушающий сокет передан новому процессу: он же теперь главный процесс службы,
+            # отвечает на управляющий сокет, пишет захват, держит пул соединений с серверами
+            # и уведомляет watchdog systemd
+            accept_task.cancel()
+            listen_sock.close()
+            handoff_server.close()
+            if pool_task is not None:
+                pool_task.cancel()
+                self.pool.close()
+            if watchdog_task is not None:
+                watchdog_task.cancel()
+            loop.add_signal_handler(signal.SIGHUP, _LOGGER.warning,
+                                    "Listening socket is already handed off")
+            systemd.set_notify_environ(None)
+            if self.control is not None:
+                self.control.close()
+            self.capture.stop()
+            _LOGGER.info(f"Listening socket handed off, waiting for {len(self.tasks)} sessions "
+                         f"to end")
+            while self.tasks:
+                await asyncio.wait(set(self.tasks))
+            _LOGGER.info("All sessions ended, exiting")
+        finally:
+            systemd.notify("STOPPING=1")
+            accept_task.cancel()
+            listen_sock.close()
+            if handoff_task is not None:
+                handoff_task.cancel()
+                handoff_server.close()
+            if self.control is not None:
+                self.control.close()
+            if pool_task is not None:
+                pool_task.cancel()
+            if watchdog_task is not None:
+                watchdog_task.cancel()
+            if tune_task is not None:
+                tune_task.cancel()
+            if watch_task is not None:
+                watch_task.cancel()
+            for tunnel in self.tunnels.values():
+                tunnel.close()
+            for task in self.tasks:
+                task.cancel()
+
+    async def open_upstream(self, loop: asyncio.AbstractEventLoop, target_host: str,
+                            port: Optional[int] = None,
+                            timing: Optional[SessionTiming] = None) -> RelaySocket:
+        server = (target_host, port or self.config.upstream_port)
+        start = time.perf_counter()
+        infos = await self.resolver.resolve(loop, *server)
+        resolved = time.perf_counter()
+        sock = await connect_any(loop, target_host, infos, self.config.connect_stagger_s,
+                                 self.connect_race)
+        configure_socket(sock)
+        if self.config.dead_peer_timeout_s:
+            set_dead_peer_timeout(sock, self.config.dead_peer_timeout_s)
+        connected = time.perf_counter()
+        if timing is not None:
+            timing.add("resolve", start, resolved)
+            timing.add("connect", resolved, connected)
+        if port is None and target_host in self.config.plain_servers:
+            return RelaySocket(sock, loop)
+        try:
+            tls_sock = self.tls.wrap_socket(sock, server)
+        except BaseException:
+            sock.close()
+            raise
+
+        upstream = RelaySocket(tls_sock, loop)
+        try:
+            await upstream.do_handshake()
+        except BaseException as e:
+            self.tls.handshake_failed(server, e)
+            upstream.close()
+            raise
+        handshake_done = time.perf_counter()
+        self.tls.handshake_done(tls_sock, server, handshake_done - connected)
+        if timing is not None:
+            timing.add("handshake", connected, handshake_done)
+        return upstream
+
+    def connect_upstream(self, target_host: str) -> Awaitable[RelaySocket]:
+        """
+        Соединение для пула
+        """
+        return self.open_upstream(asyncio.get_running_loop(), target_host)
+
+    async def get_tunnel(self, loop: asyncio.AbstractEventLoop,
+                         target_host: str) -> TunnelConnection:
+        tunnel = self.tunnels.get(target_host)
+        if tunnel is not None and not tunnel.closed:
+            return tunnel
+        # Сессии, начатые во время подключения, ждут того же соединения
+        connect = self._tunnel_connects.get(target_host)
+        if connect is None:
+            connect = loop.create_task(self._connect_tunnel(loop, target_host))
+            self._tunnel_connects[target_host] = connect
+        return await asyncio.shield(connect)
+
+    async def _connect_tunnel(self, loop: asyncio.AbstractEventLoop,
+                              target_host: str) -> TunnelConnection:
+        try:
+            sock = await self.open_upstream(loop, target_host, self.config.tunnel_port)
+        finally:
+            del self._tunnel_connects[target_host]
+        tunnel = TunnelConnection(sock)
+        tunnel.start()
+        self.tunnels[target_host] = tunnel
+        if self.config.tcp_tune:
+            self.tunnel_tuners[target_host] = BufferTuner()
+        _LOGGER.info(f"Tunnel to {target_host}:{self.config.tunnel_port} opened")
+        return tunnel
+
+    async def acquire_upstream(self, loop: asyncio.AbstractEventLoop, target_host: str,
+                               timing: Optional[SessionTiming] = None) -> Upstream:
+        if self.config.tunnel:
+            return (await self.get_tunnel(loop, target_host)).open_stream()
+        upstream = self.pool.take(target_host) if self.pool is not None else None
+        if upstream is None:
+            if self.config.server_connect_rate > 0:
+                limiter = self.connect_limiters.setdefault(target_host, RateLimiter(
+                    self.config.server_connect_rate, self.config.server_connect_burst))
+                await limiter.acquire(self.config.admission_timeout_s)
+            upstream = await self.open_upstream(loop, target_host, timing=timing)
+        return upstream
+
+    def release_upstream(self, target_host: str, upstream: Upstream):
+        if isinstance(upstream, RelaySocket) and isinstance(upstream.sock, ssl.SSLSocket):
+            self.tls.save_session(upstream.sock, (target_host, self.config.upstream_port))
+        upstream.close()
+
+    async def fetch_devlist(self, target_host: str, request: bytes) -> FetchResult:
+        upstream = await self.acquire_upstream(asyncio.get_running_loop(), target_host)
+        try:
+            await upstream.sendall(request)
+            return await read_devlist_reply(upstream)
+        finally:
+            self.release_upstream(target_host, upstream)
+
+    async def handle_session(self, conn: socket.socket, address: Tuple):
+        try:
+            await self.admission.admit(address[0])
+        except AdmissionRejected as e:
+            _LOGGER.warning(f"Proxy connection from {address[0]} rejected: {e}")
+            conn.close()
+            return
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            await self.run_session(conn, address)
+        finally:
+            self.admission.release(address[0])
+
+    async def run_session(self, conn: socket.socket, address: Tuple):
+        loop = asyncio.get_running_loop()
+        self._last_session_id += 1
+        session = Session(self._last_session_id, RelaySocket(conn, loop), address[0])
+        self.sessions[session.id] = session
+        target_host = None
+
+        _LOGGER.info(f"-------- New proxy connection from {address[0]} --------")
+        try:
+            preamble = await asyncio.wait_for(session.client.recv_exactly(TARGET_HOST_SIZE),
+                                              TARGET_HOST_TIMEOUT_S)
+            if len(preamble) < TARGET_HOST_SIZE:
+                _LOGGER.info("Proxy client disconnected before sending target host")
+                return
+            session.timing.add("preamble", session.timing.started)
+
+            target_host = session.target_host = parse_target_host(preamble)
+            _LOGGER.info(f"proxy_server_address: {target_host}")
+
+            # С кэшем списка устройств прокси читает op_common запроса до подключения к серверу,
+            # а для события session_lost - еще и busid op_req_import
+            first_request = b''
+            if self.devlist_cache is not None or self.config.dead_peer_timeout_s:
+                first_request = await asyncio.wait_for(
+                    session.client.recv_exactly(OP_COMMON.size), TARGET_HOST_TIMEOUT_S)
+                if len(first_request) < OP_COMMON.size:
+                    _LOGGER.info("Proxy client disconnected before sending request")
+                    return
+                code = OP_COMMON.unpack(first_request)[1]
+                if code == OP_REQ_IMPORT:
+                    busid = await asyncio.wait_for(
+                        session.client.recv_exactly(SYSFS_BUS_ID_SIZE), TARGET_HOST_TIMEOUT_S)
+                    session.busid = c_string(busid)
+                    first_request += busid
+                elif code == OP_REQ_DEVLIST and self.devlist_cache is not None:
+                    reply = await self.devlist_cache.get(
+                        target_host, first_request,
+                        lambda: self.fetch_devlist(target_host, first_request))
+                    await session.client.sendall(reply)
+                    _LOGGER.info("Device list sent to proxy client")
+                    return
+
+            session.upstream = await self.acquire_upstream(loop, target_host, session.timing)
+            _LOGGER.info(f"Connected to {target_host}:{self.config.upstream_port}")
+
+            if self.config.qos and isinstance(session.upstream, TunnelStream):
+                session.upstream.classify = SessionQos(track_urbs=False).to_server
+            session.shaper = self.shaping.session(target_host)
+            if self.impairment is not None:
+                seed = self.config.impair_seed
+                session.impairment = SessionImpairment(
+                    self.impairment.copy(), seed + session.id if seed is not None else None)
+            if self.config.tcp_tune and isinstance(session.upstream, RelaySocket):
+                session.tuner = BufferTuner()
+            if self.config.urb_stats or self.capture.enabled:
+                session.monitor = SessionMonitor()
+                self.capture.attach(session.id, session.monitor.parser)
+            if first_request:
+                if session.monitor is not None:
+                    session.monitor.to_server(memoryview(first_request))
+                await session.upstream.sendall(first_request)
+            await self.relay(session)
+
+        except asyncio.TimeoutError:
+            _LOGGER.info("Proxy client did not send target host in time")
+        except UnicodeDecodeError:
+            _LOGGER.info("Proxy client sent bad target host")
+        except socket.gaierror:
+            _LOGGER.info(f"Failed to resolve {target_host} name")
+        except ConnectionRefusedError:
+            _LOGGER.info(f"Failed to connect to {target_host}:{self.config.upstream_port}. "
+                         f"Check if usbipd daemon running on target host")
+        except ssl.SSLError as e:
+            _LOGGER.info(f"TLS error with {target_host}: {e}")
+        except ProtocolError as e:
+            _LOGGER.info(f"Bad device list reply from {target_host}: {e}")
+        except AdmissionRejected as e:
+            _LOGGER.warning(f"Connection to {target_host} rejected: {e}")
+        except OSError as e:
+            _LOGGER.info(f"Connection error with {target_host}: {e}")
+        finally:
+            self.close_session(session)
+            _LOGGER.info(f"XXXXXXXX Connection with {target_host} closed XXXXXXXX")
+
+    def close_session(self, session: Session):
+        del self.sessions[session.id]
+        session.client.close()
+        if session.upstream is not None:
+            self.release_upstream(session.target_host, session.upstream)
+        if session.monitor is not None:
+            self.capture.detach(session.id)
+            self.server_urb_stats.setdefault(session.target_host, UrbStats()).merge(
+                session.monitor.stats)
+        if session.target_host is not None:
+            session.timing.finish()
+            self.server_timings.setdefault(session.target_host, ServerTimings()).add(
+                session.timing)
+            _LOGGER.debug(f"Session timing: {session.timing.to_dict()}")
+
+    def can_splice(self, session: Session) -> bool:
+        """
+        splice работает только с обычными сокетами, а разбор URB и эмуляция сети требуют данных
+        в Python
+        """
+        upstream = session.upstream
+        return self.config.splice and HAVE_SPLICE and session.monitor is None and \
+            session.impairment is None and \
+            isinstance(upstream, RelaySocket) and not isinstance(upstream.sock, ssl.SSLSocket)
+
+    def can_splice_to_server(self, session: Session) -> bool:
+        """
+        Записи, отправляемые серверу через kTLS, шифрует ядро, поэтому данные клиента можно
+        передавать в TLS-соединение через splice, как в обычное. Прием остается за OpenSSL:
+        кроме данных сервер присылает служебные записи (тикеты сессий)
+        """
+        upstream = session.upstream
+        return self.tls.ktls and self.config.splice and HAVE_SPLICE and \
+            session.monitor is None and session.impairment is None and \
+            not self.config.coalesce and \
+            isinstance(upstream, RelaySocket) and isinstance(upstream.sock, ssl.SSLSocket) and \
+            ktls_active(upstream.sock, TLS_TX)
+
+    async def relay(self, session: Session):
+        loop = asyncio.get_running_loop()
+        client, upstream = session.client, session.upstream
+        monitor = session.monitor
+        relay_started = time.perf_counter()
+
+        def on_first_upstream_data():
+            session.timing.add("first_byte", relay_started)
+
+        buffers = []
+        writer = None
+        shaper = session.shaper
+        impairment = session.impairment
+        client_dst: Union[RelaySocket, ImpairedWriter] = client
+        upstream_dst: Union[Upstream, ImpairedWriter] = upstream
+        if impairment is not None:
+            client_dst = impairment.to_client = ImpairedWriter(client, impairment.impairment,
+                                                               impairment.rng)
+            upstream_dst = impairment.to_server = ImpairedWriter(upstream, impairment.impairment,
+                                                                 impairment.rng)
+        if self.can_splice(session):
+            to_server = loop.create_task(splice_pump(client, upstream,
+                                                     throttle=shaper.to_server))
+            to_client = loop.create_task(splice_pump(upstream, client,
+                                                     on_first_data=on_first_upstream_data,
+                                                     throttle=shaper.to_client))
+        else:
+            # Каждое направление пересылает данные через свой буфер и не читает следующую
+            # порцию, пока не отправит предыдущую. Так медленная сторона тормозит быструю,
+            # а память на сессию ограничена двумя буферами
+            buffers = [self.buffers.acquire()]
+            to_client = loop.create_task(pump(
+                upstream, client_dst, buffers[0], monitor.to_client if monitor else None,
+                on_first_upstream_data, shaper.to_client))
+            if self.can_splice_to_server(session):
+                to_server = loop.create_task(splice_pump(client, upstream,
+                                                         throttle=shaper.to_server))
+            else:
+                buffers.append(self.buffers.acquire())
+                if self.config.coalesce and isinstance(upstream, RelaySocket):
+                    writer = CoalescingWriter(upstream_dst, self.config.coalesce_size,
+                                              self.config.coalesce_delay_us / 1e6,
+                                              self.coalesce_stats)
+                to_server = loop.create_task(pump(
+                    client, writer or upstream_dst, buffers[1],
+                    monitor.to_server if monitor else None, throttle=shaper.to_server))
+        lost = loop.create_task(session.lost.wait())
+        try:
+            done, _ = await asyncio.wait((to_server, to_client, lost),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if to_server in done and to_server.exception() is None:
+                # Клиент закрыл соединение, но накопленные PDU все равно нужны серверу
+                if writer is not None:
+                    await writer.flush()
+                if impairment is not None:
+                    await impairment.to_server.flush()
+            elif to_client in done and to_client.exception() is None and impairment is not None:
+                await impairment.to_client.flush()
+        finally:
+            to_server.cancel()
+            to_client.cancel()
+            lost.cancel()
+            await asyncio.gather(to_server, to_client, lost, return_exceptions=True)
+            if writer is not None:
+                writer.close()
+            if impairment is not None:
+                impairment.to_server.close()
+                impairment.to_client.close()
+            for buffer in buffers:
+                self.buffers.release(buffer)
+
+        if lost in done:
+            self.report_lost(session, session.lost_reason)
+            return
+        if isinstance(upstream, RelaySocket) and connection_aborted(upstream.sock):
+            # Через TLS ошибка сокета обычно выглядит как конец данных
+            errors = [str(task.exception()) for task in done if task.exception() is not None]
+            self.report_lost(session, errors[0] if errors else "Connection aborted")
+            return
+        if isinstance(upstream, TunnelStream) and upstream.tunnel.closed:
+            self.report_lost(session, "Tunnel connection closed")
+            return
+        for task in done:
+            # Пробрасывает ошибку сокета, если она была
+            task.result()
+
+        if to_server in done:
+            _LOGGER.info("Proxy client disconnected")
+        else:
+            _LOGGER.info("Proxy server disconnected")
+
+
+def server_run(config: ProxyConfig):
+    asyncio.run(ProxyServer(config).serve_forever())
@@ -0,0 +1,32 @@
+from typing import List
+
+
+class BufferPool:
+    """
+    Пул буферов для пересылки данных между сокетами сессии.
+    Заранее выделяет preallocated буферов одним блоком памяти. Если пул пуст, выделяет новый
+    буфер, который после release тоже остается в пуле
+    """
+    def __init__(self, buffer_size: int, preallocated: int):
+        self.buffer_size = buffer_size
+        self.allocated = preallocated
+        memory = memoryview(bytearray(buffer_size * preallocated))
+        self._free: List[memoryview] = [memory[i * buffer_size:(i + 1) * buffer_size]
+                                        for i in range(preallocated)]
+
+    @property
+    def in_use(self) -> int:
+        return self.allocated - len(self._free)
+
+    @property
+    def memory_in_use(self) -> int:
+        return self.in_use * self.buffer_size
+
+    def acquire(self) -> memoryview:
+        if self._free:
+            return self._free.pop()
+        self.allocated += 1
+        return memoryview(bytearray(self.buffer_size))
+
+    def release(self, buffer: memoryview):
+        self._free.append(buffer)
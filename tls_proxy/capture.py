@@ -0,0 +1,289 @@
+"""
+Захват PDU USB/IP, которые пересылает прокси, в кольцевой файл фиксированного размера,
+отображенный в память (mmap). Каждая запись - время, номер сессии, направление, полный размер
+PDU, заголовок PDU и первые snaplen байт данных. Новые записи вытесняют самые старые.
+Перед кольцом лежит индекс: смещение каждой записи в слоте (номер записи) % (число слотов),
+поэтому читатели находят записи без прохода по кольцу.
+Захват включается и выключается командой capture (tls_proxy.control) и работает для сессий,
+начатых при включенном захвате, и сессий с --urb-stats. Без захвата сессии не разбираются.
+
+python3 -m tls_proxy.capture export /run/usbip2/tls_proxy.capture trace.pcap
+"""
+from typing import BinaryIO, Dict, Iterator, NamedTuple, Optional
+import argparse
+import struct
+import mmap
+import json
+import time
+import os
+
+from tls_proxy.config import CAPTURE_SIZE, CAPTURE_SNAPLEN, USBIP_SERVER_PORT
+from tls_proxy.protocol import UsbipStreamParser
+
+
+CAPTURE_MAGIC = b"USBIPCAP"
+CAPTURE_VERSION = 2
+# magic, version, размер кольца, head, tail, записей в кольце, записано всего, вытеснено
+CAPTURE_HEADER = struct.Struct("<8sIIQQQQQ")
+CAPTURE_HEADER_SIZE = 64
+# размер записи, время (нс с начала эпохи), сессия, направление, полный размер PDU
+RECORD = struct.Struct("<IQIB3xI")
+# Слот индекса - смещение записи от начала кольца
+RECORD_INDEX = struct.Struct("<I")
+
+TO_SERVER = 0
+TO_CLIENT = 1
+DIRECTION_NAMES = {TO_SERVER: "to_server", TO_CLIENT: "to_client"}
+
+
+def index_slots(size: int) -> int:
+    """
+    Записи не короче RECORD, поэтому в кольце их не больше, чем слотов индекса
+    """
+    return size // RECORD.size
+
+
+def ring_offset(size: int) -> int:
+    """
+    Смещение кольца в файле: после заголовка и индекса
+    """
+    return CAPTURE_HEADER_SIZE + index_slots(size) * RECORD_INDEX.size
+
+
+class CaptureRecord(NamedTuple):
+    timestamp_ns: int
+    session: int
+    direction: int
+    length: int
+    data: bytes
+
+
+class CaptureRing:
+    """
+    Записи не разрезаются концом кольца: запись, которая не помещается в конец, пишется
+    с начала. Перед записью вытесняются старые записи, которые она перекрывает
+    """
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.slots = index_slots(size)
+        self.offset = ring_offset(size)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self.offset + size)
+            self._mmap = mmap.mmap(fd, self.offset + size)
+        finally:
+            os.close(fd)
+        self.head = 0
+        self.tail = 0
+        self.records = 0
+        self.written = 0
+        self.overwritten = 0
+        self._write_header()
+
+    def _write_header(self):
+        CAPTURE_HEADER.pack_into(self._mmap, 0, CAPTURE_MAGIC, CAPTURE_VERSION, self.size,
+                                 self.head, self.tail, self.records, self.written,
+                                 self.overwritten)
+
+    def write(self, session: int, direction: int, data: bytes, length: int):
+        record_size = RECORD.size + len(data)
+        if record_size > self.size:
+            return
+        if self.head + record_size > self.size:
+            # Записи между head и концом кольца вытесняются раньше записей в начале
+            while self.records and self.tail >= self.head:
+                self._drop_oldest()
+            self.head = 0
+        while self.records and self.head <= self.tail < self.head + record_size:
+            self._drop_oldest()
+        if not self.records:
+            self.tail = self.head
+
+        offset = self.offset + self.head
+        RECORD.pack_into(self._mmap, offset, record_size, time.time_ns(), session, direction,
+                         length)
+        self._mmap[offset + RECORD.size:offset + record_size] = data
+        RECORD_INDEX.pack_into(self._mmap, self._slot(self.written), self.head)
+        self.head += record_size
+        self.records += 1
+        self.written += 1
+        self._write_header()
+
+    def _slot(self, number: int) -> int:
+        return CAPTURE_HEADER_SIZE + number % self.slots * RECORD_INDEX.size
+
+    def _drop_oldest(self):
+        self.records -= 1
+        self.overwritten += 1
+        if self.records:
+            self.tail = RECORD_INDEX.unpack_from(
+                self._mmap, self._slot(self.written - self.records))[0]
+
+    def close(self):
+        self._mmap.close()
+
+
+def read_ring(path: str) -> Iterator[CaptureRecord]:
+    """
+    Записи кольцевого файла от старых к новым
+    """
+    with open(path, "rb") as ring_file:
+        data = mmap.mmap(ring_file.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        magic, version, size, _, _, records, written, _ = CAPTURE_HEADER.unpack_from(data, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError(f"{path} is not a tls_proxy capture file")
+        slots = index_slots(size)
+        for number in range(written - records, written):
+            position = RECORD_INDEX.unpack_from(
+                data, CAPTURE_HEADER_SIZE + number % slots * RECORD_INDEX.size)[0]
+            offset = ring_offset(size) + position
+            record_size, timestamp_ns, session, direction, length = \
+                RECORD.unpack_from(data, offset)
+            yield CaptureRecord(timestamp_ns, session, direction, length,
+                                data[offset + RECORD.size:offset + record_size])
+
+
+def export_jsonl(records: Iterator[CaptureRecord], out: BinaryIO):
+    for record in records:
+        out.write(json.dumps({
+            "ts": record.timestamp_ns / 1e9,
+            "session": record.session,
+            "direction": DIRECTION_NAMES[record.direction],
+            "length": record.length,
+            "data": record.data.hex(),
+        }).encode() + b'\n')
+
+
+# Заголовок файла pcap и пакета, пакеты - IPv4 без канального уровня (LINKTYPE_RAW)
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_PACKET = struct.Struct("<IIII")
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_RAW = 101
+IPV4_HEADER = struct.Struct(">BBHHHBBH4s4s")
+TCP_HEADER = struct.Struct(">HHIIBBHHH")
+IP_TCP_HEADERS_SIZE = IPV4_HEADER.size + TCP_HEADER.size
+CLIENT_ADDRESS = bytes([10, 0, 0, 1])
+SERVER_ADDRESS = bytes([10, 0, 0, 2])
+TCP_FLAGS_PSH_ACK = 0x18
+
+
+def export_pcap(records: Iterator[CaptureRecord], out: BinaryIO):
+    """
+    Каждая сессия - TCP-соединение 10.0.0.1:(сессия) - 10.0.0.2:3240, чтобы Wireshark
+    разбирал PDU дисектором usbip. Обрезанные PDU сохраняются с полной исходной длиной пакета
+    """
+    out.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, 0xffff, LINKTYPE_RAW))
+    # (сессия, направление) -> номер последовательности TCP
+    sequences: Dict[tuple, int] = {}
+    for record in records:
+        client_port = 1024 + record.session % 64512
+        to_server = record.direction == TO_SERVER
+        key = (record.session, record.direction)
+        seq = sequences.get(key, 1)
+        sequences[key] = (seq + record.length) & 0xffffffff
+        ack = sequences.get((record.session, TO_CLIENT if to_server else TO_SERVER), 1)
+
+        src, dst = (CLIENT_ADDRESS, SERVER_ADDRESS) if to_server else \
+            (SERVER_ADDRESS, CLIENT_ADDRESS)
+        src_port, dst_port = (client_port, USBIP_SERVER_PORT) if to_server else \
+            (USBIP_SERVER_PORT, client_port)
+        # Для PDU больше 64 КиБ длина 0, как в дампах пакетов TSO
+        total_length = IP_TCP_HEADERS_SIZE + record.length
+        total_length = total_length if total_length <= 0xffff else 0
+        headers = IPV4_HEADER.pack(0x45, 0, total_length, 0, 0, 64, 6, 0, src, dst) + \
+            TCP_HEADER.pack(src_port, dst_port, seq, ack, 5 << 4, TCP_FLAGS_PSH_ACK, 0xffff, 0, 0)
+
+        seconds, nanoseconds = divmod(record.timestamp_ns, 1000000000)
+        out.write(PCAP_PACKET.pack(seconds, nanoseconds // 1000,
+                                   IP_TCP_HEADERS_SIZE + len(record.data),
+                                   IP_TCP_HEADERS_SIZE + record.length))
+        out.write(headers)
+        out.write(record.data)
+
+
+EXPORT_FORMATS = {
+    "pcap": export_pcap,
+    "jsonl": export_jsonl,
+}
+
+
+class Capture:
+    """
+    Включение захвата и подключение к нему разборщиков сессий
+    """
+    def __init__(self):
+        self.ring: Optional[CaptureRing] = None
+        self.snaplen = CAPTURE_SNAPLEN
+        self._parsers: Dict[int, UsbipStreamParser] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ring is not None
+
+    def start(self, path: str, size: int = CAPTURE_SIZE, snaplen: int = CAPTURE_SNAPLEN):
+        self.stop()
+        self.ring = CaptureRing(path, size)
+        self.snaplen = snaplen
+        for session, parser in self._parsers.items():
+            self._tap(session, parser)
+
+    def stop(self):
+        if self.ring is None:
+            return
+        for parser in self._parsers.values():
+            parser.to_server.on_record = None
+            parser.to_client.on_record = None
+        self.ring.close()
+        self.ring = None
+
+    def attach(self, session: int, parser: UsbipStreamParser):
+        self._parsers[session] = parser
+        if self.ring is not None:
+            self._tap(session, parser)
+
+    def detach(self, session: int):
+        self._parsers.pop(session, None)
+
+    def _tap(self, session: int, parser: UsbipStreamParser):
+        ring = self.ring
+        for framer, direction in ((parser.to_server, TO_SERVER), (parser.to_client, TO_CLIENT)):
+            framer.snaplen = self.snaplen
+            framer.on_record = \
+                lambda data, length, direction=direction: ring.write(session, direction, data,
+                                                                     length)
+
+    def to_dict(self) -> dict:
+        if self.ring is None:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "path": self.ring.path,
+            "size": self.ring.size,
+            "snaplen": self.snaplen,
+            "sessions": len(self._parsers),
+            "records": self.ring.records,
+            "written": self.ring.written,
+            "overwritten": self.ring.overwritten,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export tls_proxy capture ring")
+    parser.add_argument('command', choices=["export"])
+    parser.add_argument('ring', help='Capture ring file')
+    parser.add_argument('output', help='Output file')
+    parser.add_argument('--format', choices=EXPORT_FORMATS.keys(), default=None,
+                        help='Output format, by default from output file extension')
+    args = parser.parse_args()
+
+    export_format = args.format or os.path.splitext(args.output)[1].lstrip(".")
+    if export_format not in EXPORT_FORMATS:
+        parser.error(f"Unknown output format {export_format}, use --format")
+    with open(args.output, "wb") as out:
+        EXPORT_FORMATS[export_format](read_ring(args.ring), out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Профили шифров соединений с серверами. Модуль ssl не умеет менять набор шифров TLS 1.3
+(порядок OpenSSL по умолчанию - сначала AES-GCM), поэтому профиль chacha20 - это TLS 1.2
+с ECDHE и ChaCha20-Poly1305. Профиль auto один раз при запуске измеряет скорость шифрования
+AES-GCM и ChaCha20-Poly1305 через libcrypto и выбирает быстрый: без AES-NI и на многих ARM
+ChaCha20 в несколько раз быстрее. chacha20 ограничивает соединения TLS 1.2, поэтому auto
+выбирает его, только если это явно разрешено, иначе остается профиль по умолчанию
+"""
+from typing import Dict, Optional, Tuple
+import ctypes.util
+import ctypes
+import time
+import ssl
+
+
+# Шифры TLS 1.2 профилей, TLS 1.3 остается с набором OpenSSL
+PROFILE_CIPHERS = {
+    "aes-gcm": "ECDHE+AESGCM",
+    "chacha20": "ECDHE+CHACHA20",
+}
+# Шифры libcrypto, которые сравнивает auto: TLS_AES_256_GCM_SHA384 - первый шифр TLS 1.3
+BENCHMARK_CIPHERS = {
+    "aes-gcm": b"aes-256-gcm",
+    "chacha20": b"chacha20-poly1305",
+}
+# Размер записи TLS
+BENCHMARK_RECORD_SIZE = 16384
+BENCHMARK_TIME_S = 0.05
+
+
+def apply_profile(context: ssl.SSLContext, profile: str):
+    if profile == "tls13":
+        context.minimum_version = ssl.TLSVersion.TLSv1_3
+    elif profile == "chacha20":
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers(PROFILE_CIPHERS[profile])
+    elif profile == "aes-gcm":
+        context.set_ciphers(PROFILE_CIPHERS[profile])
+
+
+def _load_libcrypto() -> ctypes.CDLL:
+    for name in (ctypes.util.find_library("crypto"), "libcrypto.so.3", "libcrypto.so.1.1"):
+        if not name:
+            continue
+        try:
+            return ctypes.CDLL(name)
+        except OSError:
+            continue
+    raise OSError("libcrypto not found")
+
+
+def _encrypt_rate(libcrypto: ctypes.CDLL, name: bytes) -> float:
+    """
+    Байт в секунду при шифровании записей BENCHMARK_RECORD_SIZE байт, каждой со своим nonce,
+    как в TLS
+    """
+    libcrypto.EVP_get_cipherbyname.restype = ctypes.c_void_p
+    libcrypto.EVP_get_cipherbyname.argtypes = [ctypes.c_char_p]
+    libcrypto.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+    libcrypto.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+    libcrypto.EVP_EncryptInit_ex.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                                             ctypes.c_char_p, ctypes.c_char_p]
+    libcrypto.EVP_EncryptUpdate.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                            ctypes.POINTER(ctypes.c_int), ctypes.c_char_p,
+                                            ctypes.c_int]
+    libcrypto.EVP_EncryptFinal_ex.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                              ctypes.POINTER(ctypes.c_int)]
+    cipher = libcrypto.EVP_get_cipherbyname(name)
+    if not cipher:
+        raise OSError(f"{name.decode()} is not supported by libcrypto")
+    ctx = libcrypto.EVP_CIPHER_CTX_new()
+    if not ctx:
+        raise MemoryError()
+    key = bytes(32)
+    data = bytes(BENCHMARK_RECORD_SIZE)
+    out = ctypes.create_string_buffer(BENCHMARK_RECORD_SIZE + 64)
+    out_size = ctypes.c_int()
+    try:
+        if not libcrypto.EVP_EncryptInit_ex(ctx, cipher, None, key, None):
+            raise OSError(f"Failed to init {name.decode()}")
+        records = 0
+        start = time.perf_counter()
+        elapsed = 0.
+        while elapsed < BENCHMARK_TIME_S:
+            nonce = records.to_bytes(12, "big")
+            if not (libcrypto.EVP_EncryptInit_ex(ctx, None, None, None, nonce) and
+                    libcrypto.EVP_EncryptUpdate(ctx, out, ctypes.byref(out_size), data,
+                                                len(data)) and
+                    libcrypto.EVP_EncryptFinal_ex(ctx, out, ctypes.byref(out_size))):
+                raise OSError(f"{name.decode()} encryption failed")
+            records += 1
+            elapsed = time.perf_counter() - start
+    finally:
+        libcrypto.EVP_CIPHER_CTX_free(ctx)
+    return records * BENCHMARK_RECORD_SIZE / elapsed
+
+
+def measure_ciphers() -> Dict[str, float]:
+    """
+    Скорость шифрования профилей из BENCHMARK_CIPHERS в байтах в секунду
+    """
+    libcrypto = _load_libcrypto()
+    return {profile: _encrypt_rate(libcrypto, name)
+            for profile, name in BENCHMARK_CIPHERS.items()}
+
+
+def select_profile(allow_tls12: bool = False) -> Tuple[str, Dict[str, float], Optional[str]]:
+    """
+    Профиль для auto, измеренные скорости и ошибка измерения. Если измерить не удалось или
+    быстрее chacha20, а allow_tls12 не задан, остается профиль по умолчанию
+    """
+    try:
+        rates = measure_ciphers()
+    except (OSError, AttributeError, MemoryError) as e:
+        return "default", {}, str(e)
+    profile = max(rates, key=rates.__getitem__)
+    if profile == "chacha20" and not allow_tls12:
+        profile = "default"
+    return profile, rates, None
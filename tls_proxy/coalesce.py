@@ -0,0 +1,134 @@
+"""
+Объединение PDU, которые клиент отправляет серверу, в одну запись в TLS-соединение. Вместо
+записи каждой прочитанной у клиента порции (а значит, отдельной записи TLS и системного вызова)
+CoalescingWriter копит целые PDU, пока их не наберется size байт или не пройдет delay_s
+с первого накопленного байта. PDU control, прерываний и изохронных передач (tls_proxy.qos)
+отправляются сразу вместе с накопленными, как и все данные до импорта устройства
+"""
+from typing import Any, Optional
+import logging
+import asyncio
+
+from tls_proxy.protocol import UrbObserver, UsbipStreamParser
+from tls_proxy.qos import QOS_BULK, urb_class
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+class CoalesceStats:
+    """
+    Общая для всех сессий: сколько порций записано и сколькими записями, и почему
+    """
+    def __init__(self):
+        self.chunks = 0
+        self.writes = 0
+        self.bytes = 0
+        self.size_flushes = 0
+        self.deadline_flushes = 0
+        self.urgent_flushes = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "chunks": self.chunks,
+            "writes": self.writes,
+            "bytes": self.bytes,
+            "size_flushes": self.size_flushes,
+            "deadline_flushes": self.deadline_flushes,
+            "urgent_flushes": self.urgent_flushes,
+        }
+
+
+class CoalescingWriter(UrbObserver):
+    """
+    Заменяет соединение с сервером в pump: повторяет его sendall. delay_s 0 - данные
+    отправляются, когда цикл событий обработает все готовые события. Задержки короче
+    миллисекунды округляются циклом событий до миллисекунды
+    """
+    def __init__(self, dst: Any, size: int, delay_s: float, stats: CoalesceStats):
+        self.dst = dst
+        self.size = size
+        self.delay_s = delay_s
+        self.stats = stats
+        # Ответы сервера идут мимо, запомненные URB никогда бы не удалялись
+        self.parser = UsbipStreamParser(self, track_urbs=False)
+        self._buffer = bytearray()
+        self._urgent = False
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Handle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def submit(self, seqnum: int, devid: int, direction: int, ep: int, length: int,
+               number_of_packets: int, interval: int) -> Any:
+        if urb_class(ep, number_of_packets, interval) != QOS_BULK:
+            self._urgent = True
+        return None
+
+    def unlink(self, seqnum: int, unlink_seqnum: int):
+        self._urgent = True
+
+    def _complete(self) -> int:
+        """
+        Сколько накопленных байт составляют целые PDU
+        """
+        framer = self.parser.to_server
+        return max(0, len(self._buffer) - (framer.position - framer.record_end))
+
+    async def sendall(self, data: memoryview):
+        # После OP_REQ_IMPORT с busid клиент отправляет только URB, ответ сервера writer не видит
+        self._urgent = self.parser.busid is None
+        self.parser.feed_to_server(data)
+        self._buffer += data
+        self.stats.chunks += 1
+        if self._urgent or not self.parser.to_server.need:
+            self.stats.urgent_flushes += 1
+            await self._write(len(self._buffer))
+        elif len(self._buffer) >= self.size:
+            self.stats.size_flushes += 1
+            await self._write(self._complete() or len(self._buffer))
+        if self._buffer and self._timer is None:
+            loop = asyncio.get_running_loop()
+            if self.delay_s:
+                self._timer = loop.call_later(self.delay_s, self._deadline)
+            else:
+                self._timer = loop.call_soon(self._deadline)
+
+    def _deadline(self):
+        self._timer = None
+        if self._buffer and (self._flush_task is None or self._flush_task.done()):
+            self.stats.deadline_flushes += 1
+            self._flush_task = asyncio.get_running_loop().create_task(self._deadline_flush())
+
+    async def _deadline_flush(self):
+        try:
+            await self.flush()
+        except OSError as e:
+            # Ошибку соединения получит и пересылка в обратном направлении
+            _LOGGER.debug(f"Coalesced write failed: {e}")
+
+    async def _write(self, size: int):
+        """
+        Записи идут по очереди, каждая забирает начало буфера, поэтому порядок данных
+        сохраняется
+        """
+        async with self._lock:
+            size = min(size, len(self._buffer))
+            if not size:
+                return
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self.stats.writes += 1
+            self.stats.bytes += size
+            await self.dst.sendall(data)
+
+    async def flush(self):
+        while self._buffer:
+            await self._write(len(self._buffer))
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
@@ -0,0 +1,173 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+PROXY_ADDRESS = "localhost"
+PROXY_PORT = 3241
+LISTEN_BACKLOG = 1024
+USBIP_SERVER_PORT = 3240
+# Порт tls_proxy.tunnel_server на сервере
+TUNNEL_PORT = 3242
+CONTROL_SOCKET_PATH = "/run/usbip2/tls_proxy.sock"
+HANDOFF_SOCKET_PATH = "/run/usbip2/tls_proxy.handoff"
+# Файл настроек autoredir со списком серверов
+SERVERS_FILE_PATH = "/etc/usbip2/settings.ini"
+
+# MAX_TARGET_HOST_SIZE из usbip/src/usbip_network.h
+TARGET_HOST_SIZE = 20
+TARGET_HOST_TIMEOUT_S = 10.
+
+# Сессия использует два буфера, по одному на направление
+RELAY_BUFFER_SIZE = 4096 * 4
+PREALLOCATED_BUFFERS = 64
+
+# Время жизни адресов серверов и ошибок разрешения имен в кэше (tls_proxy.resolver)
+DNS_CACHE_TTL_S = 30.
+DNS_NEGATIVE_TTL_S = 5.
+# Задержка между попытками подключения к разным адресам сервера (RFC 8305)
+CONNECT_STAGGER_S = 0.25
+
+# Сессии сверх ограничения ждут в очереди не дольше ADMISSION_TIMEOUT_S (tls_proxy.admission)
+ADMISSION_QUEUE_SIZE = 256
+ADMISSION_TIMEOUT_S = 5.
+SERVER_CONNECT_BURST = 10
+# Сколько байт сессия или сервер может передать подряд сверх ограничения скорости
+# (tls_proxy.shaping)
+RATE_LIMIT_BURST = 256 * 1024
+
+# Профили шифров соединений с серверами (tls_proxy.ciphers): auto выбирает быстрый из aes-gcm
+# и chacha20, tls13 - только TLS 1.3
+CIPHER_PROFILES = ("default", "auto", "aes-gcm", "chacha20", "tls13")
+
+# Объединение PDU клиента в записи TLS (tls_proxy.coalesce): размер записи и сколько ждать
+# следующих PDU
+COALESCE_SIZE = 16384
+COALESCE_DELAY_US = 200
+
+# Как часто подстраивать буферы соединений с серверами под BDP (tls_proxy.tcp_info)
+TCP_TUNE_INTERVAL_S = 1.
+
+# Сколько держать неиспользуемое соединение из пула (tls_proxy.upstream_pool)
+POOL_IDLE_TIMEOUT_S = 60.
+
+# Кольцевой файл захвата PDU (tls_proxy.capture) и сколько байт данных PDU в нем сохранять
+CAPTURE_PATH = "/run/usbip2/tls_proxy.capture"
+CAPTURE_SIZE = 64 * 1024 * 1024
+CAPTURE_SNAPLEN = 256
+
+
+@dataclass
+class ProxyConfig:
+    address: str = PROXY_ADDRESS
+    port: int = PROXY_PORT
+    upstream_port: int = USBIP_SERVER_PORT
+    # Если None, сертификат сервера проверяется системными сертификатами
+    ca_file: Optional[str] = None
+    buffer_size: int = RELAY_BUFFER_SIZE
+    preallocated_buffers: int = PREALLOCATED_BUFFERS
+    # unix-сокет для запроса статистики и управления (tls_proxy.control)
+    control_socket: Optional[str] = None
+    # Разбирать URB в сессиях и собирать статистику задержек (tls_proxy.urb_stats)
+    urb_stats: bool = False
+    # Число процессов прокси (tls_proxy.workers), 0 - без супервизора
+    workers: int = 0
+    # Привязать каждый процесс к своему ядру
+    cpu_affinity: bool = False
+    reuse_port: bool = False
+    # Слушающий сокет, переданный systemd (tls_proxy.systemd), вместо address:port
+    listen_fd: Optional[int] = None
+    # unix-сокет для передачи слушающего сокета новому процессу (tls_proxy.handoff)
+    handoff_socket: Optional[str] = None
+    # Забрать слушающий сокет у процесса, работающего с тем же handoff_socket
+    takeover: bool = False
+    # Число готовых TLS-соединений с каждым сервером из servers_file, 0 - без пула
+    pool_size: int = 0
+    pool_idle_timeout_s: float = POOL_IDLE_TIMEOUT_S
+    servers_file: str = SERVERS_FILE_PATH
+    # Время жизни ответов на OP_REQ_DEVLIST в кэше (tls_proxy.devlist_cache), 0 - без кэша
+    devlist_cache_ttl_s: float = 0.
+    # Передавать все сессии с сервером через одно соединение с tls_proxy.tunnel_server
+    tunnel: bool = False
+    tunnel_port: int = TUNNEL_PORT
+    # Сертификат и ключ клиента, которые проверяет tls_proxy.tunnel_server
+    tunnel_cert_file: Optional[str] = None
+    tunnel_key_file: Optional[str] = None
+    # Отправлять PDU прерываний и изохронных передач в туннель раньше bulk (tls_proxy.qos)
+    qos: bool = False
+    # Серверы, с которыми прокси соединяется без TLS (usbipd без шифрования в доверенной сети)
+    plain_servers: List[str] = field(default_factory=list)
+    # Пересылать данные сессий с plain_servers через splice, не копируя их в Python
+    splice: bool = True
+    # Профиль шифров соединений с серверами (CIPHER_PROFILES)
+    cipher_profile: str = "default"
+    # Профиль auto может выбрать chacha20, который ограничивает соединения TLS 1.2
+    cipher_allow_tls12: bool = False
+    # Шифровать записи TLS соединений с серверами в ядре (kTLS), если его поддерживают
+    # Python, OpenSSL и ядро
+    ktls: bool = False
+    # Объединять PDU клиента в одну запись в соединение с сервером (tls_proxy.coalesce)
+    coalesce: bool = False
+    coalesce_size: int = COALESCE_SIZE
+    coalesce_delay_us: int = COALESCE_DELAY_US
+    # Подстраивать SO_SNDBUF, SO_RCVBUF и TCP_NOTSENT_LOWAT соединений с серверами под BDP
+    tcp_tune: bool = False
+    # Через сколько секунд без данных и подтверждений от сервера сессия считается потерянной,
+    # 0 - только по ошибке сокета
+    dead_peer_timeout_s: float = 0.
+    # Только для тестов: эмуляция глобальной сети на пути пересылки (tls_proxy.impair) -
+    # задержка в одном направлении, ее разброс, пропускная способность и вероятность потери
+    impair: bool = False
+    impair_delay_ms: float = 0.
+    impair_jitter_ms: float = 0.
+    impair_rate: float = 0.
+    impair_loss: float = 0.
+    # Сессия N использует генератор случайных чисел с seed + N
+    impair_seed: Optional[int] = None
+    dns_cache_ttl_s: float = DNS_CACHE_TTL_S
+    dns_negative_ttl_s: float = DNS_NEGATIVE_TTL_S
+    connect_stagger_s: float = CONNECT_STAGGER_S
+    # Ограничения нагрузки, 0 - без ограничения
+    max_sessions: int = 0
+    max_client_sessions: int = 0
+    # Память буферов всех сессий в байтах, уменьшает max_sessions
+    memory_budget: int = 0
+    admission_queue: int = ADMISSION_QUEUE_SIZE
+    admission_timeout_s: float = ADMISSION_TIMEOUT_S
+    # Новых соединений с одним сервером в секунду
+    server_connect_rate: float = 0.
+    server_connect_burst: int = SERVER_CONNECT_BURST
+    # Байт в секунду в каждом направлении для одной сессии и для всех сессий с одним сервером
+    # (tls_proxy.shaping), меняются командой rate_limits
+    session_rate_limit: float = 0.
+    server_rate_limit: float = 0.
+    rate_limit_burst: int = RATE_LIMIT_BURST
+    # Захватывать PDU сессий в этот файл с запуска, без него захват включается командой capture
+    capture_path: Optional[str] = None
+    capture_size: int = CAPTURE_SIZE
+    capture_snaplen: int = CAPTURE_SNAPLEN
+
+
+# Сертификаты usbipd2 (usbip/libsrc/ssl_utils.c, debian/usbip-server.postinst)
+SERVER_CERT_FILE = "/etc/ssl/certs/usbip.pem"
+SERVER_KEY_FILE = "/etc/ssl/private/usbip.key"
+SERVER_CA_FILE = "/etc/ssl/certs/usbip_ca.pem"
+TUNNEL_SERVER_ADDRESS = "0.0.0.0"
+
+
+@dataclass
+class TunnelServerConfig:
+    address: str = TUNNEL_SERVER_ADDRESS
+    port: int = TUNNEL_PORT
+    cert_file: str = SERVER_CERT_FILE
+    key_file: str = SERVER_KEY_FILE
+    # CA сертификатов клиентов. Потоки туннеля приходят к usbipd2 с 127.0.0.1, и его проверка
+    # адреса клиента (libwrap) их не отличает, поэтому клиенты туннеля проверяются по сертификату
+    client_ca_file: str = SERVER_CA_FILE
+    # Локальный usbipd2, которому передаются потоки туннеля
+    usbipd_address: str = "localhost"
+    usbipd_port: int = USBIP_SERVER_PORT
+    usbipd_ca_file: Optional[str] = SERVER_CA_FILE
+    buffer_size: int = RELAY_BUFFER_SIZE
+    preallocated_buffers: int = PREALLOCATED_BUFFERS
+    # Отправлять PDU прерываний и изохронных передач в туннель раньше bulk (tls_proxy.qos)
+    qos: bool = False
@@ -0,0 +1,122 @@
+"""
+Управление работающим tls_proxy через unix-сокет.
+Запрос - одна строка JSON вида {"command": "stats", ...параметры}, ответ - одна строка JSON
+{"ok": true, "result": ...} или {"ok": false, "error": "..."}
+
+python3 -m tls_proxy.control stats
+"""
+from typing import Any, Callable, Dict, Optional
+import argparse
+import asyncio
+import logging
+import socket
+import json
+import os
+
+from tls_proxy.config import CONTROL_SOCKET_PATH
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlServer:
+    def __init__(self, path: str):
+        self.path = path
+        self.handlers: Dict[str, Callable[..., Any]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def register(self, command: str, handler: Callable[..., Any]):
+        """
+        handler вызывается с параметрами запроса как с именованными аргументами и возвращает
+        то, что можно сериализовать в JSON, или корутину с таким результатом.
+        Некорректные параметры - ControlError
+        """
+        self.handlers[command] = handler
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+        _LOGGER.info(f"Control socket: {self.path}")
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def execute(self, request: dict) -> dict:
+        params = dict(request)
+        command = params.pop("command", None)
+        handler = self.handlers.get(command)
+        if handler is None:
+            return {"ok": False, "error": f"Unknown command: {command}"}
+        try:
+            result = handler(**params)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return {"ok": True, "result": result}
+        except (ControlError, TypeError, ValueError) as e:
+            return {"ok": False, "error": str(e)}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            line = await reader.readline()
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be an object")
+            except ValueError as e:
+                reply = {"ok": False, "error": f"Bad request: {e}"}
+            else:
+                reply = await self.execute(request)
+            writer.write(json.dumps(reply).encode() + b'\n')
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _result(reply: dict) -> Any:
+    if not reply["ok"]:
+        raise ControlError(reply["error"])
+    return reply["result"]
+
+
+def request(command: str, path: str = CONTROL_SOCKET_PATH, **params) -> Any:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps({"command": command, **params}).encode() + b'\n')
+        return _result(json.loads(sock.makefile("rb").readline()))
+
+
+async def async_request(command: str, path: str, **params) -> Any:
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        writer.write(json.dumps({"command": command, **params}).encode() + b'\n')
+        return _result(json.loads(await reader.readline()))
+    finally:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send command to running tls_proxy")
+    parser.add_argument('--socket', default=CONTROL_SOCKET_PATH, help='Control socket path')
+    parser.add_argument('command')
+    parser.add_argument('params', nargs='?', default='{}', help='Command parameters (JSON)')
+    args = parser.parse_args()
+
+    try:
+        result = request(args.command, args.socket, **json.loads(args.params))
+    except ControlError as e:
+        parser.exit(1, f"Error: {e}\n")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Кэш ответов на OP_REQ_DEVLIST (usbip list -r). autoredir и usbip_gui запрашивают список
+устройств каждого сервера раз в секунду, а каждый запрос стоит серверу fork usbipd2 и
+рукопожатия TLS. Прокси отвечает на повторные запросы из кэша, а одновременные запросы
+к одному серверу объединяет в один запрос к серверу
+"""
+from dataclasses import dataclass, asdict
+from typing import Awaitable, Callable, Dict, Tuple, Union
+import asyncio
+import struct
+import time
+
+from tls_proxy.protocol import OP_COMMON, OP_REP_DEVLIST, USB_DEVICE, USB_INTERFACE_SIZE, \
+    ProtocolError, parse_usb_device
+from tls_proxy.relay_socket import RelaySocket
+from tls_proxy.tunnel import TunnelStream
+
+
+ST_OK = 0x00
+
+# ndev
+OP_DEVLIST_REPLY = struct.Struct(">I")
+# Больше устройств на сервере не бывает, иначе ответ разобран неправильно
+MAX_DEVICES = 1024
+
+# Ответ сервера и можно ли его кэшировать
+FetchResult = Tuple[bytes, bool]
+# Соединение с сервером или поток туннеля к нему
+Upstream = Union[RelaySocket, TunnelStream]
+
+
+async def _recv_exactly(upstream: Upstream, size: int) -> bytes:
+    data = await upstream.recv_exactly(size)
+    if len(data) < size:
+        raise ProtocolError("devlist reply is truncated")
+    return data
+
+
+async def read_devlist_reply(upstream: Upstream) -> FetchResult:
+    """
+    Читает ответ на OP_REQ_DEVLIST. Ответ с ошибкой состоит из одного op_common и не кэшируется
+    """
+    header = await _recv_exactly(upstream, OP_COMMON.size)
+    _, code, status = OP_COMMON.unpack(header)
+    if code != OP_REP_DEVLIST:
+        raise ProtocolError(f"unexpected reply code {code:#06x}")
+    if status != ST_OK:
+        return header, False
+
+    reply = bytearray(header)
+    ndev_data = await _recv_exactly(upstream, OP_DEVLIST_REPLY.size)
+    reply += ndev_data
+    ndev, = OP_DEVLIST_REPLY.unpack(ndev_data)
+    if ndev > MAX_DEVICES:
+        raise ProtocolError(f"bad devices count {ndev}")
+    for _ in range(ndev):
+        device_data = await _recv_exactly(upstream, USB_DEVICE.size)
+        reply += device_data
+        num_interfaces = parse_usb_device(device_data).num_interfaces
+        reply += await _recv_exactly(upstream, num_interfaces * USB_INTERFACE_SIZE)
+    return bytes(reply), True
+
+
+@dataclass
+class DevlistCacheStats:
+    # Ответ из кэша
+    hits: int = 0
+    # Запрос к серверу
+    misses: int = 0
+    # Ожидание ответа на уже отправленный серверу запрос
+    coalesced: int = 0
+    errors: int = 0
+
+    def to_dict(self) -> dict:
+        stats = asdict(self)
+        requests = self.hits + self.misses + self.coalesced
+        stats["saved_ratio"] = (self.hits + self.coalesced) / requests if requests else 0.
+        return stats
+
+
+class DevlistCache:
+    """
+    Ответы хранятся ttl_s секунд по серверу и байтам запроса (в op_common есть версия протокола)
+    """
+    def __init__(self, ttl_s: float):
+        self.ttl_s = ttl_s
+        # (сервер, запрос) -> (время истечения, ответ)
+        self._replies: Dict[Tuple[str, bytes], Tuple[float, bytes]] = {}
+        self._fetches: Dict[Tuple[str, bytes], asyncio.Task] = {}
+        self.servers: Dict[str, DevlistCacheStats] = {}
+
+    async def get(self, server: str, request: bytes,
+                  fetch: Callable[[], Awaitable[FetchResult]]) -> bytes:
+        key = (server, request)
+        stats = self.servers.setdefault(server, DevlistCacheStats())
+        cached = self._replies.get(key)
+        if cached is not None:
+            expires, reply = cached
+            if expires > time.monotonic():
+                stats.hits += 1
+                return reply
+            del self._replies[key]
+
+        task = self._fetches.get(key)
+        if task is None:
+            stats.misses += 1
+            task = asyncio.get_running_loop().create_task(self._fetch(key, fetch))
+            self._fetches[key] = task
+        else:
+            stats.coalesced += 1
+        # Отключение одного клиента не должно отменять запрос, которого ждут другие
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: Tuple[str, bytes],
+                     fetch: Callable[[], Awaitable[FetchResult]]) -> bytes:
+        try:
+            reply, cacheable = await fetch()
+        except BaseException:
+            self.servers[key[0]].errors += 1
+            raise
+        finally:
+            del self._fetches[key]
+        if cacheable:
+            self._replies[key] = (time.monotonic() + self.ttl_s, reply)
+        return reply
+
+    def to_dict(self) -> dict:
+        return {
+            "ttl_s": self.ttl_s,
+            "cached": len(self._replies),
+            "servers": {server: stats.to_dict() for server, stats in self.servers.items()},
+        }
@@ -0,0 +1,120 @@
+"""
+Обновление прокси без разрыва сессий. Работающий процесс с handoff_socket по SIGHUP (или команде
+upgrade) запускает новый процесс с теми же аргументами и --takeover и передает ему слушающий
+сокет через unix-сокет handoff_socket (SCM_RIGHTS). Когда новый процесс начинает принимать
+сессии, старый перестает их принимать, пересылает данные своих сессий до их завершения
+и выходит. Соединения, пришедшие во время передачи, ждут в очереди слушающего сокета
+"""
+from typing import List, Tuple
+import subprocess
+import logging
+import asyncio
+import socket
+import sys
+import os
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+HANDOFF_MAGIC = b"tls_proxy handoff"
+HANDOFF_READY = b"ready"
+# Сколько ждать, пока новый процесс начнет принимать сессии
+HANDOFF_TIMEOUT_S = 30.
+
+
+class HandoffError(Exception):
+    pass
+
+
+def successor_command() -> List[str]:
+    """
+    Команда запуска нового процесса: исполняемый файл на диске уже может быть обновлен
+    """
+    args = [arg for arg in sys.argv[1:] if arg != "--takeover"] + ["--takeover"]
+    # Собранный PyInstaller исполняемый файл (build_python_apps.py)
+    if getattr(sys, "frozen", False):
+        return [sys.executable] + args
+    return [sys.executable, "-m", "tls_proxy"] + args
+
+
+def start_successor() -> subprocess.Popen:
+    env = dict(os.environ)
+    # Новый процесс станет главным процессом службы и будет сам отправлять WATCHDOG=1
+    env.pop("WATCHDOG_PID", None)
+    return subprocess.Popen(successor_command(), env=env)
+
+
+class HandoffServer:
+    """
+    Отдает слушающий сокет новому процессу, подключившемуся к path
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def start(self):
+        # Сокет предыдущего процесса, который передал слушающий сокет этому, заменяется
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock.bind(self.path)
+        self.sock.listen()
+        self.sock.setblocking(False)
+
+    async def wait_takeover(self, listen_sock: socket.socket):
+        """
+        Завершается, когда новый процесс получил слушающий сокет и начал принимать сессии.
+        Если новый процесс не запустился, этот продолжает работать как раньше
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(self.sock)
+            with conn:
+                try:
+                    socket.send_fds(conn, [HANDOFF_MAGIC], [listen_sock.fileno()])
+                    reply = await asyncio.wait_for(loop.sock_recv(conn, len(HANDOFF_READY)),
+                                                   HANDOFF_TIMEOUT_S)
+                except (OSError, asyncio.TimeoutError) as e:
+                    _LOGGER.warning(f"Listening socket handoff failed: {e!r}")
+                    continue
+            if reply == HANDOFF_READY:
+                return
+            _LOGGER.warning("New process did not start, continue accepting sessions")
+
+    def close(self):
+        """
+        Файл сокета не удаляется: после передачи его заменяет новый процесс
+        """
+        self.sock.close()
+
+
+def takeover(path: str) -> Tuple[int, socket.socket]:
+    """
+    Получает слушающий сокет от процесса, работающего с тем же handoff_socket. Возвращает
+    дескриптор сокета и соединение, через которое нужно сообщить о готовности (ready)
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOFF_TIMEOUT_S)
+    try:
+        conn.connect(path)
+        message, fds, _, _ = socket.recv_fds(conn, len(HANDOFF_MAGIC), 1)
+    except OSError as e:
+        conn.close()
+        raise HandoffError(f"Failed to receive listening socket from {path}: {e}")
+    if message != HANDOFF_MAGIC or not fds:
+        conn.close()
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError(f"Unexpected handoff message from {path}")
+    return fds[0], conn
+
+
+def ready(conn: socket.socket):
+    """
+    Сообщает старому процессу, что новый принимает сессии
+    """
+    with conn:
+        try:
+            conn.sendall(HANDOFF_READY)
+        except OSError as e:
+            _LOGGER.warning(f"Failed to notify previous process: {e}")
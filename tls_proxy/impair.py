@@ -0,0 +1,184 @@
+"""
+Эмуляция глобальной сети на пути пересылки (только для тестов): задержка, разброс задержки,
+пропускная способность канала, потери и остановки. Данные не теряются и не переставляются:
+потеря задерживает порцию на время повторной передачи TCP, а следующие порции ждут ее, как
+в TCP. Параметры каждой сессии меняются во время работы командой impair (tls_proxy.control)
+"""
+from typing import Any, Deque, Optional, Tuple
+from collections import deque
+import asyncio
+import random
+
+
+# Сколько байт направления может быть в пути, как окно TCP: sendall ждет, пока их больше
+IMPAIR_QUEUE_LIMIT = 4 * 1024 * 1024
+# Потерянная порция приходит через RTT плюс минимальный RTO Linux
+LOSS_RTO_MS = 200.
+
+
+class Impairment:
+    """
+    delay_ms - задержка в одном направлении, jitter_ms - ее случайное отклонение в обе стороны,
+    rate - пропускная способность канала в байтах в секунду (0 - без ограничения),
+    loss - вероятность потери порции
+    """
+    def __init__(self, delay_ms: float = 0., jitter_ms: float = 0., rate: float = 0.,
+                 loss: float = 0.):
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.rate = rate
+        self.loss = loss
+
+    def update(self, delay_ms: Optional[float] = None, jitter_ms: Optional[float] = None,
+               rate: Optional[float] = None, loss: Optional[float] = None):
+        if delay_ms is not None:
+            self.delay_ms = delay_ms
+        if jitter_ms is not None:
+            self.jitter_ms = jitter_ms
+        if rate is not None:
+            self.rate = rate
+        if loss is not None:
+            self.loss = loss
+
+    def copy(self) -> "Impairment":
+        return Impairment(self.delay_ms, self.jitter_ms, self.rate, self.loss)
+
+    def to_dict(self) -> dict:
+        return {
+            "delay_ms": self.delay_ms,
+            "jitter_ms": self.jitter_ms,
+            "rate": self.rate,
+            "loss": self.loss,
+        }
+
+
+class ImpairedWriter:
+    """
+    Заменяет dst в pump: sendall ставит копию данных в очередь со временем доставки, а задача
+    отправляет их в dst, когда оно наступит
+    """
+    def __init__(self, dst: Any, impairment: Impairment, rng: random.Random):
+        self.dst = dst
+        self.impairment = impairment
+        self.rng = rng
+        self._queue: Deque[Tuple[float, bytes]] = deque()
+        self.queued = 0
+        self._link_free = 0.
+        self._last_release = 0.
+        self.stalled_until = 0.
+        self._changed = asyncio.Event()
+        self._sent = asyncio.Event()
+        self._error: Optional[BaseException] = None
+        self._task: Optional[asyncio.Task] = None
+        self.bytes = 0
+        self.chunks = 0
+        self.losses = 0
+        self.stalls = 0
+
+    async def sendall(self, data: bytes):
+        while self.queued >= IMPAIR_QUEUE_LIMIT and self._error is None:
+            self._sent.clear()
+            await self._sent.wait()
+        if self._error is not None:
+            raise self._error
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        impairment = self.impairment
+        # Порция передается по каналу после предыдущих, затем идет delay_ms
+        start = max(now, self._link_free, self.stalled_until)
+        self._link_free = start + len(data) / impairment.rate if impairment.rate else start
+        delay_ms = max(0., impairment.delay_ms +
+                       self.rng.uniform(-impairment.jitter_ms, impairment.jitter_ms))
+        if impairment.loss and self.rng.random() < impairment.loss:
+            delay_ms += 2 * impairment.delay_ms + LOSS_RTO_MS
+            self.losses += 1
+        # Без перестановок: порция не обгоняет предыдущую
+        release = max(self._link_free + delay_ms / 1000, self._last_release)
+        self._last_release = release
+        self._queue.append((release, bytes(data)))
+        self.queued += len(data)
+        self.chunks += 1
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+        self._changed.set()
+
+    def stall(self, duration_s: float):
+        """
+        Ничего не доставляет duration_s секунд с этого момента
+        """
+        self.stalled_until = max(self.stalled_until,
+                                 asyncio.get_running_loop().time() + duration_s)
+        self.stalls += 1
+        self._changed.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if not self._queue:
+                    self._changed.clear()
+                    await self._changed.wait()
+                    continue
+                release, data = self._queue[0]
+                wait_s = max(release, self.stalled_until) - loop.time()
+                if wait_s > 0:
+                    # Остановка могла начаться во время ожидания
+                    self._changed.clear()
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), wait_s)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self._queue.popleft()
+                await self.dst.sendall(data)
+                self.queued -= len(data)
+                self.bytes += len(data)
+                self._sent.set()
+        except OSError as e:
+            # Ошибку получит следующий sendall
+            self._error = e
+            self._sent.set()
+
+    async def flush(self):
+        """
+        Дожидается доставки всех данных из очереди
+        """
+        while self.queued and self._error is None:
+            self._sent.clear()
+            await self._sent.wait()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def to_dict(self) -> dict:
+        return {
+            "bytes": self.bytes,
+            "chunks": self.chunks,
+            "queued": self.queued,
+            "losses": self.losses,
+            "stalls": self.stalls,
+        }
+
+
+class SessionImpairment:
+    """
+    Параметры сессии и ее направления: к серверу и к клиенту
+    """
+    def __init__(self, impairment: Impairment, seed: Optional[int] = None):
+        self.impairment = impairment
+        self.rng = random.Random(seed)
+        self.to_server: Optional[ImpairedWriter] = None
+        self.to_client: Optional[ImpairedWriter] = None
+
+    def stall(self, duration_s: float):
+        for writer in (self.to_server, self.to_client):
+            if writer is not None:
+                writer.stall(duration_s)
+
+    def to_dict(self) -> dict:
+        return {
+            **self.impairment.to_dict(),
+            "to_server": self.to_server.to_dict() if self.to_server is not None else None,
+            "to_client": self.to_client.to_dict() if self.to_client is not None else None,
+        }
@@ -0,0 +1,296 @@
+"""
+Разбор потока USB/IP: op_common (usbip/src/usbip_network.h) на этапе импорта устройства
+и usbip_header (usbip/libsrc/usbip_host_userspace/stub_common.h) на этапе передачи URB.
+Все поля передаются в сетевом порядке байт
+"""
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+import struct
+
+
+OP_REQUEST = 0x80 << 8
+OP_REPLY = 0x00 << 8
+OP_IMPORT = 0x03
+OP_DEVLIST = 0x05
+OP_REQ_IMPORT = OP_REQUEST | OP_IMPORT
+OP_REP_IMPORT = OP_REPLY | OP_IMPORT
+OP_REQ_DEVLIST = OP_REQUEST | OP_DEVLIST
+OP_REP_DEVLIST = OP_REPLY | OP_DEVLIST
+
+USBIP_CMD_SUBMIT = 0x0001
+USBIP_CMD_UNLINK = 0x0002
+USBIP_RET_SUBMIT = 0x0003
+USBIP_RET_UNLINK = 0x0004
+
+USBIP_DIR_OUT = 0x00
+USBIP_DIR_IN = 0x01
+
+SYSFS_BUS_ID_SIZE = 32
+
+# version, code, status
+OP_COMMON = struct.Struct(">HHI")
+# path, busid, busnum, devnum, speed, idVendor, idProduct, bcdDevice, bDeviceClass,
+# bDeviceSubClass, bDeviceProtocol, bConfigurationValue, bNumConfigurations, bNumInterfaces
+USB_DEVICE = struct.Struct(">256s32sIIIHHHBBBBBB")
+USB_INTERFACE_SIZE = 4
+# usbip_header_basic и первые 5 полей cmd_submit/ret_submit/cmd_unlink/ret_unlink, setup[8]
+USBIP_HEADER = struct.Struct(">IIIIIiiiii8x")
+ISO_PACKET_DESCRIPTOR_SIZE = 16
+
+# Больше не бывает, иначе поток разобран неправильно
+MAX_TRANSFER_SIZE = 1 << 24
+
+
+class UsbDevice(NamedTuple):
+    busid: str
+    busnum: int
+    devnum: int
+    speed: int
+    vid: int
+    pid: int
+    device_class: int
+    num_interfaces: int
+
+
+def c_string(data: bytes) -> str:
+    return data.split(b'\0', 1)[0].decode(encoding="ascii", errors="replace")
+
+
+def parse_usb_device(data: bytes) -> UsbDevice:
+    _, busid, busnum, devnum, speed, vid, pid, _, device_class, _, _, _, _, num_interfaces = \
+        USB_DEVICE.unpack(data)
+    return UsbDevice(c_string(busid), busnum, devnum, speed, vid, pid, device_class,
+                     num_interfaces)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Обработчик заголовка получает заголовок целиком и возвращает, сколько байт данных после него
+# пропустить и какого размера следующий заголовок (0 - дальше поток не разбирать)
+HeaderHandler = Callable[[memoryview], Tuple[int, int]]
+# Получает заголовок с первыми байтами данных и полный размер заголовка с данными
+RecordHandler = Callable[[bytes, int], None]
+
+
+class StreamFramer:
+    """
+    Делит поток одного направления на заголовки и данные. Заголовки, разрезанные между
+    порциями потока, собирает в отдельный буфер, данные не копирует.
+    Если задан on_record, передает ему каждый заголовок с первыми snaplen байтами данных.
+    Во время вызова on_header header_position - смещение заголовка от начала потока
+    """
+    def __init__(self, header_size: int, on_header: HeaderHandler):
+        self.on_header = on_header
+        self.need = header_size
+        self.skip = 0
+        self._partial = bytearray()
+        self.position = 0
+        self.header_position = 0
+        self.on_record: Optional[RecordHandler] = None
+        self.snaplen = 0
+        self._record = bytearray()
+        # Полный размер и сколько еще копировать данных текущей записи
+        self._record_size = 0
+        self._record_left = 0
+
+    def feed(self, data: memoryview):
+        pos = 0
+        end = len(data)
+        base = self.position
+        self.position += end
+        while pos < end and self.need:
+            if self.skip:
+                step = min(self.skip, end - pos)
+                if self._record_left:
+                    copy = min(step, self._record_left)
+                    self._record += data[pos:pos + copy]
+                    self._record_left -= copy
+                self.skip -= step
+                pos += step
+                if not self.skip and self._record_size:
+                    self._emit_record()
+                continue
+
+            if self._partial or end - pos < self.need:
+                step = min(self.need - len(self._partial), end - pos)
+                self._partial += data[pos:pos + step]
+                pos += step
+                if len(self._partial) < self.need:
+                    return
+                header = memoryview(bytes(self._partial))
+                self._partial.clear()
+            else:
+                header = data[pos:pos + self.need]
+                pos += self.need
+
+            self.header_position = base + pos - len(header)
+            self.skip, self.need = self.on_header(header)
+            if self.on_record is not None:
+                self._record += header
+                self._record_size = len(header) + self.skip
+                self._record_left = min(self.skip, self.snaplen)
+                if not self.skip:
+                    self._emit_record()
+
+    @property
+    def record_end(self) -> int:
+        """
+        Смещение от начала потока, до которого пришли только целые заголовки с данными
+        """
+        if self.skip:
+            return self.header_position
+        return self.position - len(self._partial)
+
+    def _emit_record(self):
+        if self.on_record is not None:
+            self.on_record(bytes(self._record), self._record_size)
+        self._record.clear()
+        self._record_size = 0
+        self._record_left = 0
+
+    def stop(self):
+        self.need = 0
+        self.skip = 0
+        self._partial.clear()
+
+
+def submit_payload_size(has_data: bool, data_length: int, number_of_packets: int) -> int:
+    """
+    Размер данных после заголовка CMD_SUBMIT или RET_SUBMIT: буфер передачи (только для
+    CMD_SUBMIT с направлением OUT и RET_SUBMIT с направлением IN) и дескрипторы iso-пакетов
+    """
+    size = data_length if has_data and data_length > 0 else 0
+    if number_of_packets > 0:
+        size += number_of_packets * ISO_PACKET_DESCRIPTOR_SIZE
+    if size > MAX_TRANSFER_SIZE:
+        raise ProtocolError(f"Transfer size {size} is too big")
+    return size
+
+
+class UrbObserver:
+    """
+    Получает разобранные URB сессии. Значение, возвращенное submit, передается в ret_submit
+    для того же seqnum и в ret_unlink для отмененного URB
+    """
+    def submit(self, seqnum: int, devid: int, direction: int, ep: int, length: int,
+               number_of_packets: int, interval: int) -> Any:
+        return None
+
+    def ret_submit(self, tag: Any, status: int, actual_length: int, number_of_packets: int):
+        pass
+
+    def unlink(self, seqnum: int, unlink_seqnum: int):
+        pass
+
+    def ret_unlink(self, status: int, tag: Any):
+        pass
+
+
+class UsbipStreamParser:
+    """
+    Разбирает оба направления одной сессии прокси. Для OP_REQ_IMPORT после успешного ответа
+    сервера разбирает заголовки URB и передает их observer, для остальных запросов только
+    определяет код запроса.
+    Ошибка разбора останавливает разбор сессии, но не влияет на пересылку данных.
+    Если разбирается только направление к серверу, track_urbs=False: URB, на которые некому
+    ответить, не запоминаются
+    """
+    def __init__(self, observer: Optional[UrbObserver] = None, track_urbs: bool = True):
+        self.observer = observer if observer is not None else UrbObserver()
+        self.track_urbs = track_urbs
+        self.op_code: Optional[int] = None
+        self.busid: Optional[str] = None
+        self.device: Optional[UsbDevice] = None
+        self.error: Optional[str] = None
+        self.to_server = StreamFramer(OP_COMMON.size, self._client_op_common)
+        self.to_client = StreamFramer(OP_COMMON.size, self._server_op_common)
+        # seqnum -> (направление передачи, значение observer.submit)
+        self._submitted: Dict[int, Tuple[int, Any]] = {}
+        # seqnum CMD_UNLINK -> seqnum отменяемого URB
+        self._unlinks: Dict[int, int] = {}
+
+    @property
+    def imported(self) -> bool:
+        return self.device is not None
+
+    @property
+    def outstanding(self) -> int:
+        return len(self._submitted)
+
+    def feed_to_server(self, data: memoryview):
+        if self.to_server.need:
+            self._feed(self.to_server, data)
+
+    def feed_to_client(self, data: memoryview):
+        if self.to_client.need:
+            self._feed(self.to_client, data)
+
+    def _feed(self, framer: StreamFramer, data: memoryview):
+        try:
+            framer.feed(data)
+        except (ProtocolError, struct.error) as e:
+            self.error = str(e)
+            self.to_server.stop()
+            self.to_client.stop()
+
+    def _client_op_common(self, header: memoryview) -> Tuple[int, int]:
+        _, self.op_code, _ = OP_COMMON.unpack(header)
+        if self.op_code == OP_REQ_IMPORT:
+            self.to_server.on_header = self._client_busid
+            return 0, SYSFS_BUS_ID_SIZE
+        return 0, 0
+
+    def _client_busid(self, header: memoryview) -> Tuple[int, int]:
+        self.busid = c_string(bytes(header))
+        self.to_server.on_header = self._cmd
+        return 0, USBIP_HEADER.size
+
+    def _server_op_common(self, header: memoryview) -> Tuple[int, int]:
+        _, code, status = OP_COMMON.unpack(header)
+        if code == OP_REP_IMPORT and status == 0:
+            self.to_client.on_header = self._server_device
+            return 0, USB_DEVICE.size
+        return 0, 0
+
+    def _server_device(self, header: memoryview) -> Tuple[int, int]:
+        self.device = parse_usb_device(header)
+        self.to_client.on_header = self._ret
+        return 0, USBIP_HEADER.size
+
+    def _cmd(self, header: memoryview) -> Tuple[int, int]:
+        command, seqnum, devid, direction, ep, unlink_seqnum, length, _, packets, interval = \
+            USBIP_HEADER.unpack(header)
+        if command == USBIP_CMD_SUBMIT:
+            tag = self.observer.submit(seqnum, devid, direction, ep, length, packets, interval)
+            if self.track_urbs:
+                self._submitted[seqnum] = (direction, tag)
+            return submit_payload_size(direction == USBIP_DIR_OUT, length, packets), \
+                USBIP_HEADER.size
+        if command == USBIP_CMD_UNLINK:
+            unlink_seqnum &= 0xffffffff
+            if self.track_urbs:
+                self._unlinks[seqnum] = unlink_seqnum
+            self.observer.unlink(seqnum, unlink_seqnum)
+            return 0, USBIP_HEADER.size
+        raise ProtocolError(f"Unknown command {command:#x} from client")
+
+    def _ret(self, header: memoryview) -> Tuple[int, int]:
+        command, seqnum, _, _, _, status, actual_length, _, packets, _ = \
+            USBIP_HEADER.unpack(header)
+        if command == USBIP_RET_SUBMIT:
+            submitted = self._submitted.pop(seqnum, None)
+            if submitted is None:
+                # Без CMD_SUBMIT нельзя узнать, есть ли данные после заголовка
+                raise ProtocolError(f"RET_SUBMIT for unknown seqnum {seqnum}")
+            direction, tag = submitted
+            self.observer.ret_submit(tag, status, actual_length, packets)
+            return submit_payload_size(direction == USBIP_DIR_IN, actual_length, packets), \
+                USBIP_HEADER.size
+        if command == USBIP_RET_UNLINK:
+            # После RET_UNLINK ответа на отмененный URB уже не будет: либо он отменен, либо
+            # RET_SUBMIT был отправлен раньше
+            submitted = self._submitted.pop(self._unlinks.pop(seqnum, -1), None)
+            self.observer.ret_unlink(status, submitted[1] if submitted is not None else None)
+            return 0, USBIP_HEADER.size
+        raise ProtocolError(f"Unknown command {command:#x} from server")
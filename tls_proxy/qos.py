@@ -0,0 +1,113 @@
+"""
+Классы обслуживания PDU USB/IP для планирования записи в туннель (tls_proxy.tunnel). PDU
+прерываний и изохронных передач небольшие и чувствительны к задержке (клавиатура, мышь, звук),
+поэтому туннель отправляет их раньше PDU bulk (накопители) в пределах весов классов.
+Тип передачи определяется по usbip_header CMD_SUBMIT: нулевая конечная точка - control,
+number_of_packets > 0 - iso, interval > 0 - interrupt, остальные - bulk. RET_SUBMIT получает
+класс своего CMD_SUBMIT, UNLINK и запросы до импорта устройства - control
+"""
+from typing import Any, Deque, List, Tuple
+from collections import deque
+
+from tls_proxy.protocol import StreamFramer, UrbObserver, UsbipStreamParser
+
+
+QOS_CONTROL = 0
+QOS_INTERRUPT = 1
+QOS_ISO = 2
+QOS_BULK = 3
+# В порядке приоритета
+QOS_CLASSES = (QOS_CONTROL, QOS_INTERRUPT, QOS_ISO, QOS_BULK)
+QOS_CLASS_NAMES = {
+    QOS_CONTROL: "control",
+    QOS_INTERRUPT: "interrupt",
+    QOS_ISO: "iso",
+    QOS_BULK: "bulk",
+}
+# Доли классов при одновременной отправке: bulk получает не меньше 1/13 соединения,
+# остальные классы обычно столько не используют и отправляются сразу
+QOS_WEIGHTS = {
+    QOS_CONTROL: 4,
+    QOS_INTERRUPT: 4,
+    QOS_ISO: 4,
+    QOS_BULK: 1,
+}
+
+# Участок данных: класс и размер
+Segment = Tuple[int, int]
+
+
+def urb_class(ep: int, number_of_packets: int, interval: int) -> int:
+    if ep == 0:
+        return QOS_CONTROL
+    if number_of_packets > 0:
+        return QOS_ISO
+    if interval > 0:
+        return QOS_INTERRUPT
+    return QOS_BULK
+
+
+class _Direction:
+    def __init__(self, framer: StreamFramer):
+        self.framer = framer
+        self.position = 0
+        self.qos_class = QOS_CONTROL
+        # Начала PDU в потоке и их классы, еще не разделенные на участки
+        self.starts: Deque[Tuple[int, int]] = deque()
+
+    def mark(self, qos_class: int):
+        self.starts.append((self.framer.header_position, qos_class))
+
+    def segments(self, size: int) -> List[Segment]:
+        """
+        Делит следующие size байт потока на участки PDU разных классов. Начало заголовка,
+        пришедшее в предыдущей порции, остается в участке предыдущего PDU
+        """
+        segments: List[Segment] = []
+        pos = self.position
+        end = self.position + size
+        while self.starts and self.starts[0][0] < end:
+            start, qos_class = self.starts.popleft()
+            if start > pos and qos_class != self.qos_class:
+                segments.append((self.qos_class, start - pos))
+                pos = start
+            self.qos_class = qos_class
+        if end > pos:
+            segments.append((self.qos_class, end - pos))
+        self.position = end
+        return segments
+
+
+class SessionQos(UrbObserver):
+    """
+    Разбирает оба направления сессии и делит пересылаемые данные на участки с классами PDU.
+    Если классы нужны только для направления к серверу (клиентская сторона туннеля),
+    track_urbs=False: без ответов сервера запомненные URB никогда бы не удалялись
+    """
+    def __init__(self, track_urbs: bool = True):
+        self.parser = UsbipStreamParser(self, track_urbs)
+        self._to_server = _Direction(self.parser.to_server)
+        self._to_client = _Direction(self.parser.to_client)
+
+    def to_server(self, data: memoryview) -> List[Segment]:
+        self.parser.feed_to_server(data)
+        return self._to_server.segments(len(data))
+
+    def to_client(self, data: memoryview) -> List[Segment]:
+        self.parser.feed_to_client(data)
+        return self._to_client.segments(len(data))
+
+    def submit(self, seqnum: int, devid: int, direction: int, ep: int, length: int,
+               number_of_packets: int, interval: int) -> Any:
+        qos_class = urb_class(ep, number_of_packets, interval)
+        self._to_server.mark(qos_class)
+        return qos_class
+
+    def ret_submit(self, tag: Any, status: int, actual_length: int, number_of_packets: int):
+        self._to_client.mark(tag)
+
+    def unlink(self, seqnum: int, unlink_seqnum: int):
+        self._to_server.mark(QOS_CONTROL)
+
+    def ret_unlink(self, status: int, tag: Any):
+        self._to_client.mark(QOS_CONTROL)
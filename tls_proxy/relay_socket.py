@@ -0,0 +1,191 @@
+from typing import Awaitable, Callable, List, Optional
+import asyncio
+import socket
+import ssl
+import os
+
+from tls_proxy.resolver import connect_any
+
+
+class RelaySocket:
+    """
+    Неблокирующий сокет (обычный или SSLSocket), операции которого ждут готовности сокета
+    через цикл событий asyncio.
+    Ожидать чтения и записи одновременно могут несколько корутин (например, запись в SSLSocket
+    может потребовать чтения из сокета)
+    """
+    def __init__(self, sock: socket.socket, loop: asyncio.AbstractEventLoop):
+        sock.setblocking(False)
+        self.sock = sock
+        self.loop = loop
+        self.fd = sock.fileno()
+        self._read_waiters: List[asyncio.Future] = []
+        self._write_waiters: List[asyncio.Future] = []
+
+    def wait_readable(self) -> asyncio.Future:
+        return self._wait(self._read_waiters, self.loop.add_reader, self.loop.remove_reader)
+
+    def wait_writable(self) -> asyncio.Future:
+        return self._wait(self._write_waiters, self.loop.add_writer, self.loop.remove_writer)
+
+    def _wait(self, waiters: List[asyncio.Future], add, remove) -> asyncio.Future:
+        fut = self.loop.create_future()
+        if not waiters:
+            add(self.fd, self._wake, waiters, remove)
+        waiters.append(fut)
+        return fut
+
+    def _wake(self, waiters: List[asyncio.Future], remove):
+        remove(self.fd)
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+        waiters.clear()
+
+    def _wake_pending_reader(self):
+        # SSL_write может прочитать из сокета записи с данными, тогда сокет больше не станет
+        # готовым к чтению, а данные будут лежать в буфере SSL
+        if self._read_waiters and isinstance(self.sock, ssl.SSLSocket) and self.sock.pending():
+            self._wake(self._read_waiters, self.loop.remove_reader)
+
+    async def do_handshake(self):
+        while True:
+            try:
+                self.sock.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                await self.wait_readable()
+            except ssl.SSLWantWriteError:
+                await self.wait_writable()
+
+    async def recv(self, size: int) -> bytes:
+        while True:
+            try:
+                return self.sock.recv(size)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError):
+                await self.wait_readable()
+            except ssl.SSLWantWriteError:
+                await self.wait_writable()
+
+    async def recv_into(self, buffer: memoryview) -> int:
+        while True:
+            try:
+                return self.sock.recv_into(buffer)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError):
+                await self.wait_readable()
+            except ssl.SSLWantWriteError:
+                await self.wait_writable()
+
+    async def recv_exactly(self, size: int) -> bytes:
+        """
+        Читает size байт. Возвращает меньше, если сокет закрылся раньше
+        """
+        data = b''
+        while len(data) < size:
+            chunk = await self.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    async def sendall(self, data: bytes):
+        """
+        Отправляет все данные, дожидаясь готовности сокета после частичной записи.
+        После SSLWantWriteError/SSLWantReadError запись повторяется с теми же данными,
+        как того требует SSL_write
+        """
+        view = memoryview(data)
+        while view:
+            try:
+                sent = self.sock.send(view)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError):
+                await self.wait_writable()
+                continue
+            except ssl.SSLWantReadError:
+                await self.wait_readable()
+                continue
+            view = view[sent:]
+        self._wake_pending_reader()
+
+    def close(self):
+        for waiters, remove in ((self._read_waiters, self.loop.remove_reader),
+                                (self._write_waiters, self.loop.remove_writer)):
+            if waiters:
+                remove(self.fd)
+            for fut in waiters:
+                fut.cancel()
+            waiters.clear()
+        self.sock.close()
+
+
+async def pump(src: RelaySocket, dst: RelaySocket, buffer: memoryview,
+               on_data: Optional[Callable[[memoryview], None]] = None,
+               on_first_data: Optional[Callable[[], None]] = None,
+               throttle: Optional[Callable[[int], Awaitable[None]]] = None):
+    """
+    Пересылает данные из src в dst через buffer, пока src не закроется.
+    on_first_data вызывается один раз, когда из src пришли первые данные.
+    throttle получает размер отправленных данных и задерживает чтение следующих
+    (tls_proxy.shaping)
+    """
+    while True:
+        size = await src.recv_into(buffer)
+        if not size:
+            return
+        if on_first_data is not None:
+            on_first_data()
+            on_first_data = None
+        data = buffer[:size]
+        if on_data is not None:
+            on_data(data)
+        await dst.sendall(data)
+        if throttle is not None:
+            await throttle(size)
+
+
+HAVE_SPLICE = hasattr(os, "splice")
+# Больше не поместится в канал с размером по умолчанию, и splice в канал заблокируется
+SPLICE_SIZE = 1 << 16
+
+
+async def splice_pump(src: RelaySocket, dst: RelaySocket, chunk_size: int = SPLICE_SIZE,
+                      on_first_data: Optional[Callable[[], None]] = None,
+                      throttle: Optional[Callable[[int], Awaitable[None]]] = None):
+    """
+    Пересылает данные между обычными TCP-сокетами через канал (pipe) с помощью splice:
+    данные остаются в ядре и не копируются в Python
+    """
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    read_fd, write_fd = os.pipe2(os.O_NONBLOCK)
+    try:
+        while True:
+            try:
+                size = os.splice(src.fd, write_fd, chunk_size, flags=flags)
+            except (BlockingIOError, InterruptedError):
+                await src.wait_readable()
+                continue
+            if not size:
+                return
+            if on_first_data is not None:
+                on_first_data()
+                on_first_data = None
+            sent = size
+            while size:
+                try:
+                    size -= os.splice(read_fd, dst.fd, size, flags=flags)
+                except (BlockingIOError, InterruptedError):
+                    await dst.wait_writable()
+            if throttle is not None:
+                await throttle(sent)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+async def open_tcp_connection(loop: asyncio.AbstractEventLoop, host: str,
+                              port: int) -> socket.socket:
+    """
+    Аналог socket.create_connection, не блокирующий цикл событий
+    """
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return await connect_any(loop, host, infos)
@@ -0,0 +1,195 @@
+"""
+Разрешение имен серверов и подключение к ним.
+getaddrinfo не сообщает TTL записей DNS, поэтому ответы кэшируются на заданное время,
+ошибки разрешения - на отдельное, более короткое.
+Подключение к нескольким адресам идет параллельно с задержкой между попытками (Happy Eyeballs,
+RFC 8305), поэтому недоступный адрес IPv6 не задерживает подключение по IPv4
+"""
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional, Set, Tuple, Union
+import asyncio
+import socket
+import time
+
+from tls_proxy.config import CONNECT_STAGGER_S
+
+
+# family, type, proto, canonname, address
+AddressInfo = Tuple[int, int, int, str, Tuple]
+
+FAMILY_NAMES = {socket.AF_INET: "ipv4", socket.AF_INET6: "ipv6"}
+
+
+class Resolver:
+    def __init__(self, ttl_s: float = 0., negative_ttl_s: float = 0.):
+        self.ttl_s = ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        # (имя, порт) -> (время истечения, адреса или ошибка)
+        self._cache: Dict[Tuple[str, int],
+                          Tuple[float, Union[List[AddressInfo], socket.gaierror]]] = {}
+        self._lookups: Dict[Tuple[str, int], asyncio.Task] = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    async def resolve(self, loop: asyncio.AbstractEventLoop, host: str,
+                      port: int) -> List[AddressInfo]:
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires, result = cached
+            if expires > time.monotonic():
+                if isinstance(result, socket.gaierror):
+                    self.negative_hits += 1
+                    raise socket.gaierror(*result.args)
+                self.hits += 1
+                return result
+            del self._cache[key]
+
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            self.misses += 1
+            lookup = loop.create_task(self._lookup(loop, key))
+            self._lookups[key] = lookup
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, loop: asyncio.AbstractEventLoop,
+                      key: Tuple[str, int]) -> List[AddressInfo]:
+        try:
+            infos = await loop.getaddrinfo(*key, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            self.failures += 1
+            if self.negative_ttl_s > 0:
+                self._cache[key] = (time.monotonic() + self.negative_ttl_s, e)
+            raise
+        finally:
+            del self._lookups[key]
+        if self.ttl_s > 0:
+            self._cache[key] = (time.monotonic() + self.ttl_s, infos)
+        return infos
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "cached": len(self._cache),
+            "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.,
+        }
+
+
+@dataclass
+class ConnectRaceStats:
+    races: int = 0
+    # Адресов больше одного
+    multi_address: int = 0
+    attempts: int = 0
+    attempt_errors: int = 0
+    # Подключение не к первому адресу из списка
+    fallback_wins: int = 0
+    failed: int = 0
+    wins: Dict[str, int] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def interleave_families(infos: List[AddressInfo]) -> List[AddressInfo]:
+    """
+    Чередует семейства адресов, начиная с семейства первого адреса (RFC 8305, 4)
+    """
+    by_family: Dict[int, List[AddressInfo]] = {}
+    for info in infos:
+        by_family.setdefault(info[0], []).append(info)
+    queues = list(by_family.values())
+    result = []
+    for i in range(max(len(queue) for queue in queues) if queues else 0):
+        result.extend(queue[i] for queue in queues if i < len(queue))
+    return result
+
+
+async def _connect_one(loop: asyncio.AbstractEventLoop, info: AddressInfo) -> socket.socket:
+    family, type_, proto, _, address = info
+    sock = socket.socket(family, type_, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def connect_any(loop: asyncio.AbstractEventLoop, host: str, infos: List[AddressInfo],
+                      stagger_s: float = CONNECT_STAGGER_S,
+                      stats: Optional[ConnectRaceStats] = None) -> socket.socket:
+    """
+    Подключается к адресам из infos, начиная следующую попытку через stagger_s после
+    предыдущей или сразу после ее ошибки. Возвращает первое установленное соединение,
+    остальные попытки отменяются
+    """
+    infos = interleave_families(infos)
+    if stats is not None:
+        stats.races += 1
+        stats.multi_address += len(infos) > 1
+
+    attempts: Dict[asyncio.Task, int] = {}
+    pending: Set[asyncio.Task] = set()
+    error: Optional[OSError] = None
+    next_index = 0
+    try:
+        while True:
+            if next_index < len(infos):
+                task = loop.create_task(_connect_one(loop, infos[next_index]))
+                attempts[task] = next_index
+                pending.add(task)
+                next_index += 1
+                if stats is not None:
+                    stats.attempts += 1
+            if not pending:
+                break
+
+            timeout = stagger_s if next_index < len(infos) else None
+            done, pending = await asyncio.wait(pending, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is None:
+                    if winner is None:
+                        winner = task
+                    else:
+                        task.result().close()
+                    continue
+                if not isinstance(task.exception(), OSError):
+                    raise task.exception()
+                error = task.exception()
+                if stats is not None:
+                    stats.attempt_errors += 1
+
+            if winner is not None:
+                if stats is not None:
+                    index = attempts[winner]
+                    family = FAMILY_NAMES.get(infos[index][0], str(infos[index][0]))
+                    stats.wins[family] = stats.wins.get(family, 0) + 1
+                    stats.fallback_wins += index > 0
+                return winner.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        # Попытки, успевшие подключиться во время отмены
+        for task in pending:
+            if not task.cancelled() and task.exception() is None:
+                task.result().close()
+
+    if stats is not None:
+        stats.failed += 1
+    raise error if error is not None else OSError(f"getaddrinfo returned nothing for {host}")
@@ -0,0 +1,43 @@
+"""
+События сессий для внешнего супервизора: например, session_lost - соединение с сервером
+признано мертвым и сессия закрыта, устройство нужно подключить заново. События нумеруются,
+команда session_events отдает события после указанного номера и может ждать новые
+"""
+from typing import Deque, List
+from collections import deque
+import asyncio
+import time
+
+
+# Сколько последних событий хранится
+EVENTS_SIZE = 256
+
+
+class SessionEvents:
+    def __init__(self, size: int = EVENTS_SIZE):
+        self.events: Deque[dict] = deque(maxlen=size)
+        self.last_seq = 0
+        self._new = asyncio.Event()
+
+    def emit(self, event: str, **fields) -> dict:
+        self.last_seq += 1
+        record = {"seq": self.last_seq, "time": time.time(), "event": event, **fields}
+        self.events.append(record)
+        # Ожидающие получают событие, следующие ждут уже новое
+        self._new.set()
+        self._new = asyncio.Event()
+        return record
+
+    async def wait(self, since: int, timeout_s: float) -> List[dict]:
+        """
+        События с номером больше since. Если их нет, ждет новое не дольше timeout_s
+        """
+        if since > self.last_seq:
+            # Номер из событий прошлого процесса
+            since = 0
+        if self.last_seq <= since and timeout_s > 0:
+            try:
+                await asyncio.wait_for(self._new.wait(), timeout_s)
+            except asyncio.TimeoutError:
+                pass
+        return [record for record in self.events if record["seq"] > since]
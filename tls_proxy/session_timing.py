@@ -0,0 +1,64 @@
+"""
+Длительность этапов сессий: чтение имени сервера от клиента, разрешение имени, TCP-соединение,
+рукопожатие TLS, ожидание первого байта от сервера и вся сессия.
+По каждому серверу хранятся последние TIMING_WINDOW значений каждого этапа, по которым
+считаются перцентили, чтобы находить медленные серверы
+"""
+from typing import Deque, Dict, List, Optional
+from collections import deque
+import time
+
+
+PHASES = ("preamble", "resolve", "connect", "handshake", "first_byte", "duration")
+TIMING_WINDOW = 1024
+
+
+class SessionTiming:
+    """
+    Длительность этапов одной сессии в секундах. Этапы, которых не было (например, соединение
+    взято из пула), отсутствуют
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def add(self, phase: str, start: float, end: Optional[float] = None):
+        """
+        start, end - time.perf_counter(), без end этап заканчивается сейчас
+        """
+        self.phases[phase] = (end if end is not None else time.perf_counter()) - start
+
+    def finish(self):
+        self.add("duration", self.started)
+
+    def to_dict(self) -> dict:
+        return {f"{phase}_ms": round(self.phases[phase] * 1e3, 3)
+                for phase in PHASES if phase in self.phases}
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class ServerTimings:
+    def __init__(self, window: int = TIMING_WINDOW):
+        self.samples: Dict[str, Deque[float]] = {phase: deque(maxlen=window) for phase in PHASES}
+
+    def add(self, timing: SessionTiming):
+        for phase, value in timing.phases.items():
+            self.samples[phase].append(value)
+
+    def to_dict(self) -> dict:
+        phases = {}
+        for phase, samples in self.samples.items():
+            if not samples:
+                continue
+            values = sorted(samples)
+            phases[phase] = {
+                "count": len(values),
+                "p50_us": int(_percentile(values, 0.5) * 1e6),
+                "p90_us": int(_percentile(values, 0.9) * 1e6),
+                "p99_us": int(_percentile(values, 0.99) * 1e6),
+                "max_us": int(values[-1] * 1e6),
+            }
+        return phases
@@ -0,0 +1,187 @@
+"""
+Ограничение скорости передачи данных сессий (token bucket) отдельно для каждой сессии и для
+всех сессий с одним сервером, в каждом направлении свое. Данные отправляются сразу, а долг
+(отрицательное число токенов) задерживает следующую отправку направления, так что сессия
+не читает новые данные, пока не расплатится. Ограничения меняются во время работы командой
+rate_limits (tls_proxy.control) и сразу действуют на идущие сессии
+"""
+from typing import Dict, Optional
+import asyncio
+import math
+import time
+
+
+# Постоянная времени скользящей средней скорости
+RATE_WINDOW_S = 1.
+
+
+class TokenBucket:
+    """
+    rate байт в секунду, до burst байт подряд, rate 0 - без ограничения.
+    Измеряет текущую скорость и время задержек
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+        self.bytes = 0
+        self.throttled_s = 0.
+        self._average = 0.
+        self._measured = self._updated
+
+    def set_rate(self, rate: float, burst: int):
+        self._refill(time.monotonic())
+        if not self.rate:
+            self.tokens = float(burst)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, float(burst))
+
+    def _refill(self, now: float):
+        if self.rate:
+            self.tokens = min(float(self.burst), self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, size: int) -> float:
+        """
+        Учитывает отправку size байт и возвращает, сколько секунд ждать следующей
+        """
+        now = time.monotonic()
+        self._average = self._average * math.exp((self._measured - now) / RATE_WINDOW_S) + \
+            size / RATE_WINDOW_S
+        self._measured = now
+        self.bytes += size
+        if not self.rate:
+            return 0.
+        self._refill(now)
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0.
+        delay = -self.tokens / self.rate
+        self.throttled_s += delay
+        return delay
+
+    @property
+    def current_rate(self) -> float:
+        return self._average * math.exp((self._measured - time.monotonic()) / RATE_WINDOW_S)
+
+    def to_dict(self) -> dict:
+        return {
+            "rate": self.current_rate,
+            "bytes": self.bytes,
+            "throttled_s": self.throttled_s,
+            "throttling": self.tokens < 0,
+        }
+
+
+class DirectionBuckets:
+    """
+    Ограничения обоих направлений сессии или сервера
+    """
+    def __init__(self, rate: float, burst: int):
+        self.to_server = TokenBucket(rate, burst)
+        self.to_client = TokenBucket(rate, burst)
+
+    @property
+    def rate(self) -> float:
+        return self.to_server.rate
+
+    def set_rate(self, rate: float, burst: int):
+        self.to_server.set_rate(rate, burst)
+        self.to_client.set_rate(rate, burst)
+
+    def to_dict(self) -> dict:
+        return {
+            "limit": self.rate,
+            "to_server": self.to_server.to_dict(),
+            "to_client": self.to_client.to_dict(),
+        }
+
+
+async def _throttle(size: int, session: TokenBucket, server: TokenBucket):
+    delay = max(session.consume(size), server.consume(size))
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class SessionShaper:
+    """
+    to_server и to_client передаются в pump как throttle
+    """
+    def __init__(self, server: str, session: DirectionBuckets, server_buckets: DirectionBuckets):
+        self.server = server
+        self.buckets = session
+        self.server_buckets = server_buckets
+        # Ограничение, заданное для этой сессии, вместо общего
+        self.rate: Optional[float] = None
+
+    async def to_server(self, size: int):
+        await _throttle(size, self.buckets.to_server, self.server_buckets.to_server)
+
+    async def to_client(self, size: int):
+        await _throttle(size, self.buckets.to_client, self.server_buckets.to_client)
+
+    def to_dict(self) -> dict:
+        info = self.buckets.to_dict()
+        info["server"] = self.server
+        return info
+
+
+class Shaping:
+    """
+    Ограничения по умолчанию (session_rate, server_rate) и заданные для отдельных серверов
+    и сессий
+    """
+    def __init__(self, session_rate: float, server_rate: float, burst: int):
+        self.session_rate = session_rate
+        self.server_rate = server_rate
+        self.burst = burst
+        self.server_rates: Dict[str, float] = {}
+        self.servers: Dict[str, DirectionBuckets] = {}
+
+    def server_limit(self, server: str) -> float:
+        return self.server_rates.get(server, self.server_rate)
+
+    def session(self, server: str) -> SessionShaper:
+        if server not in self.servers:
+            self.servers[server] = DirectionBuckets(self.server_limit(server), self.burst)
+        return SessionShaper(server, DirectionBuckets(self.session_rate, self.burst),
+                             self.servers[server])
+
+    def set_server_rate(self, rate: float, server: Optional[str] = None):
+        if server is None:
+            self.server_rate = rate
+        else:
+            self.server_rates[server] = rate
+        self._apply()
+
+    def set_session_rate(self, rate: float):
+        """
+        Идущим сессиям ограничение применяет update_session
+        """
+        self.session_rate = rate
+
+    def set_burst(self, burst: int):
+        self.burst = burst
+        self._apply()
+
+    def _apply(self):
+        for server, buckets in self.servers.items():
+            buckets.set_rate(self.server_limit(server), self.burst)
+
+    def update_session(self, shaper: SessionShaper):
+        """
+        Ограничение, заданное для сессии, или общее ограничение сессий
+        """
+        shaper.buckets.set_rate(shaper.rate if shaper.rate is not None else self.session_rate,
+                                self.burst)
+
+    def to_dict(self) -> dict:
+        return {
+            "session_rate": self.session_rate,
+            "server_rate": self.server_rate,
+            "burst": self.burst,
+            "server_rates": self.server_rates,
+            "servers": {server: buckets.to_dict() for server, buckets in self.servers.items()},
+        }
@@ -0,0 +1,133 @@
+import socketserver
+import logging
+import select
+import socket
+import time
+import ssl
+
+from tls_proxy.config import ProxyConfig, TARGET_HOST_SIZE
+from tls_proxy.tcp_info import configure_socket
+from tls_proxy import systemd
+
+
+class ProxyClientDisconnected(Exception):
+    pass
+
+
+class ProxyServerDisconnected(Exception):
+    pass
+
+
+def send_all(sock: socket.socket, data: memoryview):
+    """
+    sendall для неблокирующего сокета: ждет готовности сокета после частичной записи.
+    После SSLWantWriteError/SSLWantReadError запись повторяется с теми же данными
+    """
+    while data:
+        try:
+            sent = sock.send(data)
+        except (BlockingIOError, ssl.SSLWantWriteError):
+            select.select([], [sock], [])
+            continue
+        except ssl.SSLWantReadError:
+            select.select([sock], [], [])
+            continue
+        data = data[sent:]
+
+
+class MyTCPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        config: ProxyConfig = self.server.proxy_config
+        configure_socket(self.request)
+
+        logging.info("-------- New proxy connection from {} --------".format(self.client_address[0]))
+        self.data: bytes = self.request.recv(TARGET_HOST_SIZE).split(b'\0', 1)[0].strip()
+
+        proxy_server_address = self.data.decode(encoding="ascii")
+        logging.info(f"proxy_server_address: {proxy_server_address}")
+
+        context = ssl.create_default_context(cafile=config.ca_file)
+        context.check_hostname = False
+        # context.verify_mode = ssl.CERT_NONE
+
+        try:
+            with socket.create_connection((proxy_server_address, config.upstream_port)) as sock:
+                configure_socket(sock)
+                with context.wrap_socket(sock, server_hostname=None) as tls_sock:
+                    logging.info(f"Connected to {proxy_server_address}:{config.upstream_port}")
+
+                    self.request.setblocking(False)
+                    tls_sock.setblocking(False)
+
+                    client_buffer = memoryview(bytearray(config.buffer_size))
+                    server_buffer = memoryview(bytearray(config.buffer_size))
+
+                    while True:
+                        read_ready, _, _ = select.select([self.request, tls_sock], [], [], 1)
+                        # Пока идет сессия, serve_forever не вызывает service_actions
+                        self.server.service_actions()
+
+                        for s in read_ready:
+
+                            if s == self.request:
+                                size = self.request.recv_into(client_buffer)
+                                if size:
+                                    # print("client: ", client_buffer[:size])
+                                    send_all(tls_sock, client_buffer[:size])
+                                else:
+                                    raise ProxyClientDisconnected
+
+                            if s == tls_sock:
+                                try:
+                                    size = tls_sock.recv_into(server_buffer)
+                                    if not size:
+                                        raise ProxyServerDisconnected
+                                    # print("server: ", server_buffer[:size])
+                                    send_all(self.request, server_buffer[:size])
+                                    # Остаток записи TLS, не поместившийся в буфер, лежит в
+                                    # OpenSSL, и select о нем не сообщит
+                                    while tls_sock.pending():
+                                        size = tls_sock.recv_into(server_buffer)
+                                        send_all(self.request, server_buffer[:size])
+                                except ssl.SSLWantReadError:
+                                    pass
+
+        except socket.gaierror:
+            logging.info(f"Failed to resolve {proxy_server_address} name")
+        except ConnectionRefusedError:
+            logging.info(f"Failed to connect to {proxy_server_address}:{config.upstream_port}. "
+                         f"Check if usbipd daemon running on target host")
+        except ProxyClientDisconnected:
+            logging.info("Proxy client disconnected")
+        except ProxyServerDisconnected:
+            logging.info("Proxy client disconnected")
+        finally:
+            logging.info(f"XXXXXXXX Connection with {proxy_server_address} closed XXXXXXXX")
+
+
+class ProxyTCPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, config: ProxyConfig):
+        self.proxy_config = config
+        super().__init__((config.address, config.port), MyTCPHandler,
+                         bind_and_activate=config.listen_fd is None)
+        if config.listen_fd is not None:
+            # Сокет от systemd уже слушает
+            self.socket.close()
+            self.socket = socket.socket(fileno=config.listen_fd)
+            self.server_address = self.socket.getsockname()
+        self.watchdog_timeout_s = systemd.watchdog_timeout_s()
+        self._last_watchdog = 0.
+
+    def service_actions(self):
+        if self.watchdog_timeout_s and \
+                time.monotonic() - self._last_watchdog >= self.watchdog_timeout_s / 2:
+            systemd.notify("WATCHDOG=1")
+            self._last_watchdog = time.monotonic()
+
+
+def server_run(config: ProxyConfig):
+    with ProxyTCPServer(config) as server:
+        systemd.notify("READY=1")
+        server.serve_forever()
@@ -0,0 +1,205 @@
+"""
+Работа под systemd: слушающий сокет от systemd (socket activation, sd_listen_fds(3)) и
+уведомления sd_notify(3): READY=1 после запуска и WATCHDOG=1 из цикла событий прокси, так что
+systemd перезапускает прокси с зависшим циклом (WatchdogSec= в tls_proxy.service).
+Без systemd то же самое делает команда run: передает команде слушающий сокет и принимает ее
+уведомления
+
+python3 -m tls_proxy.systemd run --listen localhost:3241 --watchdog 10 -- python3 -m tls_proxy
+"""
+from typing import List, Optional, Tuple
+import argparse
+import asyncio
+import logging
+import select
+import signal
+import socket
+import struct
+import time
+import sys
+import os
+
+from tls_proxy.config import LISTEN_BACKLOG, PROXY_ADDRESS, PROXY_PORT
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+SD_LISTEN_FDS_START = 3
+# pid, uid, gid отправителя уведомления (SCM_CREDENTIALS)
+UCRED = struct.Struct("iII")
+NOTIFY_MESSAGE_SIZE = 4096
+
+
+def listen_fds() -> List[int]:
+    """
+    Дескрипторы сокетов, переданных systemd. Переменные окружения удаляются, чтобы их
+    не унаследовали дочерние процессы
+    """
+    try:
+        pid = int(os.environ.get("LISTEN_PID", "0"))
+        count = int(os.environ.get("LISTEN_FDS", "0"))
+    except ValueError:
+        pid = count = 0
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(name, None)
+    if pid != os.getpid():
+        return []
+    fds = list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count))
+    for fd in fds:
+        os.set_inheritable(fd, False)
+    return fds
+
+
+def notify(state: str) -> bool:
+    """
+    Отправляет уведомление в NOTIFY_SOCKET, без NOTIFY_SOCKET ничего не делает
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+    except OSError as e:
+        _LOGGER.warning(f"Failed to notify service manager: {e}")
+        return False
+    return True
+
+
+def set_notify_environ(address: Optional[str], watchdog_timeout_s: Optional[float] = None):
+    """
+    Переменные sd_notify текущего процесса, например после fork. Без address уведомления
+    отключаются
+    """
+    for name in ("NOTIFY_SOCKET", "WATCHDOG_USEC", "WATCHDOG_PID"):
+        os.environ.pop(name, None)
+    if address is None:
+        return
+    os.environ["NOTIFY_SOCKET"] = address
+    if watchdog_timeout_s:
+        os.environ["WATCHDOG_USEC"] = str(int(watchdog_timeout_s * 1e6))
+        os.environ["WATCHDOG_PID"] = str(os.getpid())
+
+
+def watchdog_timeout_s() -> Optional[float]:
+    """
+    WatchdogSec службы, если watchdog включен для этого процесса
+    """
+    try:
+        usec = int(os.environ.get("WATCHDOG_USEC", "0"))
+        pid = int(os.environ.get("WATCHDOG_PID", str(os.getpid())))
+    except ValueError:
+        return None
+    if usec <= 0 or pid != os.getpid():
+        return None
+    return usec / 1e6
+
+
+async def watchdog(timeout_s: float):
+    """
+    Отправляет WATCHDOG=1 дважды за timeout_s, как советует sd_watchdog_enabled(3). Если цикл
+    событий завис, уведомления прекращаются
+    """
+    while True:
+        notify("WATCHDOG=1")
+        await asyncio.sleep(timeout_s / 2)
+
+
+class NotifySocket:
+    """
+    Сокет уведомлений в абстрактном пространстве имен: принимает уведомления процессов вместо
+    systemd и определяет отправителя по SCM_CREDENTIALS
+    """
+    def __init__(self, name: str):
+        self.address = f"@{name}"
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_PASSCRED, 1)
+        self.sock.bind(f"\0{name}")
+        self.sock.setblocking(False)
+
+    def receive(self) -> List[Tuple[int, List[str]]]:
+        """
+        Все принятые уведомления: pid отправителя и строки уведомления
+        """
+        messages = []
+        while True:
+            try:
+                data, ancdata, _, _ = self.sock.recvmsg(NOTIFY_MESSAGE_SIZE,
+                                                        socket.CMSG_SPACE(UCRED.size))
+            except BlockingIOError:
+                return messages
+            pid = 0
+            for level, kind, cmsg_data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_CREDENTIALS:
+                    pid = UCRED.unpack_from(cmsg_data)[0]
+            messages.append((pid, data.decode(errors="replace").split("\n")))
+
+    def close(self):
+        self.sock.close()
+
+
+def run(address: str, port: int, watchdog_timeout: float, command: List[str]) -> int:
+    """
+    Запускает command со слушающим сокетом address:port, как systemd для tls_proxy.socket,
+    печатает уведомления команды и, как systemd, отправляет ей SIGABRT, если WATCHDOG=1
+    не было дольше watchdog_timeout
+    """
+    listen_sock = socket.create_server((address, port), backlog=LISTEN_BACKLOG)
+    notify_sock = NotifySocket(f"tls_proxy.notify.{os.getpid()}")
+    pid = os.fork()
+    if pid == 0:
+        os.dup2(listen_sock.fileno(), SD_LISTEN_FDS_START)
+        os.set_inheritable(SD_LISTEN_FDS_START, True)
+        set_notify_environ(notify_sock.address, watchdog_timeout)
+        os.environ["LISTEN_FDS"] = "1"
+        os.environ["LISTEN_PID"] = str(os.getpid())
+        try:
+            os.execvp(command[0], command)
+        except OSError as e:
+            print(f"Failed to run {command[0]}: {e}", file=sys.stderr)
+            os._exit(127)
+    listen_sock.close()
+    signal.signal(signal.SIGINT, lambda *_: os.kill(pid, signal.SIGTERM))
+
+    last_ping = time.monotonic()
+    while True:
+        select.select([notify_sock.sock], [], [], 0.1)
+        for sender, states in notify_sock.receive():
+            print(f"{time.strftime('%H:%M:%S')} notify from {sender}: {' '.join(states)}",
+                  flush=True)
+            if "WATCHDOG=1" in states:
+                last_ping = time.monotonic()
+        if watchdog_timeout and time.monotonic() - last_ping > watchdog_timeout:
+            print(f"Watchdog timeout, killing {pid}", flush=True)
+            os.kill(pid, signal.SIGABRT)
+            last_ping = time.monotonic()
+        exited, status = os.waitpid(pid, os.WNOHANG)
+        if exited:
+            notify_sock.close()
+            return os.waitstatus_to_exitcode(status)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run command with systemd-style listening socket and notify socket",
+        usage="%(prog)s run [--listen LISTEN] [--watchdog WATCHDOG] -- COMMAND ...")
+    parser.add_argument('action', choices=["run"])
+    parser.add_argument('--listen', default=f"{PROXY_ADDRESS}:{PROXY_PORT}",
+                        help='Listening socket address:port')
+    parser.add_argument('--watchdog', type=float, default=0.,
+                        help='Watchdog timeout in seconds (WatchdogSec)')
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    command = argv[split + 1:]
+    if not command:
+        parser.error("command is required")
+    address, port = args.listen.rsplit(":", 1)
+    raise SystemExit(run(address, int(port), args.watchdog, command))
+
+
+if __name__ == "__main__":
+    main()
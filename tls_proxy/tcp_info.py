@@ -0,0 +1,155 @@
+"""
+Настройка TCP-сокетов сессий и их состояние из TCP_INFO. Прокси, как usbipd2
+(usbip_net_set_nodelay и usbip_net_set_keepalive в usbip/src/usbip_network.c), отключает
+алгоритм Нейгла, иначе небольшой PDU ждет подтверждения предыдущего десятки миллисекунд.
+BufferTuner подстраивает буферы соединения с сервером под произведение скорости на задержку
+(BDP), которое измеряет ядро
+"""
+from typing import Dict, Optional
+import logging
+import socket
+import struct
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+# struct tcp_info (linux/tcp.h) до tcpi_delivery_rate, старые ядра возвращают меньше
+TCP_INFO = struct.Struct("8B24I4Q6IQ")
+# Поля, которые показывает tcp_info, и их номера в TCP_INFO
+TCP_INFO_FIELDS = {
+    "state": 0,
+    "rtt_us": 23,
+    "rttvar_us": 24,
+    "min_rtt_us": 39,
+    "retransmits": 2,
+    "total_retrans": 31,
+    "lost": 14,
+    "cwnd": 26,
+    "mss": 10,
+    "unacked": 12,
+    "notsent_bytes": 38,
+    "delivery_rate": 42,
+    "rcv_space": 30,
+    "bytes_acked": 34,
+    "bytes_received": 35,
+    "last_data_recv_ms": 19,
+    "last_ack_recv_ms": 20,
+}
+# linux/tcp.h, в модуле socket есть с Python 3.12
+TCP_NOTSENT_LOWAT = 25
+# tcpi_state соединения, разорванного ядром (таймаут, RST)
+TCP_CLOSE = 7
+# За время ожидания мертвого сервера keepalive успевает отправить столько проб
+KEEPALIVE_PROBES = 3
+
+# Буферы - два BDP в этих пределах, неотправленных данных в сокете - не меньше половины BDP
+SOCKET_BUFFER_MIN = 64 * 1024
+SOCKET_BUFFER_MAX = 8 * 1024 * 1024
+NOTSENT_LOWAT_MIN = 16 * 1024
+# Буферы меняются, только если BDP изменилось больше чем на столько
+TUNE_HYSTERESIS = 0.25
+
+
+def configure_socket(sock: socket.socket):
+    for level, option in ((socket.IPPROTO_TCP, socket.TCP_NODELAY),
+                          (socket.SOL_SOCKET, socket.SO_KEEPALIVE)):
+        try:
+            sock.setsockopt(level, option, 1)
+        except OSError as e:
+            _LOGGER.debug(f"setsockopt {option} failed: {e}")
+
+
+def set_dead_peer_timeout(sock: socket.socket, timeout_s: float):
+    """
+    Ядро закрывает соединение, если отправленные данные не подтверждены за timeout_s
+    (TCP_USER_TIMEOUT), а простаивающее соединение проверяет пробами keepalive: первая - через
+    треть timeout_s, остальные KEEPALIVE_PROBES - за следующую треть
+    """
+    idle_s = max(1, int(timeout_s / 3))
+    options = ((socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(timeout_s * 1000)),
+               (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+               (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle_s),
+               (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, idle_s // KEEPALIVE_PROBES)),
+               (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_PROBES))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as e:
+            _LOGGER.debug(f"setsockopt {option} failed: {e}")
+
+
+def peer_silent(info: Dict[str, int], timeout_s: float) -> bool:
+    """
+    Сервер ничего не присылал и не подтверждал дольше timeout_s. На живом простаивающем
+    соединении подтверждения проб keepalive приходят чаще (set_dead_peer_timeout)
+    """
+    return min(info["last_data_recv_ms"], info["last_ack_recv_ms"]) > timeout_s * 1000
+
+
+def connection_aborted(sock: socket.socket) -> bool:
+    """
+    Ядро разорвало соединение (TCP_USER_TIMEOUT, keepalive, RST), а не другая сторона закрыла
+    его. SSLSocket может сообщить о такой ошибке как о конце данных
+    """
+    info = tcp_info(sock)
+    return info is not None and info["state"] == TCP_CLOSE
+
+
+def tcp_info(sock: socket.socket) -> Optional[Dict[str, int]]:
+    """
+    Поля TCP_INFO_FIELDS соединения, None - если сокет закрыт или это не TCP
+    """
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    except OSError:
+        return None
+    fields = TCP_INFO.unpack(data.ljust(TCP_INFO.size, b'\0'))
+    return {name: fields[index] for name, index in TCP_INFO_FIELDS.items()}
+
+
+def bdp(info: Dict[str, int]) -> int:
+    """
+    Произведение скорости доставки на минимальную задержку или окно перегрузки, если оно больше
+    """
+    return max(info["delivery_rate"] * info["min_rtt_us"] // 1000000, info["cwnd"] * info["mss"])
+
+
+class BufferTuner:
+    """
+    Подстраивает SO_SNDBUF, SO_RCVBUF и TCP_NOTSENT_LOWAT соединения с сервером
+    """
+    def __init__(self):
+        self.bdp = 0
+        self.sndbuf = 0
+        self.rcvbuf = 0
+        self.notsent_lowat = 0
+        self.updates = 0
+
+    def update(self, sock: socket.socket, info: Dict[str, int]):
+        measured = bdp(info)
+        if not measured or (self.bdp and abs(measured - self.bdp) < self.bdp * TUNE_HYSTERESIS):
+            return
+        self.bdp = measured
+        self.sndbuf = min(max(2 * measured, SOCKET_BUFFER_MIN), SOCKET_BUFFER_MAX)
+        # rcv_space - сколько ядро само считает нужным принимать за RTT
+        self.rcvbuf = min(max(2 * max(measured, info["rcv_space"]), SOCKET_BUFFER_MIN),
+                          SOCKET_BUFFER_MAX)
+        self.notsent_lowat = max(measured // 2, NOTSENT_LOWAT_MIN)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, self.notsent_lowat)
+        except OSError as e:
+            _LOGGER.debug(f"Socket buffers tuning failed: {e}")
+            return
+        self.updates += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "bdp": self.bdp,
+            "sndbuf": self.sndbuf,
+            "rcvbuf": self.rcvbuf,
+            "notsent_lowat": self.notsent_lowat,
+            "updates": self.updates,
+        }
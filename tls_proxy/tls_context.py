@@ -0,0 +1,201 @@
+from typing import Dict, Optional, Set, Tuple
+from dataclasses import dataclass, asdict
+import logging
+import socket
+import time
+import ssl
+import sys
+
+from tls_proxy.ciphers import apply_profile, select_profile
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+# Шифрование записей TLS в ядре (kTLS): ssl.OP_ENABLE_KTLS есть с Python 3.12, OpenSSL должен
+# быть собран с enable-ktls, а ядру нужен модуль tls
+OP_ENABLE_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 0)
+# linux/tcp.h и linux/tls.h
+TCP_ULP = 31
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
+# struct tls_crypto_info: version, cipher_type, без ключей
+TLS_CRYPTO_INFO_SIZE = 4
+
+
+@dataclass
+class HandshakeStats:
+    full: int = 0
+    resumed: int = 0
+    failed: int = 0
+    total_time_s: float = 0.
+    max_time_s: float = 0.
+
+    def add(self, resumed: bool, time_s: float):
+        if resumed:
+            self.resumed += 1
+        else:
+            self.full += 1
+        self.total_time_s += time_s
+        self.max_time_s = max(self.max_time_s, time_s)
+
+    def to_dict(self) -> dict:
+        handshakes = self.full + self.resumed
+        stats = asdict(self)
+        stats["avg_time_s"] = self.total_time_s / handshakes if handshakes else 0.
+        return stats
+
+
+def ktls_unavailable() -> Optional[str]:
+    """
+    Почему kTLS нельзя включить, None - можно. Подключение модуля tls к TCP-соединению
+    загружает модуль, если он есть
+    """
+    if not OP_ENABLE_KTLS:
+        return f"ssl module of Python {sys.version_info.major}.{sys.version_info.minor} " \
+               f"has no OP_ENABLE_KTLS (Python 3.12+ is required)"
+    try:
+        with socket.create_server(("127.0.0.1", 0)) as server, \
+                socket.create_connection(server.getsockname()) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_ULP, b"tls")
+    except OSError as e:
+        return f"kernel tls module is not available: {e}"
+    return None
+
+
+def ktls_active(sock: socket.socket, direction: int) -> bool:
+    """
+    Шифрует ли ядро записи соединения в направлении TLS_TX или TLS_RX
+    """
+    try:
+        sock.getsockopt(SOL_TLS, direction, TLS_CRYPTO_INFO_SIZE)
+    except OSError:
+        return False
+    return True
+
+
+def create_client_context(ca_file: Optional[str], cert_file: Optional[str] = None,
+                          key_file: Optional[str] = None) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=ca_file)
+    context.check_hostname = False
+    if cert_file is not None:
+        context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+class UpstreamTls:
+    """
+    Общий SSLContext для соединений с серверами и кэш TLS-сессий по серверам, чтобы повторные
+    соединения с сервером возобновляли сессию вместо полного рукопожатия.
+    Профиль шифров (tls_proxy.ciphers) auto выбирается при создании. Если сервер не принял
+    выбранные так шифры, следующие соединения с ним используют шифры по умолчанию.
+    Сессия возобновляется только в том SSLContext, в котором создана, поэтому в кэше она
+    хранится вместе со своим контекстом
+    """
+    def __init__(self, ca_file: Optional[str], ktls: bool = False,
+                 cipher_profile: str = "default", allow_tls12: bool = False,
+                 cert_file: Optional[str] = None, key_file: Optional[str] = None):
+        self.stats = HandshakeStats()
+        # Сертификат клиента для серверов, которые его проверяют (tls_proxy.tunnel_server)
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self._sessions: Dict[Tuple[str, int], Tuple[ssl.SSLContext, ssl.SSLSession]] = {}
+        # Соединения, которые шифрует и расшифровывает ядро
+        self.ktls_unavailable = ktls_unavailable() if ktls else "disabled"
+        self.ktls = self.ktls_unavailable is None
+        self.ktls_tx = 0
+        self.ktls_rx = 0
+        self.cipher_profile = cipher_profile
+        self.cipher_rates: Dict[str, float] = {}
+        self.cipher_benchmark_error: Optional[str] = None
+        if cipher_profile == "auto":
+            cipher_profile, self.cipher_rates, self.cipher_benchmark_error = \
+                select_profile(allow_tls12)
+        self.selected_profile = cipher_profile
+        self.context = self._create_context(ca_file, cipher_profile)
+        self.fallback_context: Optional[ssl.SSLContext] = None
+        if self.cipher_profile == "auto" and cipher_profile != "default":
+            self.fallback_context = self._create_context(ca_file, "default")
+        self.fallback_servers: Set[Tuple[str, int]] = set()
+        # Согласованные шифры: сколько соединений с каждым
+        self.ciphers: Dict[str, int] = {}
+
+    def _create_context(self, ca_file: Optional[str], cipher_profile: str) -> ssl.SSLContext:
+        context = create_client_context(ca_file, self.cert_file, self.key_file)
+        apply_profile(context, cipher_profile)
+        if self.ktls:
+            context.options |= OP_ENABLE_KTLS
+        return context
+
+    def _server_context(self, server: Tuple[str, int]) -> ssl.SSLContext:
+        return self.fallback_context if server in self.fallback_servers else self.context
+
+    def _cached_session(self, server: Tuple[str, int],
+                        context: ssl.SSLContext) -> Optional[ssl.SSLSession]:
+        session_context, session = self._sessions.get(server, (None, None))
+        if session is None:
+            return None
+        # Сессия из контекста, которым сервер больше не пользуется, или истекшая
+        if session_context is not context or session.time + session.timeout <= time.time():
+            del self._sessions[server]
+            return None
+        return session
+
+    def wrap_socket(self, sock: socket.socket, server: Tuple[str, int]) -> ssl.SSLSocket:
+        context = self._server_context(server)
+        return context.wrap_socket(sock, server_hostname=None, do_handshake_on_connect=False,
+                                   session=self._cached_session(server, context))
+
+    def handshake_done(self, tls_sock: ssl.SSLSocket, server: Tuple[str, int], time_s: float):
+        self.stats.add(tls_sock.session_reused, time_s)
+        cipher = tls_sock.cipher()
+        if cipher is not None:
+            self.ciphers[cipher[0]] = self.ciphers.get(cipher[0], 0) + 1
+        if self.ktls:
+            self.ktls_tx += ktls_active(tls_sock, TLS_TX)
+            self.ktls_rx += ktls_active(tls_sock, TLS_RX)
+        self.save_session(tls_sock, server)
+
+    def handshake_failed(self, server: Tuple[str, int], error: Optional[BaseException] = None):
+        self.stats.failed += 1
+        # Сессия могла стать недействительной, например, после перезапуска сервера
+        self._sessions.pop(server, None)
+        if self.fallback_context is not None and server not in self.fallback_servers and \
+                isinstance(error, ssl.SSLError) and \
+                not isinstance(error, ssl.SSLCertVerificationError):
+            self.fallback_servers.add(server)
+            _LOGGER.warning(f"Handshake with {server[0]}:{server[1]} failed with "
+                            f"{self.selected_profile} ciphers, using default ciphers for it")
+
+    def save_session(self, tls_sock: ssl.SSLSocket, server: Tuple[str, int]):
+        """
+        В TLS 1.3 тикет сессии приходит после рукопожатия, поэтому сессию стоит сохранить еще раз
+        при закрытии соединения
+        """
+        session = tls_sock.session
+        # Соединение, открытое до перехода сервера на шифры по умолчанию
+        if session is None or tls_sock.context is not self._server_context(server):
+            return
+        if session.has_ticket or (session.id and tls_sock.version() != "TLSv1.3"):
+            self._sessions[server] = (tls_sock.context, session)
+
+    def to_dict(self) -> dict:
+        stats = self.stats.to_dict()
+        stats["cached_sessions"] = len(self._sessions)
+        stats["ktls"] = {
+            "enabled": self.ktls,
+            "unavailable": self.ktls_unavailable,
+            "tx": self.ktls_tx,
+            "rx": self.ktls_rx,
+        }
+        stats["cipher_profile"] = {
+            "profile": self.cipher_profile,
+            "selected": self.selected_profile,
+            "rates_mb_per_s": {name: rate / 1e6 for name, rate in self.cipher_rates.items()},
+            "benchmark_error": self.cipher_benchmark_error,
+            "fallback_servers": [f"{host}:{port}" for host, port in self.fallback_servers],
+        }
+        stats["ciphers"] = self.ciphers
+        return stats
@@ -0,0 +1,342 @@
+"""
+Туннель: много сессий USB/IP (потоков) в одном TLS-соединении между tls_proxy клиента
+и tls_proxy.tunnel_server на сервере.
+Соединение передает кадры FRAME: тип, номер потока и значение. Значение DATA - размер данных
+после заголовка, WINDOW - на сколько байт увеличить окно отправки потока.
+Поток открывает клиент (OPEN), закрывает любая сторона (CLOSE), после чего другая сторона
+дочитывает принятые данные и закрывает поток у себя.
+Отправитель передает в поток не больше окна, пока получатель не вернет его через WINDOW,
+поэтому медленная сессия не занимает соединение и память другой стороны.
+Кадры DATA и CLOSE каждого потока отправляются по порядку, а между потоками соединение делится
+по классам PDU (tls_proxy.qos) взвешенным циклическим обслуживанием (deficit round robin)
+"""
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from collections import deque
+import logging
+import asyncio
+import struct
+
+from tls_proxy.qos import QOS_BULK, QOS_CLASSES, QOS_CLASS_NAMES, QOS_CONTROL, QOS_WEIGHTS
+from tls_proxy.qos import Segment
+from tls_proxy.relay_socket import RelaySocket
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_WINDOW = 3
+FRAME_CLOSE = 4
+
+# type, stream id, value
+FRAME = struct.Struct(">BII")
+MAX_FRAME_DATA = 1 << 16
+STREAM_WINDOW = 1 << 18
+# Окно возвращается порциями не меньше этой, чтобы не отправлять WINDOW на каждый URB
+WINDOW_UPDATE_THRESHOLD = STREAM_WINDOW // 4
+READ_SIZE = 1 << 16
+# Запись в соединение не больше этого, чтобы новый кадр прерывания не ждал все очереди
+WRITE_SIZE = 1 << 16
+# Столько байт за круг планирования получает класс с весом 1: хватает на любой кадр
+QOS_QUANTUM = FRAME.size + MAX_FRAME_DATA
+
+
+class TunnelError(Exception):
+    pass
+
+
+class TunnelStream:
+    """
+    Логическое соединение внутри туннеля. Повторяет методы RelaySocket, которые используют
+    пересылка данных и кэш списка устройств (recv_into, recv, recv_exactly, sendall, close).
+    classify делит отправляемые данные на участки PDU с классами (tls_proxy.qos), без него все
+    данные - bulk
+    """
+    def __init__(self, tunnel: "TunnelConnection", id_: int):
+        self.tunnel = tunnel
+        self.id = id_
+        self.classify: Optional[Callable[[memoryview], List[Segment]]] = None
+        # Кадры потока, ожидающие отправки: класс и кадр с заголовком
+        self._pending: Deque[Tuple[int, bytes]] = deque()
+        self.send_window = STREAM_WINDOW
+        self.recv_window = STREAM_WINDOW
+        self._unacked = 0
+        self._incoming: Deque[memoryview] = deque()
+        # Другая сторона закрыла поток или туннель разорван
+        self._eof = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._eof or self.id not in self.tunnel.streams
+
+    async def recv_into(self, buffer: memoryview) -> int:
+        while not self._incoming:
+            if self._eof:
+                return 0
+            self._readable.clear()
+            await self._readable.wait()
+
+        chunk = self._incoming[0]
+        size = min(len(buffer), len(chunk))
+        buffer[:size] = chunk[:size]
+        if size < len(chunk):
+            self._incoming[0] = chunk[size:]
+        else:
+            self._incoming.popleft()
+
+        self.recv_window += size
+        self._unacked += size
+        if self._unacked >= WINDOW_UPDATE_THRESHOLD and not self.closed:
+            self.tunnel.send_frame(FRAME_WINDOW, self.id, self._unacked)
+            self._unacked = 0
+        return size
+
+    async def recv(self, size: int) -> bytes:
+        buffer = bytearray(size)
+        received = await self.recv_into(memoryview(buffer))
+        return bytes(buffer[:received])
+
+    async def recv_exactly(self, size: int) -> bytes:
+        """
+        Читает size байт. Возвращает меньше, если поток закрылся раньше
+        """
+        data = b''
+        while len(data) < size:
+            chunk = await self.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    async def sendall(self, data: bytes):
+        view = memoryview(data)
+        segments = self.classify(view) if self.classify is not None else [(QOS_BULK, len(view))]
+        for qos_class, segment_size in segments:
+            segment, view = view[:segment_size], view[segment_size:]
+            while segment:
+                while not self.send_window and not self.closed:
+                    self._writable.clear()
+                    await self._writable.wait()
+                if self.closed:
+                    raise ConnectionResetError(f"Tunnel stream {self.id} closed")
+                size = min(len(segment), self.send_window, MAX_FRAME_DATA)
+                self.tunnel.queue_frame(self, qos_class, FRAME_DATA, size, segment[:size])
+                self.send_window -= size
+                segment = segment[size:]
+
+    def close(self):
+        if self.id in self.tunnel.streams:
+            del self.tunnel.streams[self.id]
+            if not self._eof:
+                # После еще не отправленных данных потока
+                self.tunnel.queue_frame(self, QOS_CONTROL, FRAME_CLOSE, 0)
+        self._remote_closed()
+
+    def _data_received(self, data: memoryview):
+        if len(data) > self.recv_window:
+            raise TunnelError(f"Stream {self.id} window exceeded")
+        self.recv_window -= len(data)
+        self._incoming.append(data)
+        self._readable.set()
+
+    def _window_received(self, size: int):
+        self.send_window += size
+        self._writable.set()
+
+    def _remote_closed(self):
+        self._eof = True
+        self._readable.set()
+        self._writable.set()
+
+
+class TunnelConnection:
+    """
+    Одно TLS-соединение туннеля. Кадры OPEN и WINDOW отправляются первыми, кадры потоков ждут
+    в очередях потоков, пока предыдущая запись в сокет не завершилась, и отправляются записями
+    до WRITE_SIZE. Поток стоит в очереди класса своего первого кадра, каждый круг класс может
+    отправить QOS_WEIGHTS * QOS_QUANTUM байт, классы обслуживаются в порядке приоритета.
+    on_open вызывается на стороне сервера для каждого нового потока
+    """
+    def __init__(self, sock: RelaySocket,
+                 on_open: Optional[Callable[[TunnelStream], None]] = None):
+        self.sock = sock
+        self.on_open = on_open
+        self.streams: Dict[int, TunnelStream] = {}
+        self._last_stream_id = 0
+        # Кадры OPEN и WINDOW
+        self._out = bytearray()
+        # Потоки с кадрами на отправку по классу первого кадра
+        self._queues: Dict[int, Deque[TunnelStream]] = {
+            qos_class: deque() for qos_class in QOS_CLASSES}
+        self._deficits = {qos_class: 0 for qos_class in QOS_CLASSES}
+        self._out_ready = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.streams_opened = 0
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.writes = 0
+        self.class_bytes_sent = {qos_class: 0 for qos_class in QOS_CLASSES}
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._read_loop()), loop.create_task(self._write_loop())]
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    def open_stream(self) -> TunnelStream:
+        if self.closed:
+            raise ConnectionResetError("Tunnel connection closed")
+        # Потоки открывает только клиент, номера не пересекаются с прошлыми потоками
+        self._last_stream_id += 1
+        stream = self._add_stream(self._last_stream_id)
+        self.send_frame(FRAME_OPEN, stream.id, 0)
+        return stream
+
+    def _add_stream(self, stream_id: int) -> TunnelStream:
+        stream = TunnelStream(self, stream_id)
+        self.streams[stream_id] = stream
+        self.streams_opened += 1
+        return stream
+
+    def send_frame(self, type_: int, stream_id: int, value: int, payload: bytes = b''):
+        if self.closed:
+            raise ConnectionResetError("Tunnel connection closed")
+        self._out += FRAME.pack(type_, stream_id, value)
+        self._out += payload
+        self.frames_sent += 1
+        self._out_ready.set()
+
+    def queue_frame(self, stream: TunnelStream, qos_class: int, type_: int, value: int,
+                    payload: bytes = b''):
+        if self.closed:
+            raise ConnectionResetError("Tunnel connection closed")
+        if not stream._pending:
+            self._queues[qos_class].append(stream)
+        stream._pending.append((qos_class, FRAME.pack(type_, stream.id, value) + payload))
+        self.frames_sent += 1
+        self._out_ready.set()
+
+    def _next_write(self) -> bytearray:
+        data, self._out = self._out, bytearray()
+        while len(data) < WRITE_SIZE and any(self._queues.values()):
+            for qos_class, queue in self._queues.items():
+                if len(data) >= WRITE_SIZE:
+                    break
+                if not queue:
+                    self._deficits[qos_class] = 0
+                    continue
+                self._deficits[qos_class] += QOS_WEIGHTS[qos_class] * QOS_QUANTUM
+                while queue and len(data) < WRITE_SIZE and \
+                        len(queue[0]._pending[0][1]) <= self._deficits[qos_class]:
+                    stream = queue.popleft()
+                    _, frame = stream._pending.popleft()
+                    data += frame
+                    self._deficits[qos_class] -= len(frame)
+                    self.class_bytes_sent[qos_class] += len(frame)
+                    if stream._pending:
+                        self._queues[stream._pending[0][0]].append(stream)
+        return data
+
+    async def _write_loop(self):
+        try:
+            while True:
+                data = self._next_write()
+                if not data:
+                    self._out_ready.clear()
+                    await self._out_ready.wait()
+                    continue
+                self.writes += 1
+                self.bytes_sent += len(data)
+                await self.sock.sendall(data)
+        except OSError as e:
+            _LOGGER.info(f"Tunnel write error: {e}")
+        finally:
+            self.close()
+
+    async def _read_loop(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = await self.sock.recv(READ_SIZE)
+                if not data:
+                    break
+                self.bytes_received += len(data)
+                buffer += data
+                pos = self._dispatch(buffer)
+                del buffer[:pos]
+        except (OSError, TunnelError) as e:
+            _LOGGER.info(f"Tunnel read error: {e}")
+        finally:
+            self.close()
+
+    def _dispatch(self, data: bytearray) -> int:
+        """
+        Обрабатывает принятые целиком кадры, возвращает размер обработанных данных
+        """
+        pos = 0
+        while len(data) - pos >= FRAME.size:
+            type_, stream_id, value = FRAME.unpack_from(data, pos)
+            size = value if type_ == FRAME_DATA else 0
+            if size > MAX_FRAME_DATA:
+                raise TunnelError(f"Bad frame size {size}")
+            end = pos + FRAME.size + size
+            if end > len(data):
+                break
+
+            self.frames_received += 1
+            stream = self.streams.get(stream_id)
+            if type_ == FRAME_OPEN:
+                if self.on_open is None or stream is not None:
+                    raise TunnelError(f"Unexpected stream {stream_id} open")
+                self.on_open(self._add_stream(stream_id))
+            elif type_ == FRAME_DATA:
+                # Данные закрытого здесь потока, отправленные до получения CLOSE
+                if stream is not None:
+                    stream._data_received(memoryview(data[end - size:end]))
+            elif type_ == FRAME_WINDOW:
+                if stream is not None:
+                    stream._window_received(value)
+            elif type_ == FRAME_CLOSE:
+                if stream is not None:
+                    del self.streams[stream_id]
+                    stream._remote_closed()
+            else:
+                raise TunnelError(f"Unknown frame type {type_}")
+            pos = end
+        return pos
+
+    def close(self):
+        if self.closed:
+            return
+        self._closed.set()
+        for task in self._tasks:
+            task.cancel()
+        for stream in self.streams.values():
+            stream._remote_closed()
+        self.streams.clear()
+        self.sock.close()
+
+    def to_dict(self) -> dict:
+        return {
+            "streams": len(self.streams),
+            "streams_opened": self.streams_opened,
+            "frames_sent": self.frames_sent,
+            "frames_received": self.frames_received,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "writes": self.writes,
+            "class_bytes_sent": {QOS_CLASS_NAMES[qos_class]: size
+                                 for qos_class, size in self.class_bytes_sent.items()},
+        }
@@ -0,0 +1,198 @@
+"""
+Серверная часть туннеля (tls_proxy.tunnel): принимает TLS-соединения от tls_proxy клиентов
+с ключом --tunnel и передает каждый поток туннеля отдельным соединением локальному usbipd2.
+Рукопожатия с usbipd2 идут по локальному соединению и возобновляют TLS-сессию.
+usbipd2 видит все потоки туннеля с адреса 127.0.0.1, его ограничения по адресу клиента
+(libwrap, hosts.allow) к ним не применяются. Поэтому туннель открывается только клиентам
+с сертификатом, подписанным --client-ca
+
+python3 -m tls_proxy.tunnel_server -d
+"""
+from typing import Set, Tuple
+import argparse
+import logging
+import asyncio
+import socket
+import time
+import ssl
+
+from tls_proxy.config import TunnelServerConfig, LISTEN_BACKLOG, TARGET_HOST_TIMEOUT_S
+from tls_proxy.relay_socket import RelaySocket, open_tcp_connection, pump
+from tls_proxy.tunnel import TunnelConnection, TunnelStream
+from tls_proxy.tls_context import UpstreamTls
+from tls_proxy.tcp_info import configure_socket
+from tls_proxy.qos import SessionQos
+from tls_proxy.buffers import BufferPool
+from tls_proxy import config
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+class TunnelServer:
+    def __init__(self, server_config: TunnelServerConfig):
+        self.config = server_config
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH,
+                                                  cafile=server_config.client_ca_file)
+        self.context.verify_mode = ssl.CERT_REQUIRED
+        self.context.load_cert_chain(server_config.cert_file, server_config.key_file)
+        self.usbipd_tls = UpstreamTls(server_config.usbipd_ca_file)
+        self.buffers = BufferPool(server_config.buffer_size, server_config.preallocated_buffers)
+        self.tunnels: Set[TunnelConnection] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        listen_sock = socket.create_server((self.config.address, self.config.port),
+                                           backlog=LISTEN_BACKLOG)
+        listen_sock.setblocking(False)
+        _LOGGER.info(f"Listening on {self.config.address}:{self.config.port}")
+        try:
+            while True:
+                try:
+                    conn, address = await loop.sock_accept(listen_sock)
+                except OSError as e:
+                    _LOGGER.error(f"Accept error: {e}")
+                    await asyncio.sleep(0.1)
+                    continue
+                self._spawn(self.handle_tunnel(conn, address))
+        finally:
+            listen_sock.close()
+            for tunnel in list(self.tunnels):
+                tunnel.close()
+            for task in self.tasks:
+                task.cancel()
+
+    async def handle_tunnel(self, conn: socket.socket, address: Tuple):
+        loop = asyncio.get_running_loop()
+        configure_socket(conn)
+        sock = RelaySocket(self.context.wrap_socket(conn, server_side=True,
+                                                    do_handshake_on_connect=False), loop)
+        try:
+            await asyncio.wait_for(sock.do_handshake(), TARGET_HOST_TIMEOUT_S)
+        except (asyncio.TimeoutError, OSError) as e:
+            _LOGGER.info(f"Tunnel handshake with {address[0]} failed: {e}")
+            sock.close()
+            return
+
+        _LOGGER.info(f"-------- New tunnel from {address[0]} --------")
+        tunnel = TunnelConnection(sock, self.on_stream)
+        self.tunnels.add(tunnel)
+        tunnel.start()
+        try:
+            await tunnel.wait_closed()
+        finally:
+            self.tunnels.discard(tunnel)
+            tunnel.close()
+            _LOGGER.info(f"XXXXXXXX Tunnel from {address[0]} closed XXXXXXXX")
+
+    def on_stream(self, stream: TunnelStream):
+        self._spawn(self.handle_stream(stream))
+
+    async def open_usbipd(self, loop: asyncio.AbstractEventLoop) -> RelaySocket:
+        server = (self.config.usbipd_address, self.config.usbipd_port)
+        sock = await open_tcp_connection(loop, *server)
+        configure_socket(sock)
+        try:
+            tls_sock = self.usbipd_tls.wrap_socket(sock, server)
+        except BaseException:
+            sock.close()
+            raise
+
+        usbipd = RelaySocket(tls_sock, loop)
+        start = time.perf_counter()
+        try:
+            await usbipd.do_handshake()
+        except BaseException:
+            self.usbipd_tls.handshake_failed(server)
+            usbipd.close()
+            raise
+        self.usbipd_tls.handshake_done(tls_sock, server, time.perf_counter() - start)
+        return usbipd
+
+    async def handle_stream(self, stream: TunnelStream):
+        loop = asyncio.get_running_loop()
+        _LOGGER.info(f"Tunnel stream {stream.id} opened")
+        try:
+            usbipd = await self.open_usbipd(loop)
+        except (OSError, ssl.SSLError) as e:
+            _LOGGER.info(f"Failed to connect to usbipd: {e}")
+            stream.close()
+            return
+
+        qos = None
+        if self.config.qos:
+            qos = SessionQos()
+            stream.classify = qos.to_client
+        to_usbipd_buffer = self.buffers.acquire()
+        to_stream_buffer = self.buffers.acquire()
+        to_usbipd = loop.create_task(pump(stream, usbipd, to_usbipd_buffer,
+                                          qos.to_server if qos else None))
+        to_stream = loop.create_task(pump(usbipd, stream, to_stream_buffer))
+        try:
+            await asyncio.wait((to_usbipd, to_stream), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            to_usbipd.cancel()
+            to_stream.cancel()
+            await asyncio.gather(to_usbipd, to_stream, return_exceptions=True)
+            self.buffers.release(to_usbipd_buffer)
+            self.buffers.release(to_stream_buffer)
+            stream.close()
+            self.usbipd_tls.save_session(
+                usbipd.sock, (self.config.usbipd_address, self.config.usbipd_port))
+            usbipd.close()
+            _LOGGER.info(f"Tunnel stream {stream.id} closed")
+
+
+def server_run(server_config: TunnelServerConfig):
+    asyncio.run(TunnelServer(server_config).serve_forever())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server side of tls_proxy tunnel")
+    parser.add_argument('-d', action='store_true', dest='debug', help='Show debug messages')
+    parser.add_argument('--address', default=config.TUNNEL_SERVER_ADDRESS, help='Listen address')
+    parser.add_argument('--port', type=int, default=config.TUNNEL_PORT, help='Listen port')
+    parser.add_argument('--cert', default=config.SERVER_CERT_FILE, dest='cert_file',
+                        help='Server certificate')
+    parser.add_argument('--key', default=config.SERVER_KEY_FILE, dest='key_file',
+                        help='Server private key')
+    parser.add_argument('--client-ca', default=config.SERVER_CA_FILE, dest='client_ca_file',
+                        help='CA certificates to verify client certificates, required because '
+                             'usbipd2 sees all tunnel streams from localhost')
+    parser.add_argument('--usbipd-port', type=int, default=config.USBIP_SERVER_PORT,
+                        dest='usbipd_port', help='Local usbipd2 port')
+    parser.add_argument('--usbipd-cafile', default=config.SERVER_CA_FILE, dest='usbipd_ca_file',
+                        help='CA certificates to verify usbipd2 certificate')
+    parser.add_argument('--qos', action='store_true',
+                        help='Send interrupt and isochronous URBs through the tunnel ahead of bulk')
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(
+        level=log_level, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S')
+
+    server_config = TunnelServerConfig(
+        address=args.address,
+        port=args.port,
+        cert_file=args.cert_file,
+        key_file=args.key_file,
+        client_ca_file=args.client_ca_file,
+        usbipd_port=args.usbipd_port,
+        usbipd_ca_file=args.usbipd_ca_file,
+        qos=args.qos,
+    )
+    try:
+        server_run(server_config)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
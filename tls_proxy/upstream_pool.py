@@ -0,0 +1,201 @@
+from typing import Awaitable, Callable, Deque, Dict, List, Set
+from collections import deque
+import configparser
+import logging
+import asyncio
+import json
+import time
+import ssl
+import os
+
+from tls_proxy.relay_socket import RelaySocket
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+
+def read_servers(servers_file_path: str) -> List[str]:
+    """
+    Читает адреса серверов из файла настроек autoredir (/etc/usbip2/settings.ini)
+    """
+    config = configparser.ConfigParser()
+    try:
+        if not config.read(servers_file_path):
+            return []
+        server_names = json.loads(config['main']['servers'])
+    except (KeyError, configparser.Error, json.JSONDecodeError) as e:
+        _LOGGER.error(f"Config file {servers_file_path} format error: {e}")
+        return []
+
+    addresses = []
+    for srv in server_names:
+        try:
+            addresses.append(config[srv]['address'])
+        except KeyError as e:
+            _LOGGER.error(f"Parse server {srv} config error: {e}")
+    return addresses
+
+
+class _IdleConnection:
+    __slots__ = ("upstream", "created")
+
+    def __init__(self, upstream: RelaySocket):
+        self.upstream = upstream
+        self.created = time.monotonic()
+
+
+class UpstreamPool:
+    """
+    Держит для серверов из файла настроек до size готовых TLS-соединений, чтобы новая сессия
+    не ждала подключения и рукопожатия.
+    Пока соединение свободно, прокси читает из него: так обрабатываются тикеты TLS 1.3
+    и обнаруживается закрытие соединения сервером. Соединения старше idle_timeout_s закрываются
+    """
+    REFRESH_INTERVAL_S = 5.
+    # Сколько не пытаться подключиться к серверу после ошибки
+    RETRY_INTERVAL_S = 30.
+
+    def __init__(self, connect: Callable[[str], Awaitable[RelaySocket]], size: int,
+                 idle_timeout_s: float, servers_file_path: str):
+        self.connect = connect
+        self.size = size
+        self.idle_timeout_s = idle_timeout_s
+        self.servers_file_path = servers_file_path
+        self.servers: List[str] = []
+        self._servers_file_mt = 0.
+        self._idle: Dict[str, Deque[_IdleConnection]] = {}
+        self._connecting: Dict[str, int] = {}
+        self._retry_after: Dict[str, float] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.expired = 0
+        self.closed_by_server = 0
+
+    def take(self, server: str) -> RelaySocket:
+        """
+        Возвращает готовое соединение с сервером или None, если свободных нет
+        """
+        idle = self._idle.get(server)
+        if not idle:
+            if server in self.servers:
+                self.misses += 1
+            return None
+
+        # Самое новое соединение - меньше шансов, что сервер его уже закрыл
+        conn = idle.pop()
+        conn.upstream.loop.remove_reader(conn.upstream.fd)
+        self.hits += 1
+        self._wakeup.set()
+        return conn.upstream
+
+    async def run(self):
+        try:
+            while True:
+                self._reload_servers()
+                self._expire()
+                self._refill()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.REFRESH_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Закрывает готовые соединения и отменяет подключения. Задача run при этом продолжает
+        работать, ее нужно отменить
+        """
+        for task in self._tasks:
+            task.cancel()
+        for server in list(self._idle):
+            self._close_all(server)
+
+    def _reload_servers(self):
+        try:
+            servers_file_mt = os.stat(self.servers_file_path).st_mtime
+        except OSError:
+            servers_file_mt = 0.
+        if servers_file_mt == self._servers_file_mt:
+            return
+        self._servers_file_mt = servers_file_mt
+
+        self.servers = read_servers(self.servers_file_path) if servers_file_mt else []
+        _LOGGER.info(f"Upstream pool servers: {self.servers}")
+        for server in set(self._idle) - set(self.servers):
+            self._close_all(server)
+
+    def _expire(self):
+        deadline = time.monotonic() - self.idle_timeout_s
+        for server, idle in self._idle.items():
+            while idle and idle[0].created < deadline:
+                idle.popleft().upstream.close()
+                self.expired += 1
+
+    def _refill(self):
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        for server in self.servers:
+            if self._retry_after.get(server, 0.) > now:
+                continue
+            missing = self.size - len(self._idle.get(server, ())) - self._connecting.get(server, 0)
+            for _ in range(missing):
+                self._connecting[server] = self._connecting.get(server, 0) + 1
+                task = loop.create_task(self._open(server))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _open(self, server: str):
+        try:
+            upstream = await self.connect(server)
+        except (OSError, ssl.SSLError, UnicodeError) as e:
+            self.connect_failures += 1
+            self._retry_after[server] = time.monotonic() + self.RETRY_INTERVAL_S
+            _LOGGER.info(f"Upstream pool failed to connect to {server}: {e}")
+            return
+        finally:
+            self._connecting[server] -= 1
+
+        self.connects += 1
+        if server not in self.servers:
+            upstream.close()
+            return
+        conn = _IdleConnection(upstream)
+        self._idle.setdefault(server, deque()).append(conn)
+        upstream.loop.add_reader(upstream.fd, self._idle_readable, server, conn)
+
+    def _idle_readable(self, server: str, conn: _IdleConnection):
+        try:
+            conn.upstream.sock.recv(1)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # Прочитаны служебные записи TLS, например, тикет сессии
+            return
+        except (OSError, ssl.SSLError):
+            pass
+        # Сервер закрыл соединение или прислал данные, которых не должно быть до запроса
+        conn.upstream.loop.remove_reader(conn.upstream.fd)
+        self._idle[server].remove(conn)
+        conn.upstream.close()
+        self.closed_by_server += 1
+
+    def _close_all(self, server: str):
+        for conn in self._idle.pop(server, ()):
+            conn.upstream.loop.remove_reader(conn.upstream.fd)
+            conn.upstream.close()
+
+    def to_dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "connects": self.connects,
+            "connect_failures": self.connect_failures,
+            "expired": self.expired,
+            "closed_by_server": self.closed_by_server,
+            "idle": {server: len(idle) for server, idle in self._idle.items()},
+        }
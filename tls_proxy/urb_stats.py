@@ -0,0 +1,188 @@
+from typing import Any, Dict, Optional, Tuple
+import time
+
+from tls_proxy.protocol import UrbObserver, UsbipStreamParser, USBIP_DIR_IN, USBIP_DIR_OUT
+
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек в микросекундах. В корзину i попадают задержки от 2**(i-1) до 2**i
+    """
+    BUCKETS = 32
+
+    __slots__ = ("counts", "total_us", "max_us")
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.total_us = 0
+        self.max_us = 0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def add(self, latency_us: int):
+        self.counts[min(latency_us.bit_length(), self.BUCKETS - 1)] += 1
+        self.total_us += latency_us
+        if latency_us > self.max_us:
+            self.max_us = latency_us
+
+    def merge(self, other: 'LatencyHistogram'):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total_us += other.total_us
+        self.max_us = max(self.max_us, other.max_us)
+
+    def percentile(self, q: float) -> int:
+        """
+        Верхняя граница корзины, в которую попадает перцентиль q (0..1)
+        """
+        rank = self.count * q
+        passed = 0
+        for i, count in enumerate(self.counts):
+            passed += count
+            if count and passed >= rank:
+                return 1 << i
+        return 0
+
+    def to_dict(self) -> dict:
+        count = self.count
+        return {
+            "count": count,
+            "avg_us": self.total_us / count if count else 0.,
+            "max_us": self.max_us,
+            "p50_us": self.percentile(0.5),
+            "p90_us": self.percentile(0.9),
+            "p99_us": self.percentile(0.99),
+            "buckets_us": {1 << i: c for i, c in enumerate(self.counts) if c},
+        }
+
+
+class EndpointStats:
+    __slots__ = ("direction", "urbs", "bytes", "errors", "unlinks", "latency")
+
+    def __init__(self, direction: int):
+        self.direction = direction
+        self.urbs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.unlinks = 0
+        self.latency = LatencyHistogram()
+
+    def merge(self, other: 'EndpointStats'):
+        self.urbs += other.urbs
+        self.bytes += other.bytes
+        self.errors += other.errors
+        self.unlinks += other.unlinks
+        self.latency.merge(other.latency)
+
+    def to_dict(self) -> dict:
+        return {
+            "urbs": self.urbs,
+            "bytes": self.bytes,
+            "errors": self.errors,
+            "unlinks": self.unlinks,
+            "latency": self.latency.to_dict(),
+        }
+
+
+def endpoint_name(ep: int, direction: int) -> str:
+    return f"ep{ep}-{'in' if direction == USBIP_DIR_IN else 'out'}"
+
+
+class UrbStats(UrbObserver):
+    """
+    Счетчики URB и задержки от CMD_SUBMIT клиента до RET_SUBMIT сервера по конечным точкам
+    и направлениям. Собирается для сессии, статистика закрытых сессий суммируется по серверам
+    """
+    def __init__(self):
+        self.endpoints: Dict[Tuple[int, int], EndpointStats] = {}
+        self.bytes_to_server = 0
+        self.bytes_to_client = 0
+        self.pdus_to_server = 0
+        self.pdus_to_client = 0
+        # Время получения разбираемой порции данных, задается перед разбором
+        self.now_ns = 0
+
+    def submit(self, seqnum: int, devid: int, direction: int, ep: int, length: int,
+               number_of_packets: int, interval: int) -> Any:
+        endpoint = self.endpoints.get((ep, direction))
+        if endpoint is None:
+            endpoint = self.endpoints[(ep, direction)] = EndpointStats(direction)
+        endpoint.urbs += 1
+        if direction == USBIP_DIR_OUT and length > 0:
+            endpoint.bytes += length
+        self.pdus_to_server += 1
+        return self.now_ns, endpoint
+
+    def ret_submit(self, tag: Any, status: int, actual_length: int, number_of_packets: int):
+        submit_ns, endpoint = tag
+        endpoint.latency.add((self.now_ns - submit_ns) // 1000)
+        if status:
+            endpoint.errors += 1
+        elif endpoint.direction == USBIP_DIR_IN and actual_length > 0:
+            endpoint.bytes += actual_length
+        self.pdus_to_client += 1
+
+    def unlink(self, seqnum: int, unlink_seqnum: int):
+        self.pdus_to_server += 1
+
+    def ret_unlink(self, status: int, tag: Any):
+        if tag is not None:
+            tag[1].unlinks += 1
+        self.pdus_to_client += 1
+
+    def merge(self, other: 'UrbStats'):
+        for key, endpoint in other.endpoints.items():
+            if key not in self.endpoints:
+                self.endpoints[key] = EndpointStats(endpoint.direction)
+            self.endpoints[key].merge(endpoint)
+        self.bytes_to_server += other.bytes_to_server
+        self.bytes_to_client += other.bytes_to_client
+        self.pdus_to_server += other.pdus_to_server
+        self.pdus_to_client += other.pdus_to_client
+
+    def to_dict(self) -> dict:
+        directions = {"in": LatencyHistogram(), "out": LatencyHistogram()}
+        for (_, direction), endpoint in self.endpoints.items():
+            directions["in" if direction == USBIP_DIR_IN else "out"].merge(endpoint.latency)
+        return {
+            "bytes_to_server": self.bytes_to_server,
+            "bytes_to_client": self.bytes_to_client,
+            "pdus_to_server": self.pdus_to_server,
+            "pdus_to_client": self.pdus_to_client,
+            "latency": {name: hist.to_dict() for name, hist in directions.items()},
+            "endpoints": {endpoint_name(ep, direction): endpoint.to_dict()
+                          for (ep, direction), endpoint in sorted(self.endpoints.items())},
+        }
+
+
+class SessionMonitor:
+    """
+    Разбирает данные, которые пересылает сессия, и собирает по ним UrbStats
+    """
+    def __init__(self):
+        self.stats = UrbStats()
+        self.parser = UsbipStreamParser(self.stats)
+
+    @property
+    def busid(self) -> Optional[str]:
+        return self.parser.busid
+
+    def to_server(self, data: memoryview):
+        self.stats.bytes_to_server += len(data)
+        self.stats.now_ns = time.monotonic_ns()
+        self.parser.feed_to_server(data)
+
+    def to_client(self, data: memoryview):
+        self.stats.bytes_to_client += len(data)
+        self.stats.now_ns = time.monotonic_ns()
+        self.parser.feed_to_client(data)
+
+    def to_dict(self) -> dict:
+        stats = self.stats.to_dict()
+        stats["busid"] = self.parser.busid
+        stats["outstanding_urbs"] = self.parser.outstanding
+        if self.parser.error is not None:
+            stats["parse_error"] = self.parser.error
+        return stats
@@ -0,0 +1,812 @@
+"""
+Офлайн-анализ трасс URB: захвата прокси (tls_proxy.capture), его экспорта в JSONL или pcap
+и дампов TCP портов 3240/3241 (tcpdump -w, формат pcap).
+Заголовки usbip_header декодируются в столбцы NumPy порциями по chunk записей, и вся
+статистика считается операциями над столбцами, поэтому файлы любого размера читаются потоком
+с ограниченной памятью. Кольцо захвата читается без цикла Python по записям: смещения записей
+берутся из индекса кольца, поля записей и заголовков - из отображенного файла структурным
+dtype. JSONL разбирается модулем json порциями строк, столбцы из разобранных записей собираются
+без явного цикла, но через объекты Python каждой записи.
+В pcap над массивами разбираются только заголовки пакетов (канальный уровень, IP, TCP), а
+границы пакетов в блоке ищутся по одной. Сборка потоков TCP и деление их на PDU идут в цикле
+Python по сегментам и по PDU: сегменты нужно упорядочить по seq, а размер RET_SUBMIT зависит
+от направления CMD_SUBMIT с тем же seqnum из встречного потока, поэтому границы PDU в одном
+потоке нельзя найти независимо от другого.
+В дампе TCP должно быть начало соединения (импорт устройства), иначе PDU в нем не найти
+
+python3 -m tls_proxy.urb_trace trace.pcap --interval 0.1
+"""
+from dataclasses import dataclass, asdict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from itertools import islice, repeat
+from operator import itemgetter
+import argparse
+import struct
+import array
+import json
+
+import numpy as np
+
+from tls_proxy.config import PROXY_PORT, TARGET_HOST_SIZE, USBIP_SERVER_PORT
+from tls_proxy.capture import CAPTURE_HEADER, CAPTURE_HEADER_SIZE, CAPTURE_MAGIC
+from tls_proxy.capture import CAPTURE_VERSION, RECORD, RECORD_INDEX, index_slots, ring_offset
+from tls_proxy.protocol import UsbipStreamParser, USBIP_HEADER, USBIP_DIR_IN, USBIP_DIR_OUT
+from tls_proxy.protocol import USBIP_CMD_SUBMIT, USBIP_CMD_UNLINK, USBIP_RET_SUBMIT
+from tls_proxy.protocol import USBIP_RET_UNLINK
+from tls_proxy.urb_stats import LatencyHistogram, endpoint_name
+
+
+# usbip_header. status - transfer_flags для CMD_SUBMIT, seqnum отменяемого URB для CMD_UNLINK
+USBIP_HEADER_DTYPE = np.dtype([
+    ("command", ">u4"), ("seqnum", ">u4"), ("devid", ">u4"), ("direction", ">u4"),
+    ("ep", ">u4"), ("status", ">i4"), ("length", ">i4"), ("start_frame", ">i4"),
+    ("number_of_packets", ">i4"), ("interval", ">i4"), ("setup", "V8"),
+])
+# Запись кольца захвата (tls_proxy.capture.RECORD) и заголовок usbip_header в начале ее данных
+CAPTURE_RECORD_DTYPE = np.dtype([
+    ("record_size", "<u4"), ("ts_ns", "<u8"), ("session", "<u4"), ("direction", "u1"),
+    ("reserved", "V3"), ("size", "<u4"), ("header", USBIP_HEADER_DTYPE),
+])
+# Столбцы трассы: время получения PDU целиком, сессия (соединение), размер PDU с данными
+# и поля заголовка
+COLUMNS = ("ts_ns", "session", "size", "command", "seqnum", "devid", "direction", "ep",
+           "status", "length", "number_of_packets", "interval")
+
+TRACE_CHUNK_RECORDS = 1 << 20
+# URB без ответа дольше этого числа запросов считаются потерянными (ответ не попал в трассу)
+MAX_PENDING_URBS = 1 << 20
+DEFAULT_PORTS = (USBIP_SERVER_PORT, PROXY_PORT)
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_MAGIC = 0x0a0d0d0a
+# pcap читается и разбирается блоками такого размера
+PCAP_BLOCK_SIZE = 16 << 20
+# Сегменты TCP после пропуска, которые ждут недостающие данные
+MAX_PENDING_SEGMENTS = 4096
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_TCP = 6
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+SEQ_MASK = 0xffffffff
+
+
+@dataclass
+class TraceStats:
+    records: int = 0
+    packets: int = 0
+    # Пакеты, которые не удалось разобрать (не IP/TCP или обрезанные заголовки)
+    skipped_packets: int = 0
+    connections: int = 0
+    # Потоки с потерянными сегментами TCP, дальше пропуска не разбираются
+    lost_streams: int = 0
+    parse_errors: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class _ColumnsBuilder:
+    def __init__(self, chunk_records: int):
+        self.chunk_records = chunk_records
+        self._reset()
+
+    def _reset(self):
+        self.headers = bytearray()
+        self.timestamps = array.array("q")
+        self.sessions = array.array("I")
+        self.sizes = array.array("I")
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def full(self) -> bool:
+        return len(self.timestamps) >= self.chunk_records
+
+    def append(self, header: bytes, timestamp_ns: int, session: int, size: int):
+        self.headers += header
+        self.timestamps.append(timestamp_ns)
+        self.sessions.append(session)
+        self.sizes.append(size)
+
+    def take(self) -> Dict[str, np.ndarray]:
+        columns = _header_columns(np.frombuffer(self.headers, dtype=USBIP_HEADER_DTYPE),
+                                  np.frombuffer(self.timestamps, dtype=np.int64),
+                                  np.frombuffer(self.sessions, dtype=np.uint32),
+                                  np.frombuffer(self.sizes, dtype=np.uint32))
+        self._reset()
+        return columns
+
+
+def _header_columns(raw: np.ndarray, ts_ns: np.ndarray, session: np.ndarray,
+                    size: np.ndarray) -> Dict[str, np.ndarray]:
+    columns = {
+        "ts_ns": ts_ns.astype(np.int64),
+        "session": session.astype(np.uint32),
+        "size": size.astype(np.uint32),
+        "command": raw["command"].astype(np.uint8),
+        "seqnum": raw["seqnum"].astype(np.uint32),
+        "devid": raw["devid"].astype(np.uint32),
+        "direction": raw["direction"].astype(np.uint8),
+        "ep": raw["ep"].astype(np.uint8),
+        "status": raw["status"].astype(np.int32),
+        "length": raw["length"].astype(np.int32),
+        "number_of_packets": raw["number_of_packets"].astype(np.int32),
+        "interval": raw["interval"].astype(np.int32),
+    }
+    # В захвате прокси есть и записи этапа импорта, заголовки URB отличаются командой
+    valid = (raw["command"] >= USBIP_CMD_SUBMIT) & (raw["command"] <= USBIP_RET_UNLINK)
+    return {name: column[valid] for name, column in columns.items()}
+
+
+def _read_capture_ring(path: str, chunk_records: int,
+                       stats: TraceStats) -> Iterator[Dict[str, np.ndarray]]:
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    magic, version, size, _, _, records, written, _ = CAPTURE_HEADER.unpack_from(data, 0)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError(f"{path} is not a tls_proxy capture file")
+    slots = index_slots(size)
+    index = data[CAPTURE_HEADER_SIZE:CAPTURE_HEADER_SIZE + slots * RECORD_INDEX.size].view("<u4")
+    record_bytes = np.arange(CAPTURE_RECORD_DTYPE.itemsize)
+    for start in range(written - records, written, chunk_records):
+        numbers = np.arange(start, min(start + chunk_records, written), dtype=np.int64)
+        offsets = ring_offset(size) + index[numbers % slots].astype(np.int64)
+        stats.records += len(offsets)
+        # Заголовок короткой записи в конце файла читается не целиком, такие записи
+        # отбрасываются по размеру
+        fields = data[np.minimum(offsets[:, None] + record_bytes, len(data) - 1)].view(
+            CAPTURE_RECORD_DTYPE)[:, 0]
+        fields = fields[fields["record_size"] >= RECORD.size + USBIP_HEADER.size]
+        yield _header_columns(fields["header"], fields["ts_ns"], fields["session"],
+                              fields["size"])
+
+
+def _read_capture_jsonl(path: str, chunk_records: int,
+                        stats: TraceStats) -> Iterator[Dict[str, np.ndarray]]:
+    header_hex = 2 * USBIP_HEADER.size
+    with open(path, "rb") as trace:
+        while True:
+            lines = list(islice(trace, chunk_records))
+            if not lines:
+                break
+            records = json.loads(b"[" + b",".join(lines) + b"]")
+            count = len(records)
+            stats.records += count
+
+            def field(name: str, dtype: type) -> np.ndarray:
+                return np.fromiter(map(itemgetter(name), records), dtype=dtype, count=count)
+
+            data = list(map(itemgetter("data"), records))
+            full = np.fromiter(map(len, data), dtype=np.int64, count=count) >= header_hex
+            # Данные короче заголовка дополняются нулями, чтобы у всех заголовков был один шаг
+            starts = map(itemgetter(slice(header_hex)), data)
+            headers = bytes.fromhex("".join(map(str.ljust, starts, repeat(header_hex),
+                                                repeat("0"))))
+            yield _header_columns(np.frombuffer(headers, dtype=USBIP_HEADER_DTYPE)[full],
+                                  np.round(field("ts", np.float64) * 1e9)[full],
+                                  field("session", np.int64)[full],
+                                  field("length", np.int64)[full])
+
+
+class _TcpStream:
+    __slots__ = ("next_seq", "pending", "skip", "lost", "fin")
+
+    def __init__(self, skip: int = 0):
+        self.next_seq: Optional[int] = None
+        # seq -> данные сегментов, пришедших раньше предыдущих
+        self.pending: Dict[int, bytes] = {}
+        # Байты в начале потока, которые не относятся к USB/IP (имя сервера для прокси)
+        self.skip = skip
+        self.lost = False
+        self.fin = False
+
+
+class _TcpConnection:
+    def __init__(self, session: int, server_port: int):
+        self.session = session
+        self.parser = UsbipStreamParser()
+        self.to_server = _TcpStream(TARGET_HOST_SIZE if server_port == PROXY_PORT else 0)
+        self.to_client = _TcpStream()
+
+
+class _PcapReader:
+    """
+    Собирает потоки TCP соединений с портами ports и делит их на PDU разборщиком сессий
+    прокси. Данные, не попавшие в обрезанные пакеты (tcpdump -s), заменяются нулями: если
+    обрезаны только данные URB, заголовки все равно находятся
+    """
+    def __init__(self, ports: Sequence[int], builder: _ColumnsBuilder, stats: TraceStats):
+        self.ports = set(ports)
+        self.builder = builder
+        self.stats = stats
+        # (адрес клиента, порт клиента, адрес сервера, порт сервера) -> соединение
+        self.connections: Dict[Tuple[bytes, int, bytes, int], _TcpConnection] = {}
+        self.now_ns = 0
+
+    def read(self, path: str) -> Iterator[Dict[str, np.ndarray]]:
+        with open(path, "rb") as trace:
+            header = trace.read(24)
+            byte_order = "<" if struct.unpack("<I", header[:4])[0] in (PCAP_MAGIC_US,
+                                                                      PCAP_MAGIC_NS) else ">"
+            magic, _, _, _, _, _, linktype = struct.unpack(byte_order + "IHHiIII", header)
+            link = _Link(linktype & 0xffff, byte_order, 1 if magic == PCAP_MAGIC_NS else 1000)
+            rest = b''
+            while True:
+                data = trace.read(PCAP_BLOCK_SIZE)
+                block = rest + data
+                positions, end = link.walk(block)
+                rest = block[end:]
+                if positions:
+                    self._block(link, block, positions)
+                if self.builder.full:
+                    yield self.builder.take()
+                if not data:
+                    break
+        for connection in self.connections.values():
+            self._close(connection)
+        self.connections.clear()
+
+    def _block(self, link: '_Link', block: bytes, positions: List[int]):
+        segments = link.tcp_segments(block, positions)
+        self.stats.packets += len(positions)
+        self.stats.skipped_packets += len(positions) - int(np.count_nonzero(segments["valid"]))
+        relevant = segments["valid"] & (np.isin(segments["src_port"], list(self.ports)) |
+                                        np.isin(segments["dst_port"], list(self.ports)))
+        columns = [segments[name][relevant].tolist()
+                   for name in ("ts_ns", "ip", "address_size", "src_port", "dst_port", "seq",
+                                "flags", "payload", "payload_end", "ip_end")]
+        view = memoryview(block)
+        for ts_ns, ip, address_size, src_port, dst_port, seq, flags, payload, payload_end, \
+                ip_end in zip(*columns):
+            self.now_ns = ts_ns
+            src_start = ip + (12 if address_size == 4 else 8)
+            src = block[src_start:src_start + address_size]
+            dst = block[src_start + address_size:src_start + 2 * address_size]
+            data = view[payload:payload_end]
+            if ip_end > payload_end:
+                data = bytes(data) + bytes(ip_end - payload_end)
+            self._segment(src, src_port, dst, dst_port, seq, flags, data)
+
+    def _segment(self, src: bytes, src_port: int, dst: bytes, dst_port: int, seq: int,
+                 flags: int, payload: bytes):
+        if dst_port in self.ports:
+            key = (src, src_port, dst, dst_port)
+            to_server = True
+        else:
+            key = (dst, dst_port, src, src_port)
+            to_server = False
+
+        connection = self.connections.get(key)
+        if flags & TCP_SYN and not flags & TCP_ACK and connection is not None:
+            self._close(connection)
+            connection = None
+        if connection is None:
+            connection = self._open(key)
+        stream = connection.to_server if to_server else connection.to_client
+        if flags & TCP_SYN:
+            stream.next_seq = (seq + 1) & SEQ_MASK
+        elif payload:
+            self._deliver(connection, stream, to_server, seq, payload)
+
+        if flags & TCP_RST:
+            self._close(self.connections.pop(key))
+        elif flags & TCP_FIN:
+            stream.fin = True
+            if connection.to_server.fin and connection.to_client.fin:
+                self._close(self.connections.pop(key))
+
+    def _open(self, key: Tuple[bytes, int, bytes, int]) -> _TcpConnection:
+        self.stats.connections += 1
+        connection = self.connections[key] = _TcpConnection(self.stats.connections, key[3])
+        for framer in (connection.parser.to_server, connection.parser.to_client):
+            framer.on_record = \
+                lambda data, size, session=connection.session: self._record(data, size, session)
+        return connection
+
+    def _record(self, data: bytes, size: int, session: int):
+        self.stats.records += 1
+        if len(data) == USBIP_HEADER.size:
+            self.builder.append(data, self.now_ns, session, size)
+
+    def _close(self, connection: _TcpConnection):
+        if connection.parser.error is not None:
+            self.stats.parse_errors += 1
+
+    def _deliver(self, connection: _TcpConnection, stream: _TcpStream, to_server: bool,
+                 seq: int, payload: bytes):
+        if stream.lost:
+            return
+        if stream.next_seq is None:
+            # Начало соединения не попало в дамп
+            stream.next_seq = seq
+        while True:
+            payload = self._in_order(stream, seq, payload)
+            if payload:
+                stream.next_seq = (stream.next_seq + len(payload)) & SEQ_MASK
+                if stream.skip:
+                    skipped = min(stream.skip, len(payload))
+                    stream.skip -= skipped
+                    payload = payload[skipped:]
+                if to_server:
+                    connection.parser.feed_to_server(memoryview(payload))
+                else:
+                    connection.parser.feed_to_client(memoryview(payload))
+
+            # Сегменты, дождавшиеся предыдущих данных
+            for seq in stream.pending:
+                if (seq - stream.next_seq) & SEQ_MASK >= 1 << 31 or seq == stream.next_seq:
+                    payload = stream.pending.pop(seq)
+                    break
+            else:
+                return
+
+    def _in_order(self, stream: _TcpStream, seq: int, payload: bytes) -> Optional[bytes]:
+        """
+        Часть сегмента, которая продолжает поток. Сегменты после пропуска откладываются
+        """
+        ahead = (seq - stream.next_seq) & SEQ_MASK
+        if ahead >= 1 << 31:
+            # Повтор уже полученных данных
+            behind = (1 << 32) - ahead
+            return payload[behind:] if behind < len(payload) else None
+        if not ahead:
+            return payload
+        if len(stream.pending) >= MAX_PENDING_SEGMENTS:
+            stream.lost = True
+            stream.pending.clear()
+            self.stats.lost_streams += 1
+        elif len(payload) > len(stream.pending.get(seq, b'')):
+            stream.pending[seq] = bytes(payload)
+        return None
+
+
+class _Link:
+    """
+    Разбор заголовков пакетов pcap: границы записей ищутся по одной, заголовки канального
+    уровня, IP и TCP всех пакетов блока читаются операциями над массивами
+    """
+    def __init__(self, linktype: int, byte_order: str, fraction_ns: int):
+        self.packet_header = struct.Struct(byte_order + "IIII")
+        self.packet_dtype = np.dtype([("seconds", byte_order + "u4"),
+                                      ("fraction", byte_order + "u4"),
+                                      ("captured", byte_order + "u4"),
+                                      ("length", byte_order + "u4")])
+        self.fraction_ns = fraction_ns
+        # Смещение заголовка IP и положение ethertype, если он есть
+        self.ethertype_offset: Optional[int] = None
+        if linktype == LINKTYPE_ETHERNET:
+            self.ip_offset, self.ethertype_offset = 14, 12
+        elif linktype == LINKTYPE_LINUX_SLL:
+            self.ip_offset, self.ethertype_offset = 16, 14
+        elif linktype == LINKTYPE_LINUX_SLL2:
+            self.ip_offset, self.ethertype_offset = 20, 0
+        elif linktype == LINKTYPE_NULL:
+            self.ip_offset = 4
+        elif linktype in LINKTYPE_RAW:
+            self.ip_offset = 0
+        else:
+            raise ValueError(f"Unsupported pcap link type {linktype}")
+        self.vlan = linktype == LINKTYPE_ETHERNET
+
+    def walk(self, block: bytes) -> Tuple[List[int], int]:
+        """
+        Начала заголовков записей, целиком попавших в блок, и конец последней из них
+        """
+        positions = []
+        position = 0
+        header_size = self.packet_header.size
+        unpack_from = self.packet_header.unpack_from
+        while position + header_size <= len(block):
+            end = position + header_size + unpack_from(block, position)[2]
+            if end > len(block):
+                break
+            positions.append(position)
+            position = end
+        return positions, position
+
+    def tcp_segments(self, block: bytes, positions: List[int]) -> Dict[str, np.ndarray]:
+        data = np.frombuffer(block, dtype=np.uint8)
+        last = len(data) - 1
+
+        def u8(offsets: np.ndarray) -> np.ndarray:
+            return data[np.minimum(offsets, last)].astype(np.int64)
+
+        def u16(offsets: np.ndarray) -> np.ndarray:
+            return u8(offsets) << 8 | u8(offsets + 1)
+
+        headers = np.asarray(positions, dtype=np.int64)
+        fields = np.ascontiguousarray(
+            data[headers[:, None] + np.arange(self.packet_dtype.itemsize)]).view(
+                self.packet_dtype)[:, 0]
+        start = headers + self.packet_dtype.itemsize
+        end = start + fields["captured"].astype(np.int64)
+        ts_ns = fields["seconds"].astype(np.int64) * 1000000000 + \
+            fields["fraction"].astype(np.int64) * self.fraction_ns
+
+        ip = start + self.ip_offset
+        valid = end >= ip + 20
+        if self.ethertype_offset is not None:
+            ethertype = u16(start + self.ethertype_offset)
+            if self.vlan:
+                tagged = np.isin(ethertype, ETHERTYPE_VLAN)
+                ethertype = np.where(tagged, u16(ip + 2), ethertype)
+                ip = ip + 4 * tagged
+            valid &= (ethertype == ETHERTYPE_IPV4) | (ethertype == ETHERTYPE_IPV6)
+        version = u8(ip) >> 4
+        ipv4 = version == 4
+        ipv6 = version == 6
+        protocol = np.where(ipv4, u8(ip + 9), u8(ip + 6))
+        # Фрагменты не собираются
+        fragment = ipv4 & ((u16(ip + 6) & 0x3fff) != 0)
+        tcp = ip + np.where(ipv4, (u8(ip) & 0x0f) * 4, 40)
+        ip_end = ip + np.where(ipv4, u16(ip + 2), 40 + u16(ip + 4))
+        # Пакеты TSO больше 64 КиБ записываются с длиной IPv4 0
+        ip_end = np.where(ipv4 & (ip_end == ip), start + fields["length"].astype(np.int64),
+                          ip_end)
+        valid &= (ipv4 | ipv6) & (protocol == IPPROTO_TCP) & ~fragment & (end >= tcp + 20)
+        payload = tcp + (u8(tcp + 12) >> 4) * 4
+        valid &= (payload <= end) & (payload <= ip_end)
+        return {
+            "valid": valid,
+            "ts_ns": ts_ns,
+            "ip": ip,
+            "address_size": np.where(ipv4, 4, 16),
+            "src_port": u16(tcp),
+            "dst_port": u16(tcp + 2),
+            "seq": u16(tcp + 4) << 16 | u16(tcp + 6),
+            "flags": u8(tcp + 13),
+            "payload": payload,
+            "payload_end": np.minimum(ip_end, end),
+            "ip_end": ip_end,
+        }
+
+
+def read_trace(path: str, ports: Sequence[int] = DEFAULT_PORTS,
+               chunk_records: int = TRACE_CHUNK_RECORDS,
+               stats: Optional[TraceStats] = None) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Столбцы COLUMNS заголовков URB трассы порциями примерно по chunk_records записей.
+    Формат файла определяется по первым байтам
+    """
+    stats = stats if stats is not None else TraceStats()
+    builder = _ColumnsBuilder(chunk_records)
+    with open(path, "rb") as trace:
+        head = trace.read(8)
+    magic = struct.unpack("<I", head[:4])[0] if len(head) >= 4 else None
+    if head == CAPTURE_MAGIC:
+        chunks = _read_capture_ring(path, chunk_records, stats)
+    elif head.startswith(b"{"):
+        chunks = _read_capture_jsonl(path, chunk_records, stats)
+    elif magic == PCAPNG_MAGIC:
+        raise ValueError(f"{path} is pcapng, convert it with editcap -F pcap")
+    elif magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS) or \
+            struct.unpack(">I", head[:4])[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+        chunks = _PcapReader(ports, builder, stats).read(path)
+    else:
+        raise ValueError(f"Unknown trace format of {path}")
+    yield from chunks
+    if len(builder):
+        yield builder.take()
+
+
+def _extend(values: np.ndarray, size: int) -> np.ndarray:
+    if len(values) >= size:
+        return values
+    return np.concatenate([values, np.zeros((size - len(values),) + values.shape[1:],
+                                            dtype=values.dtype)])
+
+
+def _add_bins(series: np.ndarray, bins: np.ndarray, weights: Optional[np.ndarray] = None):
+    if not len(bins):
+        return series
+    counts = np.bincount(bins, weights=weights).astype(np.int64)
+    series = _extend(series, len(counts))
+    series[:len(counts)] += counts
+    return series
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    """
+    int.bit_length для неотрицательных чисел меньше 2**53
+    """
+    result = np.zeros(len(values), dtype=np.int64)
+    positive = values > 0
+    result[positive] = np.floor(np.log2(values[positive])).astype(np.int64) + 1
+    return result
+
+
+def _find(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Для каждого values - индекс первого равного ему элемента keys и признак, что он есть
+    """
+    if not len(keys):
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    order = np.argsort(keys, kind="stable")
+    positions = np.minimum(np.searchsorted(keys[order], values), len(keys) - 1)
+    found = keys[order][positions] == values
+    return order[positions], found
+
+
+class TraceAnalyzer:
+    """
+    Статистика трассы по порциям столбцов read_trace:
+    - задержки URB (от CMD_SUBMIT до RET_SUBMIT), байты, ошибки и отмены по конечным точкам;
+    - байты PDU в каждую сторону, отмены и наибольшее число URB без ответа за каждый интервал;
+    - наибольшее число URB без ответа по конечным точкам.
+    URB без ответа переносятся в следующие порции, поэтому порции могут резать трассу где угодно
+    """
+    def __init__(self, interval_s: float = 1., max_pending: int = MAX_PENDING_URBS):
+        self.interval_ns = max(1, int(interval_s * 1e9))
+        self.max_pending = max_pending
+        self.start_ns: Optional[int] = None
+        self.end_ns = 0
+        self.records = 0
+        self.sessions = set()
+        # devid << 5 | ep << 1 | направление -> номер конечной точки
+        self._endpoint_ids: Dict[int, int] = {}
+        self.endpoint_keys: List[int] = []
+        self._endpoint_direction = np.zeros(0, dtype=np.int64)
+        self.urbs = np.zeros(0, dtype=np.int64)
+        self.bytes = np.zeros(0, dtype=np.int64)
+        self.errors = np.zeros(0, dtype=np.int64)
+        self.unlinks = np.zeros(0, dtype=np.int64)
+        self.outstanding = np.zeros(0, dtype=np.int64)
+        self.max_outstanding = np.zeros(0, dtype=np.int64)
+        self.latency_counts = np.zeros((0, LatencyHistogram.BUCKETS), dtype=np.int64)
+        self.latency_total_us = np.zeros(0, dtype=np.int64)
+        self.latency_max_us = np.zeros(0, dtype=np.int64)
+        # URB без ответа: session << 32 | seqnum, время CMD_SUBMIT, конечная точка
+        self._pending_key = np.zeros(0, dtype=np.uint64)
+        self._pending_ts = np.zeros(0, dtype=np.int64)
+        self._pending_endpoint = np.zeros(0, dtype=np.int64)
+        # CMD_UNLINK без ответа: session << 32 | seqnum, session << 32 | seqnum отменяемого URB
+        self._unlink_key = np.zeros(0, dtype=np.uint64)
+        self._unlink_target = np.zeros(0, dtype=np.uint64)
+        self.total_outstanding = 0
+        # Ряды по интервалам
+        self.bytes_to_server = np.zeros(0, dtype=np.int64)
+        self.bytes_to_client = np.zeros(0, dtype=np.int64)
+        self.unlink_requests = np.zeros(0, dtype=np.int64)
+        self.outstanding_max = np.zeros(0, dtype=np.int64)
+        self.unmatched_returns = 0
+        self.lost_urbs = 0
+
+    def _endpoints(self, devid: np.ndarray, ep: np.ndarray, direction: np.ndarray) -> np.ndarray:
+        keys = (devid.astype(np.int64) << 5) | ((ep.astype(np.int64) & 0xf) << 1) | \
+            (direction.astype(np.int64) & 1)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        ids = np.empty(len(unique), dtype=np.int64)
+        for i, key in enumerate(unique.tolist()):
+            if key not in self._endpoint_ids:
+                self._endpoint_ids[key] = len(self.endpoint_keys)
+                self.endpoint_keys.append(key)
+            ids[i] = self._endpoint_ids[key]
+
+        count = len(self.endpoint_keys)
+        if count > len(self.urbs):
+            for name in ("urbs", "bytes", "errors", "unlinks", "outstanding", "max_outstanding",
+                         "latency_counts", "latency_total_us", "latency_max_us"):
+                setattr(self, name, _extend(getattr(self, name), count))
+            self._endpoint_direction = np.array([key & 1 for key in self.endpoint_keys])
+        return ids[inverse]
+
+    def _bins(self, ts_ns: np.ndarray) -> np.ndarray:
+        return np.maximum((ts_ns - self.start_ns) // self.interval_ns, 0)
+
+    def add(self, columns: Dict[str, np.ndarray]):
+        ts = columns["ts_ns"]
+        if not len(ts):
+            return
+        if self.start_ns is None:
+            self.start_ns = int(ts.min())
+        self.end_ns = max(self.end_ns, int(ts.max()))
+        self.records += len(ts)
+        self.sessions.update(np.unique(columns["session"]).tolist())
+
+        command = columns["command"]
+        session = columns["session"].astype(np.uint64) << np.uint64(32)
+        key = session | columns["seqnum"].astype(np.uint64)
+        bins = self._bins(ts)
+
+        to_server = (command == USBIP_CMD_SUBMIT) | (command == USBIP_CMD_UNLINK)
+        self.bytes_to_server = _add_bins(self.bytes_to_server, bins[to_server],
+                                         columns["size"][to_server])
+        self.bytes_to_client = _add_bins(self.bytes_to_client, bins[~to_server],
+                                         columns["size"][~to_server])
+
+        # CMD_SUBMIT
+        submit = command == USBIP_CMD_SUBMIT
+        submit_ts = ts[submit]
+        submit_endpoint = self._endpoints(columns["devid"][submit], columns["ep"][submit],
+                                          columns["direction"][submit])
+        count = len(self.endpoint_keys)
+        self.urbs += np.bincount(submit_endpoint, minlength=count)
+        out_bytes = np.where(columns["direction"][submit] == USBIP_DIR_OUT,
+                             np.maximum(columns["length"][submit], 0), 0)
+        self.bytes += np.bincount(submit_endpoint, weights=out_bytes,
+                                  minlength=count).astype(np.int64)
+        pending_key = np.concatenate([self._pending_key, key[submit]])
+        pending_ts = np.concatenate([self._pending_ts, submit_ts])
+        pending_endpoint = np.concatenate([self._pending_endpoint, submit_endpoint])
+        completed = np.zeros(len(pending_key), dtype=bool)
+
+        # RET_SUBMIT
+        ret = command == USBIP_RET_SUBMIT
+        index, found = _find(pending_key, key[ret])
+        self.unmatched_returns += int(np.count_nonzero(~found))
+        index = index[found]
+        completed[index] = True
+        ret_ts = ts[ret][found]
+        endpoint = pending_endpoint[index]
+        status = columns["status"][ret][found]
+        length = columns["length"][ret][found]
+        latency_us = np.maximum(ret_ts - pending_ts[index], 0) // 1000
+        bucket = np.minimum(_bit_length(latency_us), LatencyHistogram.BUCKETS - 1)
+        self.latency_counts += np.bincount(
+            endpoint * LatencyHistogram.BUCKETS + bucket,
+            minlength=count * LatencyHistogram.BUCKETS).reshape(count, -1)
+        self.latency_total_us += np.bincount(endpoint, weights=latency_us,
+                                             minlength=count).astype(np.int64)
+        np.maximum.at(self.latency_max_us, endpoint, latency_us)
+        self.errors += np.bincount(endpoint, weights=status != 0,
+                                   minlength=count).astype(np.int64)
+        in_bytes = (self._endpoint_direction[endpoint] == USBIP_DIR_IN) & (status == 0)
+        self.bytes += np.bincount(endpoint[in_bytes], weights=np.maximum(length[in_bytes], 0),
+                                  minlength=count).astype(np.int64)
+
+        # CMD_UNLINK и RET_UNLINK. После RET_UNLINK ответа на отменяемый URB уже не будет
+        unlink = command == USBIP_CMD_UNLINK
+        self.unlink_requests = _add_bins(self.unlink_requests, bins[unlink])
+        unlink_key = np.concatenate([self._unlink_key, key[unlink]])
+        unlink_target = np.concatenate([
+            self._unlink_target,
+            session[unlink] | columns["status"][unlink].view(np.uint32).astype(np.uint64)])
+        unlink_done = np.zeros(len(unlink_key), dtype=bool)
+        ret_unlink = command == USBIP_RET_UNLINK
+        index, found = _find(unlink_key, key[ret_unlink])
+        unlink_done[index[found]] = True
+        alive = np.flatnonzero(~completed)
+        target, target_found = _find(pending_key[alive], unlink_target[index[found]])
+        cancelled = alive[target[target_found]]
+        completed[cancelled] = True
+        cancel_ts = ts[ret_unlink][found][target_found]
+        self.unlinks += np.bincount(pending_endpoint[cancelled], minlength=count)
+
+        self._track_outstanding(
+            np.concatenate([submit_ts, ret_ts, cancel_ts]),
+            np.concatenate([submit_endpoint, endpoint, pending_endpoint[cancelled]]),
+            np.concatenate([np.ones(len(submit_ts), dtype=np.int64),
+                            -np.ones(len(ret_ts) + len(cancel_ts), dtype=np.int64)]))
+
+        self._pending_key = pending_key[~completed]
+        self._pending_ts = pending_ts[~completed]
+        self._pending_endpoint = pending_endpoint[~completed]
+        self._unlink_key = unlink_key[~unlink_done][-self.max_pending:]
+        self._unlink_target = unlink_target[~unlink_done][-self.max_pending:]
+        if len(self._pending_key) > self.max_pending:
+            self._drop_lost(len(self._pending_key) - self.max_pending)
+
+    def _track_outstanding(self, ts: np.ndarray, endpoint: np.ndarray, delta: np.ndarray):
+        """
+        delta +1 для CMD_SUBMIT и -1 для ответа или отмены в моменты ts
+        """
+        if not len(ts):
+            return
+        order = np.argsort(ts, kind="stable")
+        depth = self.total_outstanding + np.cumsum(delta[order])
+        self.total_outstanding = int(depth[-1])
+        bins = self._bins(ts[order])
+        self.outstanding_max = _extend(self.outstanding_max, int(bins[-1]) + 1)
+        np.maximum.at(self.outstanding_max, bins, depth)
+
+        order = np.lexsort((ts, endpoint))
+        endpoint, delta = endpoint[order], delta[order]
+        starts = np.flatnonzero(np.r_[True, endpoint[1:] != endpoint[:-1]])
+        group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(endpoint)]))
+        depth = np.cumsum(delta)
+        before = np.r_[0, depth[starts[1:] - 1]]
+        depth = depth - before[group] + self.outstanding[endpoint]
+        group_endpoint = endpoint[starts]
+        self.max_outstanding[group_endpoint] = np.maximum(
+            self.max_outstanding[group_endpoint], np.maximum.reduceat(depth, starts))
+        self.outstanding[group_endpoint] += np.add.reduceat(delta, starts)
+
+    def _drop_lost(self, count: int):
+        """
+        Самые старые URB без ответа больше не ждут ответа и не считаются незавершенными
+        """
+        lost = np.argsort(self._pending_ts, kind="stable")[:count]
+        keep = np.ones(len(self._pending_key), dtype=bool)
+        keep[lost] = False
+        np.subtract.at(self.outstanding, self._pending_endpoint[lost], 1)
+        self.total_outstanding -= count
+        self.lost_urbs += count
+        self._pending_key = self._pending_key[keep]
+        self._pending_ts = self._pending_ts[keep]
+        self._pending_endpoint = self._pending_endpoint[keep]
+
+    def to_dict(self) -> dict:
+        duration_s = (self.end_ns - self.start_ns) / 1e9 if self.start_ns is not None else 0.
+        interval_s = self.interval_ns / 1e9
+        endpoints = {}
+        for i, key in enumerate(self.endpoint_keys):
+            devid, ep, direction = key >> 5, (key >> 1) & 0xf, key & 1
+            latency = LatencyHistogram()
+            latency.counts = self.latency_counts[i].tolist()
+            latency.total_us = int(self.latency_total_us[i])
+            latency.max_us = int(self.latency_max_us[i])
+            urbs = int(self.urbs[i])
+            endpoints[f"{devid:08x}/{endpoint_name(ep, direction)}"] = {
+                "urbs": urbs,
+                "bytes": int(self.bytes[i]),
+                "errors": int(self.errors[i]),
+                "unlinks": int(self.unlinks[i]),
+                "unlink_ratio": int(self.unlinks[i]) / urbs if urbs else 0.,
+                "max_outstanding": int(self.max_outstanding[i]),
+                "latency": latency.to_dict(),
+            }
+        unlink_requests = int(self.unlink_requests.sum())
+        return {
+            "records": self.records,
+            "sessions": len(self.sessions),
+            "start": self.start_ns / 1e9 if self.start_ns is not None else None,
+            "duration_s": duration_s,
+            "endpoints": endpoints,
+            "throughput": {
+                "interval_s": interval_s,
+                "to_server_bytes_per_s": (self.bytes_to_server / interval_s).tolist(),
+                "to_client_bytes_per_s": (self.bytes_to_client / interval_s).tolist(),
+            },
+            "outstanding": {
+                "max": int(self.outstanding_max.max()) if len(self.outstanding_max) else 0,
+                "at_end": self.total_outstanding,
+                "max_per_interval": self.outstanding_max.tolist(),
+            },
+            "unlinks": {
+                "requests": unlink_requests,
+                "per_s": unlink_requests / duration_s if duration_s else 0.,
+                "per_interval": self.unlink_requests.tolist(),
+            },
+            "unmatched_returns": self.unmatched_returns,
+            "lost_urbs": self.lost_urbs,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze usbip URB trace")
+    parser.add_argument('trace', help='tls_proxy capture ring, its JSONL export or pcap file')
+    parser.add_argument('--port', type=int, action='append', default=None, dest='ports',
+                        help=f'usbip TCP port in pcap files (default {USBIP_SERVER_PORT} and '
+                             f'{PROXY_PORT})')
+    parser.add_argument('--interval', type=float, default=1., dest='interval_s',
+                        help='Time series interval in seconds')
+    parser.add_argument('--chunk', type=int, default=TRACE_CHUNK_RECORDS, dest='chunk_records',
+                        help='Records decoded at once')
+    args = parser.parse_args()
+
+    stats = TraceStats()
+    analyzer = TraceAnalyzer(args.interval_s)
+    try:
+        for columns in read_trace(args.trace, args.ports or DEFAULT_PORTS, args.chunk_records,
+                                  stats):
+            analyzer.add(columns)
+    except ValueError as e:
+        parser.exit(1, f"Error: {e}\n")
+    report = analyzer.to_dict()
+    report["input"] = stats.to_dict()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+"""
+Режим нескольких процессов: супервизор запускает workers процессов asyncio-прокси,
+которые слушают один порт через SO_REUSEPORT, так что ядро распределяет между ними соединения,
+а шифрование TLS выполняется на нескольких ядрах. Процессы создает fork-ом процесс запуска
+(WorkerLauncher), который супервизор создает до своего цикла событий, поэтому они не
+наследуют ни цикл событий супервизора, ни его управляющие сокеты.
+Супервизор перезапускает упавшие процессы и суммирует их статистику. Под systemd с WatchdogSec
+процессы отправляют WATCHDOG=1 супервизору, он перезапускает процессы с зависшим циклом
+событий и сам уведомляет systemd
+"""
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import dataclasses
+import logging
+import asyncio
+import select
+import signal
+import socket
+import json
+import time
+import os
+
+from tls_proxy.config import ProxyConfig, CAPTURE_PATH
+from tls_proxy.control import ControlServer, ControlError, async_request
+from tls_proxy.systemd import NotifySocket
+from tls_proxy import async_relay, systemd
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
+
+WORKER_RESTART_DELAY_S = 1.
+# Как часто опрашивать процессы, ожидая события сессий
+EVENTS_POLL_INTERVAL_S = 0.1
+LAUNCHER_MESSAGE_SIZE = 4096
+# Значения, которые у процессов не складываются: измерения и состояние каждого процесса,
+# берутся у первого процесса
+FIRST_WORKER_STATS = {"rates_mb_per_s", "tokens", "ttl_s"}
+# Доли пересчитываются по суммам счетчиков: поле -> (числитель, знаменатель)
+RATIO_STATS = {
+    "hit_ratio": (("hits", "negative_hits"), ("hits", "negative_hits", "misses", "coalesced")),
+    "saved_ratio": (("hits", "coalesced"), ("hits", "misses", "coalesced")),
+}
+
+
+def worker_control_socket(control_socket: str, index: int) -> str:
+    return f"{control_socket}.{index}"
+
+
+def merge_stats(total: Any, stats: Any) -> Any:
+    """
+    Суммирует счетчики из статистики процессов. Для полей max_* берет максимум, доли
+    пересчитывает по суммам, производные значения (средние, перцентили) пропускает.
+    Флаги и значения FIRST_WORKER_STATS не складываются, остаются от первого процесса
+    """
+    if isinstance(total, dict) and isinstance(stats, dict):
+        merged = {}
+        for key in total.keys() | stats.keys():
+            if key.startswith("avg") or (key.startswith("p") and key.endswith("_us")):
+                continue
+            if key not in total or key not in stats:
+                merged[key] = total.get(key, stats.get(key))
+            elif key in FIRST_WORKER_STATS:
+                merged[key] = total[key]
+            elif key.startswith("max"):
+                merged[key] = max(total[key], stats[key])
+            else:
+                merged[key] = merge_stats(total[key], stats[key])
+        for key, (numerator, denominator) in RATIO_STATS.items():
+            if key in merged:
+                count = sum(merged.get(name, 0) for name in denominator)
+                merged[key] = sum(merged.get(name, 0) for name in numerator) / count \
+                    if count else 0.
+        return merged
+    if isinstance(total, bool) or isinstance(stats, bool):
+        return total
+    if isinstance(total, (int, float)) and isinstance(stats, (int, float)):
+        return total + stats
+    return total
+
+
+class WorkerLauncher:
+    """
+    Процесс без цикла событий, который по запросам супервизора создает процессы прокси fork-ом
+    и сообщает об их запуске и завершении. Он родитель процессов, поэтому сигналы им тоже
+    отправляет он: pid не достанется другому процессу, пока завершение не обработано.
+    Когда соединение с супервизором закрывается, процесс запуска завершает процессы прокси
+    и завершается сам
+    """
+    def __init__(self, worker_main: Callable[[int], int]):
+        self.worker_main = worker_main
+        self.pid: Optional[int] = None
+        self.sock: Optional[socket.socket] = None
+        # pid -> номер процесса, в процессе запуска
+        self._workers: Dict[int, int] = {}
+
+    def start(self, inherited: Sequence[socket.socket] = ()):
+        """
+        inherited - сокеты супервизора, которые процессу запуска не нужны
+        """
+        self.sock, launcher_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.pid = os.fork()
+        if self.pid == 0:
+            code = 1
+            try:
+                self.sock.close()
+                for sock in inherited:
+                    sock.close()
+                self._run(launcher_sock)
+                code = 0
+            finally:
+                os._exit(code)
+        launcher_sock.close()
+        self.sock.setblocking(False)
+
+    def spawn(self, index: int):
+        self.sock.send(json.dumps({"command": "spawn", "index": index}).encode())
+
+    def kill(self, pid: int, sig: int):
+        self.sock.send(json.dumps({"command": "kill", "pid": pid, "signal": sig}).encode())
+
+    def receive(self) -> Optional[List[dict]]:
+        """
+        События started и exited процессов прокси, None - если процесс запуска завершился
+        """
+        messages = []
+        while True:
+            try:
+                data = self.sock.recv(LAUNCHER_MESSAGE_SIZE)
+            except BlockingIOError:
+                return messages
+            if not data:
+                return messages or None
+            messages.append(json.loads(data))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.pid is not None:
+            os.waitpid(self.pid, 0)
+            self.pid = None
+
+    def _run(self, sock: socket.socket):
+        # Ctrl+C и SIGTERM от systemd получают и процессы прокси, процесс запуска завершается
+        # вместе с супервизором
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_IGN)
+        wakeup, wakeup_write = socket.socketpair()
+        for wakeup_sock in (wakeup, wakeup_write):
+            wakeup_sock.setblocking(False)
+        signal.set_wakeup_fd(wakeup_write.fileno())
+        signal.signal(signal.SIGCHLD, lambda *_: None)
+        try:
+            while True:
+                readable, _, _ = select.select([sock, wakeup], [], [])
+                if wakeup in readable:
+                    try:
+                        while wakeup.recv(LAUNCHER_MESSAGE_SIZE):
+                            pass
+                    except BlockingIOError:
+                        pass
+                self._reap(sock)
+                if sock in readable:
+                    data = sock.recv(LAUNCHER_MESSAGE_SIZE)
+                    if not data:
+                        return
+                    self._execute(sock, json.loads(data), (wakeup, wakeup_write))
+        finally:
+            for pid in self._workers:
+                os.kill(pid, signal.SIGTERM)
+            for pid in self._workers:
+                os.waitpid(pid, 0)
+
+    def _execute(self, sock: socket.socket, request: dict, inherited: Sequence[socket.socket]):
+        if request["command"] == "spawn":
+            index = request["index"]
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    for child_sock in (sock, *inherited):
+                        child_sock.close()
+                    signal.set_wakeup_fd(-1)
+                    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                        signal.signal(sig, signal.SIG_DFL)
+                    code = self.worker_main(index)
+                finally:
+                    os._exit(code)
+            self._workers[pid] = index
+            self._send(sock, {"event": "started", "index": index, "pid": pid})
+        elif request["command"] == "kill" and request["pid"] in self._workers:
+            os.kill(request["pid"], request["signal"])
+
+    def _reap(self, sock: socket.socket):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index = self._workers.pop(pid, None)
+            if index is not None:
+                self._send(sock, {"event": "exited", "index": index, "pid": pid,
+                                  "status": os.waitstatus_to_exitcode(status)})
+
+    @staticmethod
+    def _send(sock: socket.socket, message: dict):
+        try:
+            sock.send(json.dumps(message).encode())
+        except OSError:
+            # Супервизор завершился, соединение закроется
+            pass
+
+
+class Supervisor:
+    def __init__(self, config: ProxyConfig):
+        self.config = config
+        # pid -> номер процесса
+        self.workers: Dict[int, int] = {}
+        self.cpus: List[int] = sorted(os.sched_getaffinity(0))
+        self.launcher = WorkerLauncher(self._worker_main)
+        self._stopping = asyncio.Event()
+        self._workers_changed = asyncio.Event()
+        # WatchdogSec службы и время последнего WATCHDOG=1 от процессов по pid
+        self.watchdog_timeout_s: Optional[float] = None
+        self.notify_sock: Optional[NotifySocket] = None
+        self.last_ping: Dict[int, float] = {}
+        self.control: Optional[ControlServer] = None
+        if config.control_socket:
+            self.control = ControlServer(config.control_socket)
+            self.control.register("stats", self.stats)
+            self.control.register("sessions", self.sessions_info)
+            self.control.register("urb_stats", self.urb_stats)
+            self.control.register("pool", self.pool_info)
+            self.control.register("devlist_cache", self.devlist_cache_info)
+            self.control.register("workers", self.workers_info)
+            self.control.register("timings", self.timings)
+            self.control.register("capture", self.capture_control)
+            self.control.register("rate_limits", self.rate_limits)
+            self.control.register("tcp_info", self.connections_info)
+            self.control.register("session_events", self.session_events)
+            if config.impair:
+                self.control.register("impair", self.impair)
+
+    def worker_config(self, index: int) -> ProxyConfig:
+        control_socket = worker_control_socket(self.config.control_socket, index) \
+            if self.config.control_socket else None
+        capture_path = f"{self.config.capture_path}.{index}" if self.config.capture_path else None
+        return dataclasses.replace(self.config, workers=0, reuse_port=True,
+                                   control_socket=control_socket, capture_path=capture_path)
+
+    def start(self):
+        """
+        Создает процесс запуска и запрашивает первые процессы прокси. Вызывается до запуска
+        цикла событий
+        """
+        self.watchdog_timeout_s = systemd.watchdog_timeout_s()
+        if self.watchdog_timeout_s:
+            self.notify_sock = NotifySocket(f"tls_proxy.workers.{os.getpid()}")
+        self.launcher.start([self.notify_sock.sock] if self.notify_sock is not None else [])
+        for index in range(self.config.workers):
+            self.launcher.spawn(index)
+
+    def _worker_main(self, index: int) -> int:
+        """
+        Процесс прокси, его создает процесс запуска
+        """
+        if self.notify_sock is not None:
+            systemd.set_notify_environ(self.notify_sock.address, self.watchdog_timeout_s)
+        else:
+            systemd.set_notify_environ(None)
+
+        if self.config.cpu_affinity:
+            cpu = self.cpus[index % len(self.cpus)]
+            os.sched_setaffinity(0, {cpu})
+            _LOGGER.info(f"Worker {index} pinned to cpu {cpu}")
+
+        try:
+            async_relay.server_run(self.worker_config(index))
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            _LOGGER.critical(f"Worker {index} failed: {e}")
+            return 1
+        return 0
+
+    def _read_launcher(self):
+        messages = self.launcher.receive()
+        self._workers_changed.set()
+        if messages is None:
+            asyncio.get_running_loop().remove_reader(self.launcher.sock.fileno())
+            if not self._stopping.is_set():
+                _LOGGER.critical("Worker launcher exited, stopping")
+                self._stopping.set()
+            return
+        # Ожидающий _wait_workers проверит процессы, когда сообщения будут обработаны
+        for message in messages:
+            pid, index = message["pid"], message["index"]
+            if message["event"] == "started":
+                self.workers[pid] = index
+                self.last_ping[pid] = time.monotonic()
+                _LOGGER.info(f"Worker {index} started (pid {pid})")
+                continue
+            self.workers.pop(pid, None)
+            self.last_ping.pop(pid, None)
+            if self._stopping.is_set():
+                continue
+            _LOGGER.error(f"Worker {index} (pid {pid}) exited with status "
+                          f"{message['status']}, restarting")
+            asyncio.get_running_loop().call_later(WORKER_RESTART_DELAY_S, self._respawn, index)
+
+    def _respawn(self, index: int):
+        if not self._stopping.is_set():
+            self.launcher.spawn(index)
+
+    async def _wait_workers(self):
+        """
+        Ждет запуска первых процессов, чтобы управляющие команды сразу видели их все
+        """
+        while len(self.workers) < self.config.workers and not self._stopping.is_set():
+            self._workers_changed.clear()
+            await self._workers_changed.wait()
+
+    def _read_notify(self):
+        for pid, states in self.notify_sock.receive():
+            if "WATCHDOG=1" in states and pid in self.workers:
+                self.last_ping[pid] = time.monotonic()
+
+    async def _watchdog(self):
+        """
+        Уведомляет systemd, пока работает цикл событий супервизора, и завершает процессы,
+        от которых не было WATCHDOG=1 дольше WatchdogSec, после чего _reap их перезапускает
+        """
+        while True:
+            now = time.monotonic()
+            for pid, index in self.workers.items():
+                if now - self.last_ping[pid] > self.watchdog_timeout_s:
+                    _LOGGER.error(f"Worker {index} (pid {pid}) watchdog timeout, killing")
+                    self.launcher.kill(pid, signal.SIGKILL)
+                    self.last_ping[pid] = now
+            systemd.notify("WATCHDOG=1")
+            await asyncio.sleep(self.watchdog_timeout_s / 2)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._stopping.set)
+        loop.add_reader(self.launcher.sock.fileno(), self._read_launcher)
+        watchdog_task = None
+        if self.notify_sock is not None:
+            loop.add_reader(self.notify_sock.sock.fileno(), self._read_notify)
+
+        await self._wait_workers()
+        if self.control is not None:
+            await self.control.start()
+        systemd.notify("READY=1")
+        if self.watchdog_timeout_s:
+            watchdog_task = loop.create_task(self._watchdog())
+        try:
+            await self._stopping.wait()
+        finally:
+            self._stopping.set()
+            systemd.notify("STOPPING=1")
+            if watchdog_task is not None:
+                watchdog_task.cancel()
+            if self.control is not None:
+                self.control.close()
+            if self.notify_sock is not None:
+                loop.remove_reader(self.notify_sock.sock.fileno())
+                self.notify_sock.close()
+            # Процесс запуска завершает процессы прокси, когда соединение с ним закрывается
+            loop.remove_reader(self.launcher.sock.fileno())
+            self.launcher.close()
+            self.workers.clear()
+
+    async def _query_workers(self, command: str, indexes: Optional[Sequence[int]] = None,
+                             worker_params: Optional[Callable[[int], dict]] = None,
+                             strict: bool = False, **params) -> Dict[int, Any]:
+        """
+        Ответы процессов indexes (по умолчанию всех), worker_params - параметры команды
+        для отдельного процесса. Не ответившие процессы пропускаются, а со strict команда
+        завершается ошибкой: так команды, которые меняют состояние, не выполняются частично
+        незаметно
+        """
+        if indexes is None:
+            indexes = sorted(self.workers.values())
+        replies = await asyncio.gather(
+            *(async_request(command, worker_control_socket(self.config.control_socket, index),
+                            **params, **(worker_params(index) if worker_params else {}))
+              for index in indexes),
+            return_exceptions=True)
+        results = {}
+        for index, reply in zip(indexes, replies):
+            if strict and isinstance(reply, Exception):
+                raise ControlError(f"Worker {index}: {reply}")
+            if isinstance(reply, (OSError, ControlError)):
+                _LOGGER.warning(f"Worker {index} did not answer {command}: {reply}")
+                continue
+            if isinstance(reply, BaseException):
+                raise reply
+            results[index] = reply
+        return results
+
+    async def _merged_stats(self, command: str) -> dict:
+        workers = await self._query_workers(command)
+        total: Any = {}
+        for stats in workers.values():
+            total = merge_stats(total, stats)
+        return {"total": total, "workers": workers}
+
+    async def stats(self) -> dict:
+        return await self._merged_stats("stats")
+
+    async def pool_info(self) -> dict:
+        return await self._merged_stats("pool")
+
+    async def devlist_cache_info(self) -> dict:
+        return await self._merged_stats("devlist_cache")
+
+    async def urb_stats(self) -> dict:
+        """
+        Статистика серверов суммируется по процессам без средних и перцентилей, сессии
+        нумеруются, как в sessions
+        """
+        workers = await self._query_workers("urb_stats")
+        servers: Any = {}
+        for reply in workers.values():
+            servers = merge_stats(servers, reply["servers"])
+        return {
+            "servers": servers,
+            "sessions": {f"{index}.{session_id}": session
+                         for index, reply in workers.items()
+                         for session_id, session in reply["sessions"].items()},
+        }
+
+    async def sessions_info(self) -> dict:
+        workers = await self._query_workers("sessions")
+        return {f"{index}.{session_id}": session
+                for index, sessions in workers.items() for session_id, session in sessions.items()}
+
+    async def connections_info(self) -> dict:
+        """
+        Сессии с номерами, как в sessions, туннели - по процессам
+        """
+        workers = await self._query_workers("tcp_info")
+        return {
+            "sessions": {f"{index}.{session_id}": session
+                         for index, reply in workers.items()
+                         for session_id, session in reply["sessions"].items()},
+            "tunnels": {index: reply["tunnels"] for index, reply in workers.items()},
+        }
+
+    async def session_events(self, since: Any = 0, timeout: float = 0) -> dict:
+        """
+        У каждого процесса свои номера событий: since - номер для всех процессов или словарь
+        {процесс: last_seq} из прошлого ответа. С timeout процессы опрашиваются, пока у одного
+        из них не появятся события
+        """
+        if timeout < 0:
+            raise ControlError("timeout must not be negative")
+        if not isinstance(since, dict):
+            since = {str(index): since for index in self.workers.values()}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            results = await self._query_workers(
+                "session_events", strict=True,
+                worker_params=lambda index: {"since": since.get(str(index), 0)})
+            if any(reply["events"] for reply in results.values()) or loop.time() >= deadline:
+                return results
+            await asyncio.sleep(min(EVENTS_POLL_INTERVAL_S, deadline - loop.time()))
+
+    async def timings(self, **params) -> dict:
+        """
+        Перцентили не суммируются, поэтому возвращаются по процессам
+        """
+        return await self._query_workers("timings", **params)
+
+    async def capture_control(self, enable: Optional[bool] = None, file: Optional[str] = None,
+                              **params) -> dict:
+        """
+        Каждый процесс пишет захват в свой файл file.N
+        """
+        file = file or self.config.capture_path or CAPTURE_PATH
+        return await self._query_workers("capture", strict=True, enable=enable,
+                                         worker_params=lambda index: {"file": f"{file}.{index}"},
+                                         **params)
+
+    async def _session_command(self, command: str, session: Optional[str],
+                               params: dict) -> dict:
+        """
+        Команда для всех процессов или для процесса сессии session - номера из команды
+        sessions вида "процесс.сессия"
+        """
+        indexes = sorted(self.workers.values())
+        if session is not None:
+            index, _, session_id = str(session).partition(".")
+            if not index.isdigit() or not session_id.isdigit() or int(index) not in indexes:
+                raise ControlError(f"No session {session}")
+            indexes = [int(index)]
+            params["session"] = int(session_id)
+        return await self._query_workers(command, indexes, strict=True, **params)
+
+    async def rate_limits(self, session: Optional[str] = None, **params) -> dict:
+        """
+        Ограничение сервера действует в каждом процессе отдельно
+        """
+        return await self._session_command("rate_limits", session, params)
+
+    async def impair(self, session: Optional[str] = None, **params) -> dict:
+        return await self._session_command("impair", session, params)
+
+    def workers_info(self) -> dict:
+        return {index: pid for pid, index in self.workers.items()}
+
+
+def server_run(config: ProxyConfig):
+    supervisor = Supervisor(config)
+    supervisor.start()
+    asyncio.run(supervisor.run())